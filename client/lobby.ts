@@ -15,7 +15,7 @@ import { notify } from './notification';
 import { PyChessModel } from "./types";
 import { MsgChat, MsgFullChat } from "./messages";
 import { variantPanels } from './lobby/layer1';
-import { Stream, Spotlight, MsgInviteCreated, MsgHostCreated, MsgGetSeeks, MsgNewGame, MsgGameInProgress, MsgUserConnected, MsgPing, MsgError, MsgShutdown, MsgGameCounter, MsgUserCounter, MsgStreams, MsgSpotlights, Seek, CreateMode } from './lobbyType';
+import { Stream, Spotlight, MsgInviteCreated, MsgHostCreated, MsgGetSeeks, MsgSeeksUpdate, MsgNewGame, MsgGameInProgress, MsgUserConnected, MsgPing, MsgError, MsgShutdown, MsgGameCounter, MsgUserCounter, MsgStreams, MsgSpotlights, Seek, CreateMode } from './lobbyType';
 
 export class LobbyController implements IChatController {
     sock: WebsocketHeartbeatJs;
@@ -701,6 +701,9 @@ export class LobbyController implements IChatController {
             case "get_seeks":
                 this.onMsgGetSeeks(msg);
                 break;
+            case "seeks_update":
+                this.onMsgSeeksUpdate(msg);
+                break;
             case "new_game":
                 this.onMsgNewGame(msg);
                 break;
@@ -765,6 +768,12 @@ export class LobbyController implements IChatController {
         oldSeeks.innerHTML = "";
         patch(oldSeeks, h('table#seeks', this.renderSeeks(msg.seeks)));
     }
+    private onMsgSeeksUpdate(msg: MsgSeeksUpdate) {
+        // added seeks replace their old version if we already have it
+        const changed = new Set(msg.remove.concat(msg.add.map(seek => seek.seekID)));
+        const seeks = this.seeks.filter(seek => !changed.has(seek.seekID)).concat(msg.add);
+        this.onMsgGetSeeks({ seeks: seeks });
+    }
     private onMsgNewGame(msg: MsgNewGame) {
         window.location.assign('/' + msg.gameId);
     }
@@ -26,6 +26,11 @@ export interface MsgGetSeeks {
 	seeks: Seek[]
 }
 
+export interface MsgSeeksUpdate {
+	add: Seek[];
+	remove: string[];
+}
+
 export interface MsgNewGame {
 	gameId: string;
 }
@@ -76,6 +76,21 @@ export interface MsgBoard {
     clocks?: Clocks;
 }
 
+// Sent instead of MsgBoard for every new ply of a running game
+export interface MsgBoardMove {
+    gameId: string;
+    ply: number;
+    status: number;
+    fen: string;
+    lastMove: string;
+    san: string;
+    check: boolean;
+    clocks: Clocks;
+
+    byo?: number[];
+    berserk?: { w: boolean, b: boolean };
+}
+
 export interface Ceval {
     d: number;
     multipv?: number;
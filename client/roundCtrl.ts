@@ -19,7 +19,7 @@ import { player } from './player';
 import { updateCount, updatePoint } from './info';
 import { updateMaterial, emptyMaterial } from './material';
 import { notify } from './notification';
-import { Clocks, MsgBoard, MsgGameEnd, MsgMove, MsgNewGame, MsgUserConnected, RDiffs, CrossTable } from "./messages";
+import { Clocks, MsgBoard, MsgBoardMove, MsgGameEnd, MsgMove, MsgNewGame, MsgUserConnected, RDiffs, CrossTable } from "./messages";
 import { MsgUserDisconnected, MsgUserPresent, MsgMoreTime, MsgDrawOffer, MsgDrawRejected, MsgRematchOffer, MsgRematchRejected, MsgCount, MsgSetup, MsgGameStart, MsgViewRematch, MsgUpdateTV, MsgBerserk } from './roundType';
 import { PyChessModel } from "./types";
 import { GameController } from './gameCtrl';
@@ -825,6 +825,31 @@ export class RoundController extends GameController {
         this.updateMaterial();
     }
 
+    private onMsgBoardMove = (msg: MsgBoardMove) => {
+        if (msg.gameId !== this.gameId) return;
+
+        // We missed some ply, only a full board message can fix our steps
+        if (this.ply === -1 || msg.ply > this.ply + 1) {
+            this.doSend({ type: "board", gameId: this.gameId });
+            return;
+        }
+
+        const turnColor = msg.fen.split(" ")[1] === "w" ? "white" : "black";
+        this.onMsgBoard({
+            gameId: msg.gameId,
+            fen: msg.fen,
+            ply: msg.ply,
+            lastMove: msg.lastMove,
+            check: msg.check,
+            status: msg.status,
+            result: this.result,
+            steps: [{ fen: msg.fen, move: msg.lastMove, check: msg.check, turnColor: turnColor, san: msg.san }],
+            clocks: msg.clocks,
+            byo: msg.byo,
+            berserk: msg.berserk || { w: false, b: false },
+        } as MsgBoard);
+    }
+
     goPly = (ply: number, plyVari = 0) => {
         super.goPly(ply, plyVari);
 
@@ -1067,6 +1092,9 @@ export class RoundController extends GameController {
             case "board":
                 this.onMsgBoard(msg);
                 break;
+            case "move":
+                this.onMsgBoardMove(msg);
+                break;
             case "gameEnd":
                 this.checkStatus(msg);
                 break;
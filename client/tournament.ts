@@ -680,6 +680,7 @@ export class TournamentController implements IChatController {
                 this.onMsgGetGames(msg);
                 break;
             case "board":
+            case "move":
                 this.onMsgBoard(msg);
                 break;
             case "gameEnd":
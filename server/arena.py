@@ -1,7 +1,26 @@
+import logging
 import time
 
 from const import ARENA
-from tournament import Tournament
+from matching import max_weight_matching
+from tournament import Tournament, SCORE_SHIFT
+
+log = logging.getLogger(__name__)
+
+# Waiting players are paired in groups of neighbours on the leaderboard
+PAIRING_GROUP_SIZE = 24
+
+# Seconds a pairing wave may spend in max_weight_matching() before
+# the remaining groups are paired with neighbours on the leaderboard
+PAIRING_TIME_BUDGET = 1.0
+
+# Weight of a pairing is PAIR_WEIGHT minus its cost, so the matching
+# always prefers one more pair over any cheaper set of pairings
+PAIR_WEIGHT = 1000000
+RANK_COST = 10
+SCORE_COST = 50
+COLOR_COST = 100
+WAITING_BONUS = 200
 
 
 class ArenaTournament(Tournament):
@@ -10,140 +29,85 @@ class ArenaTournament(Tournament):
     def just_played_together(self, x, y):
         return y.username == self.players[x].prev_opp or x.username == self.players[y].prev_opp
 
-    def create_pairing(self, waiting_players):
-        start = time.time()
-        pairing = []
+    def pair_weight(self, x, y, rank_distance, rematch):
+        """Weight of the x-y pairing in the matching, None if they can't be paired"""
+        px, py = self.players[x], self.players[y]
+
+        if not rematch and self.just_played_together(x, y):
+            return None
+
+        cost = rank_distance * RANK_COST
+        cost += abs(self.leaderboard[x] - self.leaderboard[y]) // SCORE_SHIFT * SCORE_COST
+        if px.color_balance * py.color_balance > 0:
+            # one of them will get the same color again
+            cost += min(abs(px.color_balance), abs(py.color_balance)) * COLOR_COST
+        bonus = (px.nb_not_paired + py.nb_not_paired) * WAITING_BONUS
+
+        return PAIR_WEIGHT - cost + bonus
+
+    def pair_group(self, group, rematch):
+        """Max weight matching of the group, returns pairs and the unpaired players"""
+        edges = []
+        for i in range(len(group)):
+            for j in range(i + 1, len(group)):
+                weight = self.pair_weight(group[i], group[j], j - i, rematch)
+                if weight is not None:
+                    edges.append((i, j, weight))
+
+        mate = max_weight_matching(edges)
+        pairs = [(group[i], group[j]) for i, j in enumerate(mate) if i < j]
+        unpaired = [group[i] for i in range(len(group)) if i >= len(mate) or mate[i] == -1]
+        return pairs, unpaired
+
+    def pair_neighbours(self, group, rematch):
+        """Fallback when out of time: pair every player with the next possible one"""
+        pairs = []
+        unpaired = []
+        rest = list(group)
+        while rest:
+            x = rest.pop(0)
+            y = next((y for y in rest[:3] if self.pair_weight(x, y, 1, rematch) is not None), None)
+            if y is None:
+                unpaired.append(x)
+            else:
+                rest.remove(y)
+                pairs.append((x, y))
+        return pairs, unpaired
 
+    def create_pairing(self, waiting_players):
+        start = time.monotonic()
         nb_waiting_players = len(waiting_players)
+        # two lonely players may play again when nobody else is playing
+        rematch = nb_waiting_players == 2 and self.ongoing_games == 0
+
+        # waiting_players() are in leaderboard order
+        pairs = []
+        unpaired = []
+        for i in range(0, len(waiting_players), PAIRING_GROUP_SIZE):
+            # players left unpaired in the previous group get the top of the next one
+            group = unpaired + waiting_players[i : i + PAIRING_GROUP_SIZE]
+            if time.monotonic() - start < PAIRING_TIME_BUDGET:
+                group_pairs, unpaired = self.pair_group(group, rematch)
+            else:
+                group_pairs, unpaired = self.pair_neighbours(group, rematch)
+            pairs += group_pairs
 
-        print("=== WAITING PLAYERS ===", nb_waiting_players)
-        for p in waiting_players:
-            print("%20s %s" % (p.username, self.leaderboard[p]))
-        print("======================")
-
-        failed = 0
-        failed_limit = nb_waiting_players
-        while True:
-            if len(waiting_players) <= 1:
-                if len(waiting_players) == 1:
-                    self.players[waiting_players[0]].nb_not_paired += 1
-                break
-            elif failed >= failed_limit:
-                print("!!! TOO MUCH fail, STOP PAIRING !!!", failed)
-                break
-
-            def pair_them(x, y):
-                if self.players[x].color_balance < self.players[y].color_balance:
-                    wp, bp = x, y
-                else:
-                    wp, bp = y, x
-
-                waiting_players.remove(wp)
-                waiting_players.remove(bp)
-
-                pairing.append((wp, bp))
-
-            def find_opp(color_balance_limit):
-                find = False
-
-                # If we started the pairing with exactly 2 free players only
-                # and they never played before, pair them!
-                if nb_waiting_players == 2:
-                    y = waiting_players[1]
-
-                    if y.username not in (
-                        g.wplayer.username
-                        if g.bplayer.username == x.username
-                        else g.bplayer.username
-                        for g in self.players[x].games
-                    ):
-                        print("   find OK opp (they never played before!)", y.username)
-                        pair_them(x, y)
-                        return True
-                    elif self.ongoing_games == 0:
-                        print("   find OK opp (duel!)", y.username)
-                        pair_them(x, y)
-                        return True
-                    else:
-                        return False
-
-                if len(waiting_players) == 3:
-                    a = waiting_players[-1]
-                    b = waiting_players[-2]
-
-                    y = a if self.players[a].nb_not_paired > self.players[b].nb_not_paired else b
-
-                    if not self.just_played_together(x, y):
-                        print("   find OK opp from other remaining 2", y.username)
-                        pair_them(x, y)
-                        return True
-
-                for y in waiting_players:
-                    print("   try", y.username)
-                    if y.username == x.username:
-                        print("   SKIP the same")
-                        continue
-                    if self.just_played_together(x, y):
-                        print("   FAIL, same prev_opp")
-                        continue
-
-                    if self.players[x].color_balance < color_balance_limit:
-                        # player x played more black games
-                        if self.players[x].color_balance >= self.players[y].color_balance:
-                            print(
-                                "   FAILED color_balance x vs y",
-                                self.players[x].color_balance,
-                                self.players[y].color_balance,
-                            )
-                            continue
-                        else:
-                            find = True
-                            wp, bp = x, y
-                    else:
-                        find = True
-                        wp, bp = y, x
-
-                    print("   find OK opp!", y.username)
-                    waiting_players.remove(wp)
-                    waiting_players.remove(bp)
-
-                    pairing.append((wp, bp))
-                    break
-                return find
-
-            x = waiting_players[0]
-            print("pairing...", x.username)
-
-            find = find_opp(0)
-
-            if not find:
-                failed += 1
-                find = find_opp(-1)
-                if not find:
-                    failed += 1
-                    print("   1. OH NO, I can't find an opp for %s :(" % x.username)
-
-                    waiting_players.remove(x)
-
-                    if len(waiting_players) > 1:
-                        # OK try the second player now
-                        x = waiting_players[0]
-                        print("pairing...", x.username)
-
-                        find = find_opp(0)
-
-                        if not find:
-                            failed += 1
-                            find = find_opp(-1)
-                            if not find:
-                                failed += 1
-                                print("   2. OH NO, I can't find an opp for %s :(" % x.username)
-
-        print("=== PAIRINGS === failed", failed)
-        for p in pairing:
-            print(p[0].username, p[1].username)
-        print("======================")
-
-        end = time.time()
-        print("PAIRING TIME:", end - start)
+        pairing = []
+        for x, y in pairs:
+            if self.players[x].color_balance < self.players[y].color_balance:
+                pairing.append((x, y))
+            else:
+                pairing.append((y, x))
+
+        for player in unpaired:
+            self.players[player].nb_not_paired += 1
+
+        log.debug(
+            "%s arena pairing: %s waiting, %s pairs, %s unpaired in %.3f s",
+            self.id,
+            nb_waiting_players,
+            len(pairing),
+            len(unpaired),
+            time.monotonic() - start,
+        )
         return pairing
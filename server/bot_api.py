@@ -5,9 +5,9 @@ import logging
 from aiohttp import web
 
 from const import STARTED, RESIGN
-from broadcast import round_broadcast, lobby_broadcast
+from broadcast import round_broadcast, send_json
 from user import User
-from seek import challenge, get_seeks, Seek
+from seek import challenge, Seek
 from utils import join_seek, play_move
 from settings import BOT_TOKENS
 
@@ -75,7 +75,6 @@ async def create_bot_seek(request):
 
     users = request.app["users"]
     seeks = request.app["seeks"]
-    sockets = request.app["lobbysockets"]
 
     bot_player = users[username]
 
@@ -109,7 +108,7 @@ async def create_bot_seek(request):
         bot_player.seeks[seek.id] = seek
 
         # inform others
-        await lobby_broadcast(sockets, get_seeks(seeks))
+        request.app["seek_feed"].changed()
     else:
         games = request.app["games"]
         response = await join_seek(request.app, bot_player, matching_seek.id)
@@ -155,17 +154,18 @@ async def event_stream(request):
             if gameId in games and games[gameId].status == STARTED:
                 await bot_player.event_queue.put(games[gameId].game_start)
     else:
-        bot_player = User(request.app, bot=True, username=username)
-        users[bot_player.username] = bot_player
+        bot_player = await users.load(username)
+        if bot_player is None:
+            bot_player = User(request.app, bot=True, username=username)
+            users[bot_player.username] = bot_player
 
-        doc = await db.user.find_one({"_id": username})
-        if doc is None:
             result = await db.user.insert_one(
                 {
                     "_id": username,
                     "title": "BOT",
                 }
             )
+            request.app["titles"][username] = "BOT"
             print("db insert user result %s" % repr(result.inserted_id))
 
     bot_player.online = True
@@ -176,7 +176,7 @@ async def event_stream(request):
 
     # inform others
     # TODO: do we need this at all?
-    await lobby_broadcast(sockets, get_seeks(seeks))
+    request.app["seek_feed"].changed()
 
     # send "challenge" and "gameStart" events from event_queue to the BOT
     while bot_player.online:
@@ -299,7 +299,7 @@ async def bot_abort(request):
         await opp_player.game_queues[gameId].put(game.game_end)
     else:
         opp_ws = users[opp_name].game_sockets[gameId]
-        await opp_ws.send_json(response)
+        await send_json(opp_ws, response)
 
     await round_broadcast(game, response)
 
@@ -339,7 +339,7 @@ async def bot_analysis(request):
         ceval = json.loads(data["ceval"])
         print(ply, ceval)
         if "score" in ceval:
-            game.steps[int(ply)]["eval"] = ceval["score"]
+            game.steps.annotate(int(ply), "eval", ceval["score"])
 
         user_ws = users[username].game_sockets[gameId]
         response = {
@@ -348,7 +348,7 @@ async def bot_analysis(request):
             "room": "spectator",
             "message": ply + " " + json.dumps(ceval),
         }
-        await user_ws.send_json(response)
+        await send_json(user_ws, response)
 
         response = {
             "type": "analysis",
@@ -356,7 +356,7 @@ async def bot_analysis(request):
             "color": data["color"],
             "ceval": ceval,
         }
-        await user_ws.send_json(response)
+        await send_json(user_ws, response)
 
     return web.json_response({"ok": True})
 
@@ -385,6 +385,6 @@ async def bot_chat(request):
             "room": data["room"],
             "message": data["text"],
         }
-        await opp_ws.send_json(response)
+        await send_json(opp_ws, response)
 
     return web.json_response({"ok": True})
@@ -1,15 +1,173 @@
+import asyncio
 import json
 import logging
+from time import monotonic
+from typing import Any, Dict
+
+try:
+    import orjson
+except ImportError:
+    orjson = None  # type: ignore[assignment]
 
 log = logging.getLogger(__name__)
 
+# Clients not reading a message within SEND_TIMEOUT secs are disconnected,
+# so they can't fill server memory with unsent data
+SEND_TIMEOUT = 10
+
+# Messages waiting for a client, one falling further behind is disconnected
+SEND_QUEUE_SIZE = 100
+
+
+class BroadcastStats:
+    """Fan-out metrics, pending is the number of messages waiting in send queues"""
+
+    __slots__ = "messages", "sends", "pending", "max_pending", "slow_consumers", "max_duration"
+
+    def __init__(self):
+        self.messages = 0
+        self.sends = 0
+        self.pending = 0
+        self.max_pending = 0
+        self.slow_consumers = 0
+        self.max_duration = 0.0
+
+    def as_dict(self):
+        return {slot: getattr(self, slot) for slot in self.__slots__}
+
+
+broadcast_stats = BroadcastStats()
+
+
+def json_dumps(response):
+    """Encode a message once for all of its recipients"""
+    if orjson is not None:
+        try:
+            return orjson.dumps(response, option=orjson.OPT_NON_STR_KEYS).decode()
+        except TypeError:
+            # e.g. namedtuples, let json decide
+            pass
+    return json.dumps(response)
+
+
+class SocketWriter:
+    """Bounded send queue of a websocket written by its own task while it has messages.
+    Broadcasts only put the text into the queue, so they never wait for a client."""
+
+    def __init__(self, ws):
+        self.ws = ws
+        self.queue = asyncio.Queue(SEND_QUEUE_SIZE)
+        self.task = None
+        self.slow = False
+
+    def put(self, text):
+        if self.slow:
+            return
+        try:
+            self.queue.put_nowait(text)
+        except asyncio.QueueFull:
+            # the writer task closes the socket after its current send
+            self.set_slow()
+            return
+
+        stats = broadcast_stats
+        stats.pending += 1
+        stats.max_pending = max(stats.max_pending, stats.pending)
+        if self.task is None:
+            self.task = asyncio.create_task(self.write())
+
+    def set_slow(self):
+        if not self.slow:
+            self.slow = True
+            broadcast_stats.slow_consumers += 1
+            log.warning("Closing slow websocket %s", id(self.ws))
+
+    def send_timeout(self):
+        self.set_slow()
+        self.task.cancel()
+
+    async def write(self):
+        stats = broadcast_stats
+        ws = self.ws
+        loop = asyncio.get_running_loop()
+        try:
+            while not (self.queue.empty() or self.slow):
+                text = self.queue.get_nowait()
+                stats.pending -= 1
+                # not wait_for(), its extra task would let later messages overtake this one
+                timer = loop.call_later(SEND_TIMEOUT, self.send_timeout)
+                try:
+                    await ws.send_str(text)
+                    stats.sends += 1
+                except ConnectionResetError:
+                    break
+                except asyncio.CancelledError:
+                    if not self.slow:
+                        raise
+                finally:
+                    timer.cancel()
+
+            if self.slow:
+                await ws.close()
+        finally:
+            stats.pending -= self.queue.qsize()
+            del socket_writers[ws]
+
+
+# {websocket: SocketWriter} of the sockets having unsent messages
+socket_writers: Dict[Any, SocketWriter] = {}
+
+
+def queue_text(ws, text):
+    """Put text into the send queue of ws, True when a new writer was started"""
+    writer = socket_writers.get(ws)
+    new_writer = writer is None
+    if new_writer:
+        writer = socket_writers[ws] = SocketWriter(ws)
+    writer.put(text)
+    return new_writer
+
+
+async def fan_out(sockets, text):
+    """Queue the same text to all sockets, a slow client delays nobody else"""
+    start = monotonic()
+    new_writers = False
+    for ws in sockets:
+        if ws.closed:
+            continue
+        new_writers |= queue_text(ws, text)
+    broadcast_stats.messages += 1
+    broadcast_stats.max_duration = max(broadcast_stats.max_duration, monotonic() - start)
+    if new_writers:
+        # let the new writers send before the caller's own messages to the same sockets
+        await asyncio.sleep(0)
+
+
+async def send_str(ws, text):
+    """Send text to one socket behind the broadcasts already queued to it,
+    writing it directly could overtake them"""
+    if ws.closed:
+        return
+    if queue_text(ws, text):
+        await asyncio.sleep(0)
+
+
+async def send_json(ws, response):
+    await send_str(ws, json_dumps(response))
+
+
+async def flush_writers():
+    """Wait until the queued messages are sent, e.g. before closing the sockets"""
+    tasks = [writer.task for writer in list(socket_writers.values()) if writer.task is not None]
+    await asyncio.gather(*tasks, return_exceptions=True)
+
 
 async def discord_message(app, msg_type, msg):
     """Send msg to discord-relay BOT"""
     try:
         lobby_sockets = app["lobbysockets"]
         for dr_ws in lobby_sockets["Discord-Relay"]:
-            await dr_ws.send_json({"type": msg_type, "message": msg})
+            await send_json(dr_ws, {"type": msg_type, "message": msg})
             break
     except (KeyError, ConnectionResetError):
         # BOT disconnected
@@ -26,40 +184,28 @@ async def broadcast_streams(app):
 
 
 async def lobby_broadcast(sockets, response):
-    for ws_set in sockets.values():
-        for ws in ws_set:
-            try:
-                await ws.send_json(response)
-            except ConnectionResetError:
-                pass
+    await fan_out([ws for ws_set in sockets.values() for ws in ws_set], json_dumps(response))
 
 
 async def round_broadcast(game, response, full=False, channels=None):
-    if game.spectators:
-        for spectator in game.spectators:
-            try:
-                if game.id in spectator.game_sockets:
-                    await spectator.game_sockets[game.id].send_json(response)
-            except (KeyError, ConnectionResetError):
-                # spectator was removed from users
-                pass
+    text = json_dumps(response)
+    sockets = [
+        spectator.game_sockets[game.id]
+        for spectator in game.spectators
+        if game.id in spectator.game_sockets
+    ]
 
     if full:
-        if not game.wplayer.bot:
-            try:
-                wplayer_ws = game.wplayer.game_sockets[game.id]
-                await wplayer_ws.send_json(response)
-            except (KeyError, AttributeError, ConnectionResetError):
-                pass
-
-        if not game.bplayer.bot:
-            try:
-                bplayer_ws = game.bplayer.game_sockets[game.id]
-                await bplayer_ws.send_json(response)
-            except (KeyError, AttributeError, ConnectionResetError):
-                pass
+        for player in (game.wplayer, game.bplayer):
+            if not player.bot:
+                try:
+                    sockets.append(player.game_sockets[game.id])
+                except (KeyError, AttributeError):
+                    pass
+
+    await fan_out(sockets, text)
 
     # Put response data to sse subscribers queue
     if channels is not None:
         for queue in channels:
-            await queue.put(json.dumps(response))
+            await queue.put(text)
@@ -10,6 +10,12 @@ log = logging.getLogger(__name__)
 ESTIMATE_MOVES = 40
 
 
+def estimate_game_time(base, inc):
+    """Estimated game duration in seconds for base minutes + inc seconds"""
+    # TODO: calculate with byoyomi
+    return (60 * base) + (ESTIMATE_MOVES * inc)
+
+
 class Clock:
     """Check game start and abandoned games time out"""
 
@@ -41,7 +47,7 @@ class Clock:
                 # Rated games have their first move time set
                 self.secs = self.time_for_first_move
             else:
-                self.secs = self.game.ply_clocks[self.ply][
+                self.secs = self.game.steps.clocks(self.ply)[
                     "white" if self.color == WHITE else "black"
                 ]
         self.running = True
@@ -79,8 +85,7 @@ class Clock:
 
     @property
     def estimate_game_time(self):
-        # TODO: calculate with byoyomi
-        return (60 * self.game.base) + (ESTIMATE_MOVES * self.game.inc)
+        return estimate_game_time(self.game.base, self.game.inc)
 
     @property
     def time_for_first_move(self):
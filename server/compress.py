@@ -1,8 +1,10 @@
 from itertools import product
 
 """
-We use the simplest compression method for moves here: 2 byte sqare to 1 byte ascii.
-For better result consider compressing moves using indexes in valid move lists.
+Game documents saved before the "mv" field was introduced store moves with the simplest
+compression method: 2 byte sqare to 1 byte ascii.
+Newer ones ("mv": INDEX_ENCODING) store every move as a single character, the index of the move
+in the sorted legal move list of the position it was played in.
 For more sophisticated encoding consider using lichess method described at:
 https://lichess.org/blog/Wqa7GiAAAOIpBLoY/developer-update-275-improved-game-compression
 """
@@ -110,3 +112,33 @@ def decode_moves(moves, variant):
         C2M[ord(move[0])] + C2M[ord(move[1])] + (move[2] if len(move) == 3 else "")
         for move in moves
     ]
+
+
+# Version marker saved in the "mv" field of index encoded game documents
+INDEX_ENCODING = 1
+
+
+def encode_move_indexes(indexes):
+    # most indexes are below 128 so they take one byte in UTF-8 encoded BSON strings
+    return "".join(map(chr, indexes))
+
+
+def iter_move_indexes(moves, board):
+    """Decode index encoded moves one by one.
+    The caller has to push every move to the board before asking for the next one.
+    Decoding stops at the first index not valid in the current position."""
+    for code in moves:
+        legal_moves = board.sorted_legal_moves()
+        index = ord(code)
+        if index >= len(legal_moves):
+            return
+        yield legal_moves[index]
+
+
+def decode_move_indexes(moves, board):
+    """Decode index encoded moves replaying them on the board"""
+    result = []
+    for move in iter_move_indexes(moves, board):
+        board.push(move)
+        result.append(move)
+    return result
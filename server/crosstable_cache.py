@@ -0,0 +1,74 @@
+from collections import OrderedDict
+
+# Most player pair crosstables we keep in memory
+CROSSTABLE_CACHE_SIZE = 10000
+
+
+def crosstable_id(username1, username2):
+    if username1 < username2:
+        return username1 + "/" + username2
+    return username2 + "/" + username1
+
+
+def empty_crosstable(ct_id):
+    return {"_id": ct_id, "s1": 0, "s2": 0, "r": []}
+
+
+class CrosstableCache:
+    """LRU cache of player pair crosstables loaded from the database on demand"""
+
+    def __init__(self, db, max_size=CROSSTABLE_CACHE_SIZE):
+        self.db = db
+        self.max_size = max_size
+        self.crosstables = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self.crosstables)
+
+    def get(self, ct_id):
+        try:
+            crosstable = self.crosstables[ct_id]
+        except KeyError:
+            return None
+        self.crosstables.move_to_end(ct_id)
+        return crosstable
+
+    def put(self, crosstable):
+        self.crosstables[crosstable["_id"]] = crosstable
+        self.crosstables.move_to_end(crosstable["_id"])
+
+        while len(self.crosstables) > self.max_size:
+            self.crosstables.popitem(last=False)
+            self.evictions += 1
+
+    async def load(self, ct_id):
+        crosstable = self.get(ct_id)
+        if crosstable is not None:
+            self.hits += 1
+            return crosstable
+
+        self.misses += 1
+        doc = None
+        if self.db is not None:
+            doc = await self.db.crosstable.find_one({"_id": ct_id}, {"seq": 0})
+
+        # another game of the same pair may have loaded it in the meantime
+        crosstable = self.get(ct_id)
+        if crosstable is None:
+            crosstable = doc if doc is not None else empty_crosstable(ct_id)
+            self.put(crosstable)
+        return crosstable
+
+    def clear(self):
+        self.crosstables.clear()
+
+    def as_dict(self):
+        return {
+            "crosstables": len(self.crosstables),
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+        }
@@ -0,0 +1,81 @@
+import asyncio
+import logging
+from collections import defaultdict
+from itertools import islice
+
+from pymongo import UpdateOne
+
+log = logging.getLogger(__name__)
+
+# Wait this long (in seconds) for more updates before writing them
+FLUSH_DELAY = 0.5
+
+# Max number of documents written in one round
+BATCH_SIZE = 500
+
+
+class DbWriter:
+    """Write-behind queue of $set updates.
+    Updates of the same document are merged while they wait, so a document is written
+    only once per flush. Updates are written with one bulk_write() per collection."""
+
+    def __init__(self, db, delay=FLUSH_DELAY, batch_size=BATCH_SIZE):
+        self.db = db
+        self.delay = delay
+        self.batch_size = batch_size
+        # {(collection name, _id): [fields to $set, upsert]}
+        self.pending = {}
+        self.flush_task = None
+        # set to skip the rest of the flush delay
+        self.flush_now = asyncio.Event()
+
+    def update(self, collection, doc_id, new_data, upsert=False):
+        if self.db is None:
+            return
+
+        key = (collection, doc_id)
+        if key in self.pending:
+            entry = self.pending[key]
+            entry[0].update(new_data)
+            entry[1] = entry[1] or upsert
+        else:
+            self.pending[key] = [dict(new_data), upsert]
+
+        if self.flush_task is None or self.flush_task.done():
+            self.flush_task = asyncio.create_task(self.flush_later())
+        elif len(self.pending) >= self.batch_size:
+            self.flush_now.set()
+
+    async def flush_later(self):
+        try:
+            await asyncio.wait_for(self.flush_now.wait(), self.delay)
+        except asyncio.TimeoutError:
+            pass
+        self.flush_now.clear()
+        await self.flush()
+
+    async def flush(self):
+        while self.pending:
+            keys = list(islice(self.pending, self.batch_size))
+            requests = defaultdict(list)
+            for key in keys:
+                collection, doc_id = key
+                new_data, upsert = self.pending.pop(key)
+                requests[collection].append(
+                    UpdateOne({"_id": doc_id}, {"$set": new_data}, upsert=upsert)
+                )
+
+            for collection, collection_requests in requests.items():
+                try:
+                    await self.db[collection].bulk_write(collection_requests, ordered=False)
+                except Exception:
+                    log.exception(
+                        "Failed to write %s %s documents", len(collection_requests), collection
+                    )
+
+    async def drain(self):
+        """Write out everything still waiting, used on shutdown"""
+        if self.flush_task is not None:
+            self.flush_now.set()
+            await self.flush_task
+        await self.flush()
@@ -0,0 +1,243 @@
+"""Swiss pairing following the FIDE Dutch system (C.04.3)
+
+Players are grouped into score brackets paired from the top. In every bracket
+the upper half (S1) is paired with the lower half (S2), trying S2 transpositions
+and S1-S2 exchanges in Dutch order until the pairing satisfies the criteria.
+Criteria are relaxed step by step: color preferences first, then the number of
+downfloaters. When the lowest bracket can't be paired it is collapsed into the
+one above it. Colors are allocated with the FIDE E rules.
+"""
+import logging
+from itertools import groupby
+
+log = logging.getLogger(__name__)
+
+WHITE, BLACK = "w", "b"
+OTHER = {WHITE: BLACK, BLACK: WHITE}
+
+# Color preference strengths
+NONE, MILD, STRONG, ABSOLUTE = range(4)
+
+# Pairing criteria levels, every level allows more than the previous one
+NO_COLOR_CONFLICT, MILD_COLOR_CONFLICT, ANY_COLOR_CONFLICT, REMATCH = range(4)
+
+# Candidate pairings tried in one bracket before relaxing the criteria
+SEARCH_LIMIT = 20000
+
+FLOAT = object()
+
+
+class SwissPlayer:
+    """Pairing data of a player: rank is the pairing number (1 for the highest rated),
+    colors is the list of colors played ("w"/"b") in round order"""
+
+    __slots__ = ("id", "rank", "score", "colors", "opponents", "had_bye", "preference")
+
+    def __init__(self, _id, rank, score=0, colors=(), opponents=(), had_bye=False):
+        self.id = _id
+        self.rank = rank
+        self.score = score
+        self.colors = list(colors)
+        self.opponents = set(opponents)
+        self.had_bye = had_bye
+        self.preference = color_preference(self.colors)
+
+    def __repr__(self):
+        return "%s(%s)" % (self.id, self.score)
+
+    @property
+    def color_diff(self):
+        return self.colors.count(WHITE) - self.colors.count(BLACK)
+
+
+def color_preference(colors):
+    """(color, strength) preference of a player with the given color history"""
+    diff = colors.count(WHITE) - colors.count(BLACK)
+    if diff < -1 or colors[-2:] == [BLACK, BLACK]:
+        return WHITE, ABSOLUTE
+    if diff > 1 or colors[-2:] == [WHITE, WHITE]:
+        return BLACK, ABSOLUTE
+    if diff == -1:
+        return WHITE, STRONG
+    if diff == 1:
+        return BLACK, STRONG
+    if colors:
+        return OTHER[colors[-1]], MILD
+    return None, NONE
+
+
+def compatible(x, y, level):
+    if level == REMATCH:
+        return True
+    if y.id in x.opponents:
+        return False
+    xcolor, xstrength = x.preference
+    if xcolor is None or xcolor != y.preference[0]:
+        return True
+    ystrength = y.preference[1]
+    if xstrength == ABSOLUTE and ystrength == ABSOLUTE:
+        return False
+    if level == NO_COLOR_CONFLICT:
+        return False
+    if level == MILD_COLOR_CONFLICT:
+        return min(xstrength, ystrength) == MILD
+    return True
+
+
+def colors_possible(players, level, nb_floats):
+    """Quick check that enough players are left for the ones with a color preference
+    that can't be paired with each other on this level"""
+    if level == REMATCH:
+        return True
+    min_strength = {NO_COLOR_CONFLICT: MILD, MILD_COLOR_CONFLICT: STRONG}.get(level, ABSOLUTE)
+    for color in (WHITE, BLACK):
+        nb = sum(1 for p in players if p.preference[0] == color and p.preference[1] >= min_strength)
+        if nb > (len(players) + nb_floats) // 2:
+            return False
+    return True
+
+
+def allocate_colors(x, y):
+    """Return (white, black) of the x-y pair, x is the higher ranked player"""
+    xcolor, xstrength = x.preference
+    ycolor, ystrength = y.preference
+
+    if xcolor is None and ycolor is None:
+        # E.5 higher ranked player with odd pairing number gets the initial color (white)
+        xcolor = WHITE if x.rank % 2 == 1 else BLACK
+    elif ycolor is None or (xcolor is not None and xcolor != ycolor):
+        pass
+    elif xcolor is None:
+        xcolor = OTHER[ycolor]
+    elif xstrength != ystrength:
+        # E.2 grant the stronger preference
+        if ystrength > xstrength:
+            xcolor = OTHER[ycolor]
+    elif xstrength == ABSOLUTE and abs(y.color_diff) > abs(x.color_diff):
+        # E.3 grant the wider color difference
+        xcolor = OTHER[ycolor]
+    else:
+        # E.4 alternate to the most recent round they had different colors
+        for xc, yc in zip(reversed(x.colors), reversed(y.colors)):
+            if xc != yc:
+                xcolor = OTHER[xc]
+                break
+        # E.5 otherwise the higher ranked player gets the preference
+
+    return (x, y) if xcolor == WHITE else (y, x)
+
+
+def pair_bracket(bracket, nb_mdps, level, nb_floats):
+    """Pair a bracket (players in Dutch order, downfloaters from above first) leaving
+    at most nb_floats players unpaired. Return (pairs, floaters) or None."""
+    if not bracket:
+        return [], []
+
+    mdps = set(bracket[:nb_mdps])
+    pairs = []
+    floaters = []
+    floats_left = nb_floats
+
+    def new_frame(remaining, s1):
+        x, rest = remaining[0], remaining[1:]
+        if x in mdps:
+            # downfloaters are paired with the residents from the top
+            candidates = [y for y in rest if y not in mdps] + [y for y in rest if y in mdps]
+        else:
+            if s1 is None:
+                s1 = set(remaining[: (len(remaining) - floats_left) // 2])
+            # S2 in transposition order, then S1 players to exchange from the bottom
+            candidates = [y for y in rest if y not in s1] + [y for y in reversed(rest) if y in s1]
+        return [x, rest, iter(candidates), s1, None]
+
+    frames = [new_frame(bracket, None)]
+    steps = 0
+    while frames:
+        frame = frames[-1]
+        x, rest, candidates, s1, action = frame
+
+        if action is FLOAT:
+            floaters.pop()
+            floats_left += 1
+            frames.pop()
+            continue
+        elif action is not None:
+            pairs.pop()
+            frame[4] = None
+
+        steps += 1
+        if steps > SEARCH_LIMIT:
+            return None
+
+        y = next((y for y in candidates if compatible(x, y, level)), None)
+        if y is not None:
+            frame[4] = y
+            pairs.append((x, y))
+            remaining = [z for z in rest if z is not y]
+        elif floats_left > 0:
+            frame[4] = FLOAT
+            floaters.append(x)
+            floats_left -= 1
+            remaining = rest
+        else:
+            frames.pop()
+            continue
+
+        if not remaining:
+            return pairs, floaters
+        frames.append(new_frame(remaining, s1))
+
+    return None
+
+
+def pair_brackets(brackets, max_level):
+    """Pair the score brackets from the top, the last one has to be paired completely.
+    Return the pairs or None if the last bracket can't be paired."""
+    pairs = []
+    floaters = []
+    for i, bracket in enumerate(brackets):
+        last = i == len(brackets) - 1
+        players = floaters + bracket
+        min_floats = 0 if last else len(players) % 2
+        max_floats = 0 if last else len(players)
+        result = None
+        for nb_floats in range(min_floats, max_floats + 1, 2):
+            for level in range(max_level + 1):
+                if not colors_possible(players, level, nb_floats):
+                    continue
+                result = pair_bracket(players, len(floaters), level, nb_floats)
+                if result is not None:
+                    break
+            if result is not None:
+                break
+        if result is None:
+            return None
+        bracket_pairs, floaters = result
+        pairs += bracket_pairs
+    return pairs
+
+
+def dutch_pairing(players):
+    """Pair a round, return ([(white, black), ...], bye player or None)"""
+    players = sorted(players, key=lambda p: (-p.score, p.rank))
+
+    bye = None
+    if len(players) % 2 == 1:
+        # C.2 the lowest ranked player of the lowest score group without a bye so far
+        bye = next((p for p in reversed(players) if not p.had_bye), players[-1])
+        players.remove(bye)
+
+    brackets = [list(group) for score, group in groupby(players, key=lambda p: p.score)]
+
+    pairs = None
+    while pairs is None and brackets:
+        pairs = pair_brackets(brackets, ANY_COLOR_CONFLICT)
+        if pairs is None:
+            if len(brackets) == 1:
+                log.warning("Swiss pairing needs rematches for %s players", len(players))
+                pairs = pair_brackets(brackets, REMATCH)
+                break
+            # collapse the lowest bracket into the one above
+            brackets[-2:] = [brackets[-2] + brackets[-1]]
+
+    return [allocate_colors(x, y) for x, y in (pairs or [])], bye
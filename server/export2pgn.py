@@ -1,63 +1,233 @@
+import argparse
 import asyncio
 import bz2
+import gzip
+import json
 import logging
+import os
+import shutil
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from datetime import datetime, timezone
 
 from motor import motor_asyncio as ma
 from settings import MONGO_HOST, MONGO_DB_NAME
-from utils import pgn
-from compress import C2V
+from utils import pgn_batch, PGN_PROJECTION
+from compress import V2C
+from newid import ID_CHARS
 
 log = logging.getLogger(__name__)
 
-YEAR = 2021
-MONTHS = (6, 7, 8, 9, 10, 11)
+MANIFEST = "manifest.json"
 
+# {compression: (open function, file extension)}
+COMPRESSORS = {
+    "bz2": (bz2.open, ".pgn.bz2"),
+    "gzip": (gzip.open, ".pgn.gz"),
+}
 
-async def main():
+# Number of games converted and written at once
+WRITE_CHUNK = 100
+
+
+def months(first, last):
+    """(year, month) pairs from first to last inclusive, both given as "YYYY-MM" """
+    year, month = map(int, first.split("-"))
+    last_year, last_month = map(int, last.split("-"))
+    result = []
+    while (year, month) <= (last_year, last_month):
+        result.append((year, month))
+        year, month = (year + 1, 1) if month == 12 else (year, month + 1)
+    return result
+
+
+def id_ranges(parts):
+    """Split the game _id space into parts (first inclusive, last exclusive) ranges.
+    Game ids are random, so the ranges hold about the same number of games."""
+    chars = sorted(ID_CHARS)
+    bounds = [None] + [chars[len(chars) * i // parts] for i in range(1, parts)] + [None]
+    return list(zip(bounds, bounds[1:]))
+
+
+def archive_name(year, month, variants, compression):
+    variant_part = "_" + "_".join(sorted(variants)) if variants else ""
+    return "pychess_%04d-%02d%s%s" % (year, month, variant_part, COMPRESSORS[compression][1])
+
+
+def part_name(name, part, parts):
+    return "%s.%sof%s" % (name, part + 1, parts)
+
+
+async def export_games(year, month, variants, id_range, path, compression):
     client = ma.AsyncIOMotorClient(MONGO_HOST)
     db = client[MONGO_DB_NAME]
 
-    for month in MONTHS:
-        yearmonth = "%s%02d" % (YEAR, month)
+    start = datetime(year, month, 1, tzinfo=timezone.utc)
+    end = datetime(year + month // 12, month % 12 + 1, 1, tzinfo=timezone.utc)
+    filter_cond = {"d": {"$gte": start, "$lt": end}}
+    if variants:
+        filter_cond["v"] = {"$in": [V2C[variant] for variant in variants]}
+    first_id, last_id = id_range
+    if first_id is not None or last_id is not None:
+        filter_cond["_id"] = {}
+        if first_id is not None:
+            filter_cond["_id"]["$gte"] = first_id
+        if last_id is not None:
+            filter_cond["_id"]["$lt"] = last_id
+
+    def write_chunk(f, docs):
+        texts = pgn_batch(docs, failed)
+        if texts:
+            f.write("\n".join(texts) + "\n")
+        return len(texts)
+
+    games = 0
+    failed = []
+    docs = []
+    open_archive = COMPRESSORS[compression][0]
+    # Written to a .part file first, so an interrupted run never leaves a complete looking one
+    with open_archive(path + ".part", "wt") as f:
+        async for doc in db.game.find(filter_cond, PGN_PROJECTION).sort("_id"):
+            docs.append(doc)
+            if len(docs) == WRITE_CHUNK:
+                games += write_chunk(f, docs)
+                docs = []
+        games += write_chunk(f, docs)
+
+    os.replace(path + ".part", path)
+    client.close()
+    return games, failed
+
+
+def export_part(year, month, variants, id_range, path, compression):
+    """Process pool entry point, every worker has its own db client and event loop"""
+    return asyncio.run(export_games(year, month, variants, id_range, path, compression))
 
-        game_list = []
-        game_counter = 0
-        failed = 0
-        cursor = None
 
-        print("---", yearmonth[:4], yearmonth[4:])
-        filter_cond = {
-            "$and": [
-                {"$expr": {"$eq": [{"$year": "$d"}, int(yearmonth[:4])]}},
-                {"$expr": {"$eq": [{"$month": "$d"}, int(yearmonth[4:])]}},
-            ]
+def read_manifest(out_dir):
+    try:
+        with open(os.path.join(out_dir, MANIFEST)) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+
+
+def write_manifest(out_dir, manifest):
+    path = os.path.join(out_dir, MANIFEST)
+    with open(path + ".part", "w") as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+    os.replace(path + ".part", path)
+
+
+def merge_parts(out_dir, name, parts, manifest):
+    """Concatenate the finished parts of a month into its archive.
+    Both bz2 and gzip readers handle concatenated streams."""
+    part_names = [part_name(name, part, parts) for part in range(parts)]
+    path = os.path.join(out_dir, name)
+    with open(path + ".part", "wb") as archive:
+        for part in part_names:
+            with open(os.path.join(out_dir, part), "rb") as f:
+                shutil.copyfileobj(f, archive)
+    os.replace(path + ".part", path)
+
+    entries = [manifest.pop(part) for part in part_names]
+    manifest[name] = {
+        "games": sum(entry["games"] for entry in entries),
+        "failed": sum(entry["failed"] for entry in entries),
+        "failed_games": [game_id for entry in entries for game_id in entry["failed_games"]],
+    }
+    write_manifest(out_dir, manifest)
+    for part in part_names:
+        os.remove(os.path.join(out_dir, part))
+
+
+def export_archives(
+    first, last, variants=(), out_dir=".", workers=None, parts=1, compression="bz2"
+):
+    """Export the games of every month from first to last into its own compressed PGN file.
+    Months are split into parts by game _id and the parts run in parallel in worker
+    processes. Finished parts and archives are recorded in the manifest and skipped
+    later, so an interrupted export can be simply restarted."""
+    os.makedirs(out_dir, exist_ok=True)
+    manifest = read_manifest(out_dir)
+
+    def done(name):
+        return name in manifest and os.path.exists(os.path.join(out_dir, name))
+
+    names = []
+    todo = []
+    for year, month in months(first, last):
+        name = archive_name(year, month, variants, compression)
+        if done(name):
+            log.info("%s is already done", name)
+            continue
+        names.append(name)
+        for part, id_range in enumerate(id_ranges(parts)):
+            if not done(part_name(name, part, parts)):
+                todo.append((year, month, id_range, part_name(name, part, parts)))
+
+    with ProcessPoolExecutor(workers) as pool:
+        futures = {
+            pool.submit(
+                export_part,
+                year,
+                month,
+                variants,
+                id_range,
+                os.path.join(out_dir, name),
+                compression,
+            ): name
+            for year, month, id_range, name in todo
         }
-        cursor = db.game.find(filter_cond)
-
-        if cursor is not None:
-            async for doc in cursor:
-                try:
-                    # print(game_counter)
-                    # log.info("%s %s %s" % (doc["d"].strftime("%Y.%m.%d"), doc["_id"], C2V[doc["v"]]))
-                    pgn_text = pgn(doc)
-                    if pgn_text is not None:
-                        game_list.append(pgn_text)
-                    game_counter += 1
-                except Exception:
-                    failed += 1
-                    log.error(
-                        "Failed to load game %s %s %s (early games may contain invalid moves)",
-                        doc["_id"],
-                        C2V[doc["v"]],
-                        doc["d"].strftime("%Y.%m.%d"),
-                    )
-                    continue
-            print("failed/all:", failed, game_counter)
-        pgn_text = "\n".join(game_list)
-
-        with bz2.open(yearmonth + ".pgn", "wt") as f:
-            f.write(pgn_text)
+        for future in as_completed(futures):
+            name = futures[future]
+            try:
+                games, failed = future.result()
+            except Exception:
+                log.exception("Failed to export %s", name)
+                continue
+            manifest[name] = {"games": games, "failed": len(failed), "failed_games": failed}
+            write_manifest(out_dir, manifest)
+            log.info("%s games: %s failed: %s", name, games, len(failed))
+
+    for name in names:
+        if all(done(part_name(name, part, parts)) for part in range(parts)):
+            merge_parts(out_dir, name, parts, manifest)
+
+    return manifest
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Export monthly PGN archives of PyChess games")
+    parser.add_argument("first", help="First month to export (YYYY-MM)")
+    parser.add_argument("last", nargs="?", help="Last month to export (YYYY-MM), default: first")
+    parser.add_argument(
+        "--variant",
+        action="append",
+        default=[],
+        choices=sorted(V2C),
+        help="Export only games of this variant, can be repeated",
+    )
+    parser.add_argument("--out", default=".", help="Output directory")
+    parser.add_argument(
+        "--workers", type=int, default=None, help="Number of processes, default: CPU count"
+    )
+    parser.add_argument(
+        "--parts", type=int, default=1, help="Split every month into this many parallel jobs"
+    )
+    parser.add_argument("--compression", default="bz2", choices=sorted(COMPRESSORS))
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    export_archives(
+        args.first,
+        args.last or args.first,
+        args.variant,
+        args.out,
+        args.workers,
+        args.parts,
+        args.compression,
+    )
 
 
 if __name__ == "__main__":
-    asyncio.run(main())
+    main()
@@ -2,22 +2,75 @@
 import logging
 import re
 import random
+from collections import namedtuple
+from typing import Dict
 
 try:
     import pyffish as sf
 except ImportError:
     print("No pyffish module installed!")
 
-from const import CATEGORIES
+from const import CATEGORIES, VARIANTS
 
 WHITE, BLACK = False, True
 FILES = ["a", "b", "c", "d", "e", "f", "g", "h", "i", "j"]
 
 STANDARD_FEN = "rnbqkbnr/pppppppp/8/8/8/8/PPPPPPPP/RNBQKBNR w KQkq - 0 1"
 
+# Counting rule state doesn't survive a FEN round trip in these variants,
+# so their game end checks still replay the whole move history
+COUNTING_VARIANTS = ("makruk", "makpong", "cambodian", "sittuyin", "asean")
+
+# Fairy-Stockfish looks back a few plies before the oldest position it compares
+# (bikjang, double passing, janggi move repetition rule)
+HISTORY_MARGIN = 4
+
+# Shortest n-move rule (in plies) of our variants
+MIN_N_MOVE_RULE = 100
+
+# Everything Game.update_status() needs to know about the position after a move
+AfterMove = namedtuple(
+    "AfterMove", "san, fen, legal_moves, check, insufficient, immediate_end, optional_end, result"
+)
+
+# Engine facts of a variant that never change, see variant_info()
+VariantInfo = namedtuple("VariantInfo", "start_fen, notation")
+VARIANT_INFO: Dict[str, VariantInfo] = {}
+
 log = logging.getLogger(__name__)
 
 
+def variant_info(variant):
+    """Start FEN and move notation of a variant (without 960 suffix)"""
+    info = VARIANT_INFO.get(variant)
+    if info is None:
+        if variant == "janggi":
+            notation = sf.NOTATION_JANGGI
+        elif variant in CATEGORIES["shogi"]:
+            notation = sf.NOTATION_SHOGI_HODGES_NUMBER
+        elif variant in ("xiangqi", "minixiangqi"):
+            # XIANGQI_WXF can't handle Manchu banner!
+            notation = sf.NOTATION_XIANGQI_WXF
+        else:
+            notation = sf.NOTATION_SAN
+
+        info = VariantInfo(sf.start_fen(variant), notation)
+        VARIANT_INFO[variant] = info
+    return info
+
+
+def load_variant_info():
+    """Fill VARIANT_INFO for all of our variants, call it after variants.ini was loaded"""
+    for variant in VARIANTS:
+        variant_info(variant[:-3] if variant.endswith("960") else variant)
+
+
+def position_key(fen):
+    """Board, pockets and side to move. Equal pyffish positions always have equal keys."""
+    parts = fen.split()
+    return parts[0].replace("~", "") + parts[1]
+
+
 class FairyBoard:
     def __init__(self, variant, initial_fen="", chess960=False, count_started=0, disabled_fen=""):
         self.variant = variant
@@ -34,18 +87,8 @@ class FairyBoard:
         self.fen = self.initial_fen
         self.manual_count = count_started != 0
         self.count_started = count_started
-
-        if self.variant == "janggi":
-            self.notation = sf.NOTATION_JANGGI
-        elif self.variant in CATEGORIES["shogi"]:
-            self.notation = sf.NOTATION_SHOGI_HODGES_NUMBER
-        elif self.variant in (
-            "xiangqi",
-            "minixiangqi",
-        ):  # XIANGQI_WXF can't handle Manchu banner!
-            self.notation = sf.NOTATION_XIANGQI_WXF
-        else:
-            self.notation = sf.NOTATION_SAN
+        self.reset_history()
+        self.notation = variant_info(variant).notation
 
     def start_fen(self, variant, chess960=False, disabled_fen=""):
         if chess960:
@@ -53,12 +96,45 @@ class FairyBoard:
             while new_fen == disabled_fen:
                 new_fen = self.shuffle_start()
             return new_fen
-        return sf.start_fen(variant)
+        return variant_info(variant).start_fen
 
     @property
     def initial_sfen(self):
         return sf.get_fen(self.variant, self.initial_fen, [], False, True)
 
+    def reset_history(self):
+        # fen_history[i] is the FEN after move_stack[:i]
+        self.fen_history = [self.fen]
+        self.first_seen = {position_key(self.fen): 0}
+        self.history_start = 0
+        self.clear_legal_moves()
+
+    def clear_legal_moves(self):
+        # legal moves of the current position are generated on first use
+        self._legal_moves = None
+        self._sorted_legal_moves = None
+        self._legal_move_index = None
+
+    def update_history(self):
+        """Find the oldest ply pyffish may look back to from the current position.
+        Repetition checks can't see past the last irreversible move (in drop variants
+        they can, but only positions equal to the current one matter), so there is
+        no need to replay the game from initial_fen on every query."""
+        self.fen_history.append(self.fen)
+        first = self.first_seen.setdefault(position_key(self.fen), self.ply)
+
+        if self.variant in COUNTING_VARIANTS:
+            return
+
+        rule50 = int(self.fen.split()[-2])
+        self.history_start = max(0, min(first, self.ply - rule50) - HISTORY_MARGIN)
+
+    @property
+    def history(self):
+        """Return (fen, moves) to set up the current position with enough history"""
+        start = self.history_start
+        return self.fen_history[start], self.move_stack[start:]
+
     def push(self, move):
         try:
             self.move_stack.append(move)
@@ -73,6 +149,8 @@ class FairyBoard:
                 self.show_promoted,
                 self.count_started,
             )
+            self.update_history()
+            self.clear_legal_moves()
         except Exception:
             self.move_stack.pop()
             self.ply -= 1
@@ -85,12 +163,67 @@ class FairyBoard:
             )
             raise
 
+    def play(self, move):
+        """Push move and query the new position with as few pyffish calls as possible"""
+        san = self.get_san(move)
+        self.push(move)
+        legal_moves = self.legal_moves()
+        check = self.is_checked()
+
+        immediate_end = optional_end = False
+        result = 0
+        if not legal_moves:
+            immediate_end, result = self.is_immediate_game_end()
+            if not immediate_end:
+                result = self.game_result()
+        elif self.may_end_optionally():
+            optional_end, result = self.is_optional_game_end()
+
+        return AfterMove(
+            san,
+            self.fen,
+            legal_moves,
+            check,
+            self.insufficient_material(),
+            immediate_end,
+            optional_end,
+            result,
+        )
+
+    def may_end_optionally(self):
+        """Without counting rules only repetition and the n-move rule can end the game"""
+        if self.variant in COUNTING_VARIANTS:
+            return True
+        repeated = self.first_seen[position_key(self.fen)] < self.ply
+        return repeated or int(self.fen.split()[-2]) >= MIN_N_MOVE_RULE
+
     def get_san(self, move):
         return sf.get_san(self.variant, self.fen, move, self.chess960, self.notation)
 
     def legal_moves(self):
-        # move legality can depend on history, e.g., passing and bikjang
-        return sf.legal_moves(self.variant, self.initial_fen, self.move_stack, self.chess960)
+        if self._legal_moves is None:
+            # move legality can depend on history, e.g., passing and bikjang
+            fen, moves = self.history
+            self._legal_moves = sf.legal_moves(self.variant, fen, moves, self.chess960)
+        return self._legal_moves
+
+    def sorted_legal_moves(self):
+        # move order of the index based move encoding (see compress.py)
+        if self._sorted_legal_moves is None:
+            self._sorted_legal_moves = sorted(self.legal_moves())
+        return self._sorted_legal_moves
+
+    def move_index(self, move):
+        if self._legal_move_index is None:
+            self._legal_move_index = {m: i for i, m in enumerate(self.sorted_legal_moves())}
+        return self._legal_move_index[move]
+
+    def is_legal(self, move):
+        try:
+            self.move_index(move)
+        except KeyError:
+            return False
+        return True
 
     def is_checked(self):
         return sf.gives_check(self.variant, self.fen, [], self.chess960)
@@ -99,16 +232,16 @@ class FairyBoard:
         return sf.has_insufficient_material(self.variant, self.fen, [], self.chess960)
 
     def is_immediate_game_end(self):
-        immediate_end, result = sf.is_immediate_game_end(
-            self.variant, self.initial_fen, self.move_stack, self.chess960
-        )
+        fen, moves = self.history
+        immediate_end, result = sf.is_immediate_game_end(self.variant, fen, moves, self.chess960)
         return immediate_end, result
 
     def is_optional_game_end(self):
+        fen, moves = self.history
         return sf.is_optional_game_end(
             self.variant,
-            self.initial_fen,
-            self.move_stack,
+            fen,
+            moves,
             self.chess960,
             self.count_started,
         )
@@ -118,7 +251,8 @@ class FairyBoard:
         return optional_end and result == 0
 
     def game_result(self):
-        return sf.game_result(self.variant, self.initial_fen, self.move_stack, self.chess960)
+        fen, moves = self.history
+        return sf.game_result(self.variant, fen, moves, self.chess960)
 
     def print_pos(self):
         print()
@@ -164,6 +298,7 @@ class FairyBoard:
         print("-------new FEN", fen)
         self.initial_fen = fen
         self.fen = self.initial_fen
+        self.reset_history()
 
     def shuffle_start(self):
         """Create random initial position.
@@ -7,6 +7,7 @@ from time import monotonic
 
 from aiohttp import web
 
+from broadcast import send_json
 from const import ANALYSIS
 from utils import load_game, play_move
 from settings import FISHNET_KEYS
@@ -52,9 +53,7 @@ async def get_work(request, data):
             if game is None:
                 return web.Response(status=204)
 
-            for step in game.steps:
-                if "analysis" in step:
-                    del step["analysis"]
+            game.steps.remove_annotations("analysis")
 
             users = request.app["users"]
             if "username" in work:
@@ -65,7 +64,7 @@ async def get_work(request, data):
                     "room": "spectator",
                     "message": "Work for fishnet sent...",
                 }
-                await user_ws.send_json(response)
+                await send_json(user_ws, response)
         else:
             fm[worker].append(
                 "%s %s %s %s for level %s"
@@ -163,40 +162,42 @@ async def fishnet_analysis(request):
         i = length - j - 1
         if analysis is not None:
             try:
-                if "analysis" not in game.steps[i]:
+                if game.steps.annotation(i, "analysis") is None:
                     # TODO: save PV only for inaccuracy, mistake and blunder
                     # see https://github.com/lichess-org/lila/blob/master/modules/analyse/src/main/Advice.scala
-                    game.steps[i]["analysis"] = {
-                        "s": analysis["score"],
-                        "d": analysis["depth"],
-                        "p": analysis["pv"],
-                    }
+                    game.steps.annotate(
+                        i,
+                        "analysis",
+                        {
+                            "s": analysis["score"],
+                            "d": analysis["depth"],
+                            "p": analysis["pv"],
+                        },
+                    )
                 else:
                     continue
             except KeyError:
-                game.steps[i]["analysis"] = {
-                    "s": analysis["score"],
-                }
+                game.steps.annotate(i, "analysis", {"s": analysis["score"]})
 
             ply = str(i)
             # response = {"type": "roundchat", "user": bot_name, "room": "spectator", "message": ply + " " + json.dumps(analysis)}
-            # await user_ws.send_json(response)
+            # await send_json(user_ws, response)
 
             response = {
                 "type": "analysis",
                 "ply": ply,
                 "color": "w" if i % 2 == 0 else "b",
-                "ceval": game.steps[i]["analysis"],
+                "ceval": game.steps.annotation(i, "analysis"),
             }
             try:
-                await user_ws.send_json(response)
+                await send_json(user_ws, response)
             except ConnectionResetError:
                 pass
 
     # remove completed work
     if all(data["analysis"]):
         del request.app["works"][work_id]
-        new_data = {"a": [step["analysis"] for step in game.steps]}
+        new_data = {"a": [game.steps.annotation(i, "analysis") for i in range(len(game.steps))]}
         await request.app["db"].game.find_one_and_update({"_id": game.id}, {"$set": new_data})
 
     return web.Response(status=204)
@@ -1,5 +1,6 @@
 import asyncio
 import collections
+from array import array
 import logging
 from datetime import datetime, timezone
 from time import monotonic
@@ -13,7 +14,7 @@ except ImportError:
 
 from broadcast import lobby_broadcast, round_broadcast
 from clock import Clock
-from compress import encode_moves, R2C
+from compress import encode_moves, encode_move_indexes, INDEX_ENCODING, R2C
 from const import (
     CREATED,
     STARTED,
@@ -36,11 +37,13 @@ from const import (
     MAX_CHAT_LINES,
 )
 from convert import grand2zero, uci2usi, mirror5, mirror9
-from fairy import FairyBoard, BLACK, WHITE
+from crosstable_cache import empty_crosstable
+from fairy import FairyBoard, BLACK, WHITE, variant_info
 from glicko2.glicko2 import gl2
 from draw import reject_draw
 from settings import URI
 from spectators import spectators
+from steps import Steps
 
 log = logging.getLogger(__name__)
 
@@ -119,9 +122,8 @@ class Game:
                 self.s1player = self.bplayer.username
                 self.s2player = self.wplayer.username
             self.ct_id = self.s1player + "/" + self.s2player
-            self.crosstable = self.db_crosstable.get(
-                self.ct_id, {"_id": self.ct_id, "s1": 0, "s2": 0, "r": []}
-            )
+            # the stored one is fetched by load_crosstable()
+            self.crosstable = self.db_crosstable.get(self.ct_id) or empty_crosstable(self.ct_id)
 
         self.spectators = set()
         self.draw_offers = set()
@@ -129,12 +131,6 @@ class Game:
         self.messages = collections.deque([], MAX_CHAT_LINES)
         self.date = datetime.now(timezone.utc)
 
-        self.ply_clocks = [
-            {
-                "black": (base * 1000 * 60) + 0 if base > 0 else inc * 1000,
-                "white": (base * 1000 * 60) + 0 if base > 0 else inc * 1000,
-            }
-        ]
         self.lastmove = None
         self.check = False
         self.status = CREATED
@@ -222,20 +218,24 @@ class Game:
             self.wplayer.username,
             self.bplayer.username,
         )
-        self.legal_moves = self.board.legal_moves()
-
         if self.board.move_stack:
             self.check = self.board.is_checked()
 
-        self.steps = [
-            {
-                "fen": self.initial_fen if self.initial_fen else self.board.initial_fen,
-                "san": None,
-                "turnColor": "black" if self.board.color == BLACK else "white",
-                "check": self.check,
-                "clocks": self.ply_clocks[0],
-            }
-        ]
+        start_clock = (base * 1000 * 60) + 0 if base > 0 else inc * 1000
+        self.steps = Steps(
+            self.board.move_stack,
+            self.initial_fen if self.initial_fen else self.board.initial_fen,
+            "black" if self.board.color == BLACK else "white",
+            self.check,
+            {"white": start_clock, "black": start_clock},
+        )
+
+        # indexes of the played moves in the sorted legal move lists (see compress.py)
+        self.move_indexes = array("H")
+
+        # PGN movetext SANs of games not using SAN notation
+        self.pgn_sans = []
+        self.pgn_cache = None
 
         self.stopwatch = Clock(self)
 
@@ -252,10 +252,10 @@ class Game:
     def berserk(self, color):
         if color == "white" and not self.wberserk:
             self.wberserk = True
-            self.ply_clocks[0]["white"] = self.berserk_time
+            self.steps.set_clock(0, "white", self.berserk_time)
         elif color == "black" and not self.bberserk:
             self.bberserk = True
-            self.ply_clocks[0]["black"] = self.berserk_time
+            self.steps.set_clock(0, "black", self.berserk_time)
 
     async def play_move(self, move, clocks=None, ply=None):
         self.stopwatch.stop()
@@ -288,10 +288,7 @@ class Game:
                 int(round((cur_time - self.last_server_clock) * 1000)) if self.board.ply >= 2 else 0
             )
             if clocks is None:
-                clocks = {
-                    "white": self.ply_clocks[-1]["white"],
-                    "black": self.ply_clocks[-1]["black"],
-                }
+                clocks = self.clocks
 
             if cur_player.bot and self.board.ply >= 2:
                 cur_color = "black" if self.board.color == BLACK else "white"
@@ -335,26 +332,22 @@ class Game:
 
         if self.status <= STARTED:
             try:
-                san = self.board.get_san(move)
+                index = self.board.move_index(move)
+                after = self.board.play(move)
+                self.move_indexes.append(index)
                 self.lastmove = move
-                self.board.push(move)
-                self.ply_clocks.append(clocks)
-                self.legal_moves = self.board.legal_moves()
-                self.update_status()
+                self.steps.append(
+                    after.fen,
+                    after.san,
+                    "black" if self.board.color == BLACK else "white",
+                    after.check,
+                    clocks,
+                )
+                self.update_status(after=after)
 
                 if self.status > STARTED:
                     await self.save_game()
 
-                self.steps.append(
-                    {
-                        "fen": self.board.fen,
-                        "move": move,
-                        "san": san,
-                        "turnColor": "black" if self.board.color == BLACK else "white",
-                        "check": self.check,
-                        "clocks": clocks,
-                    }
-                )
                 self.stopwatch.restart()
 
             except Exception:
@@ -429,13 +422,21 @@ class Game:
                 "f": self.board.fen,
                 "s": self.status,
                 "r": R2C[self.result],
-                "m": encode_moves(
+                "st": self.steps.snapshot(),
+            }
+
+            if len(self.move_indexes) == len(self.board.move_stack):
+                new_data["m"] = encode_move_indexes(self.move_indexes)
+                new_data["mv"] = INDEX_ENCODING
+                new_data["lm"] = self.lastmove
+            else:
+                # continued game loaded from an old document
+                new_data["m"] = encode_moves(
                     map(grand2zero, self.board.move_stack)
                     if self.variant in GRANDS
                     else self.board.move_stack,
                     self.variant,
-                ),
-            }
+                )
 
             if self.rated == RATED and self.result != "*":
                 new_data["p0"] = self.p0
@@ -447,10 +448,8 @@ class Game:
                 new_data["if"] = self.board.initial_fen
 
             if self.rated == RATED:
-                # TODO: self.ply_clocks dict stores clock data redundant
-                # possible it would be better to use self.ply_clocks_w and self.ply_clocks_b arrays instead
-                new_data["cw"] = [p["white"] for p in self.ply_clocks[1:]][0::2]
-                new_data["cb"] = [p["black"] for p in self.ply_clocks[2:]][0::2]
+                new_data["cw"] = self.steps.wclocks[1::2].tolist()
+                new_data["cb"] = self.steps.bclocks[2::2].tolist()
 
             if self.tournamentId is not None:
                 new_data["wb"] = self.wberserk
@@ -462,7 +461,7 @@ class Game:
                 new_data["mct"] = self.manual_count_toggled
 
             if self.db is not None:
-                await self.db.game.find_one_and_update({"_id": self.id}, {"$set": new_data})
+                self.app["db_writer"].update("game", self.id, new_data)
 
     def set_crosstable(self):
         if (
@@ -503,27 +502,34 @@ class Game:
             "s2": self.crosstable["s2"],
             "r": self.crosstable["r"],
         }
-        self.db_crosstable[self.ct_id] = new_data
+        self.db_crosstable.put(new_data)
 
         self.need_crosstable_save = True
 
+    async def load_crosstable(self):
+        if self.crosstable != "":
+            self.crosstable = await self.db_crosstable.load(self.ct_id)
+
     async def save_crosstable(self):
         if not self.need_crosstable_save:
             log.info("Crosstable update for %s was already saved to mongodb", self.id)
             return
 
-        new_data = {
-            "s1": self.crosstable["s1"],
-            "s2": self.crosstable["s2"],
-            "r": self.crosstable["r"],
-        }
-        try:
-            await self.db.crosstable.find_one_and_update(
-                {"_id": self.ct_id}, {"$set": new_data}, upsert=True
-            )
-        except Exception:
-            if self.db is not None:
-                log.error("Failed to save new crosstable to mongodb!")
+        swap = self.app["crosstable_swap"]
+        if swap is not None:
+            # a rebuilt crosstable collection is being renamed in place of the current one
+            swap[self.id] = {
+                "_id": self.id,
+                "us": [self.wplayer.username, self.bplayer.username],
+                "r": R2C[self.result],
+            }
+        elif self.db is not None:
+            new_data = {
+                "s1": self.crosstable["s1"],
+                "s2": self.crosstable["s2"],
+                "r": self.crosstable["r"],
+            }
+            self.app["db_writer"].update("crosstable", self.ct_id, new_data, upsert=True)
 
         self.need_crosstable_save = False
 
@@ -537,24 +543,8 @@ class Game:
         return (0, 0)
 
     async def set_highscore(self, variant, chess960, value):
-        self.highscore[variant + ("960" if chess960 else "")].update(value)
-        # We have to preserve previous top 10!
-        # See test_win_and_in_then_lost_and_out() in test.py
-        # if len(self.highscore[variant + ("960" if chess960 else "")]) > MAX_HIGH_SCORE:
-        #     self.highscore[variant + ("960" if chess960 else "")].popitem()
-
-        new_data = {
-            "scores": dict(self.highscore[variant + ("960" if chess960 else "")].items()[:10])
-        }
-        try:
-            await self.db.highscore.find_one_and_update(
-                {"_id": variant + ("960" if chess960 else "")},
-                {"$set": new_data},
-                upsert=True,
-            )
-        except Exception:
-            if self.db is not None:
-                log.error("Failed to save new highscore to mongodb!")
+        for username, rating in value.items():
+            self.highscore.update_score(variant + ("960" if chess960 else ""), username, rating)
 
     async def update_ratings(self):
         if self.result == "1-0":
@@ -594,7 +584,9 @@ class Game:
                 {self.bplayer.username: int(round(br.mu, 0))},
             )
 
-    def update_status(self, status=None, result=None):
+    def update_status(self, status=None, result=None, after=None):
+        """Set the given status and result, or the ones following from the board
+        position described by after (the AfterMove returned by FairyBoard.play())"""
         if self.status > STARTED:
             return
 
@@ -619,19 +611,18 @@ class Game:
 
             return
 
-        if self.board.move_stack:
-            self.check = self.board.is_checked()
+        self.check = after.check
 
-        w, b = self.board.insufficient_material()
+        w, b = after.insufficient
         if w and b:
             self.status = DRAW
             self.result = "1/2-1/2"
 
-        if not self.legal_moves:
-            game_result_value = self.board.game_result()
+        if not after.legal_moves:
+            game_result_value = after.result
             self.result = result_string_from_value(self.board.color, game_result_value)
 
-            if self.board.is_immediate_game_end()[0]:
+            if after.immediate_end:
                 self.status = VARIANTEND
             elif self.check:
                 self.status = MATE
@@ -667,7 +658,7 @@ class Game:
         else:
             # end the game by 50 move rule and repetition automatically
             # for non-draw results and bot games
-            is_game_end, game_result_value = self.board.is_optional_game_end()
+            is_game_end, game_result_value = after.optional_end, after.result
             if is_game_end and (game_result_value != 0 or (self.wplayer.bot or self.bplayer.bot)):
                 self.result = result_string_from_value(self.board.color, game_result_value)
                 self.status = CLAIM if game_result_value != 0 else DRAW
@@ -698,15 +689,39 @@ class Game:
         print(self.board.print_pos())
 
     @property
-    def pgn(self):
-        try:
-            mlist = sf.get_san_moves(
+    def san_moves(self):
+        """SAN of the moves played, PGN always uses standard algebraic notation"""
+        move_stack = self.board.move_stack
+        if len(self.steps) - 1 != len(move_stack):
+            return sf.get_san_moves(
+                self.variant, self.initial_fen, move_stack, self.chess960, sf.NOTATION_SAN
+            )
+
+        if self.board.notation == sf.NOTATION_SAN:
+            return [self.steps.sans[ply] for ply in range(1, len(self.steps))]
+
+        # Other notations are converted once, continuing from the last converted move
+        ply = len(self.pgn_sans)
+        if ply < len(move_stack):
+            self.pgn_sans += sf.get_san_moves(
                 self.variant,
-                self.initial_fen,
-                self.board.move_stack,
+                self.steps.fens[ply],
+                move_stack[ply:],
                 self.chess960,
                 sf.NOTATION_SAN,
             )
+        return self.pgn_sans
+
+    @property
+    def pgn(self):
+        key = (self.board.ply, self.result)
+        if self.pgn_cache is None or self.pgn_cache[0] != key:
+            self.pgn_cache = (key, self.make_pgn())
+        return self.pgn_cache[1]
+
+    def make_pgn(self):
+        try:
+            mlist = self.san_moves
         except Exception:
             log.exception("ERROR: Exception in game %s pgn()", self.id)
             mlist = self.board.move_stack
@@ -716,7 +731,7 @@ class Game:
                 for ind, move in enumerate(mlist)
             )
         )
-        no_setup = self.initial_fen == self.board.start_fen("chess") and not self.chess960
+        no_setup = self.initial_fen == variant_info("chess").start_fen and not self.chess960
         # Use lichess format for crazyhouse games to support easy import
         setup_fen = (
             self.initial_fen if self.variant != "crazyhouse" else self.initial_fen.replace("[]", "")
@@ -754,9 +769,13 @@ class Game:
             " ".join(self.board.move_stack),
         )
 
+    @property
+    def legal_moves(self):
+        return self.board.legal_moves()
+
     @property
     def clocks(self):
-        return self.ply_clocks[-1]
+        return self.steps.last_clocks()
 
     @property
     def is_claimable_draw(self):
@@ -880,12 +899,30 @@ class Game:
             self.manual_count_toggled.append((self.board.count_started, self.board.ply + 1))
             self.board.count_started = -1
 
+    def get_move(self):
+        """Delta of a move played in a running game. Clients already knowing the previous
+        ply apply it to their board, others have to ask for the full board message."""
+        response = {
+            "type": "move",
+            "gameId": self.id,
+            "ply": self.board.ply,
+            "status": self.status,
+            "fen": self.board.fen,
+            "lastMove": self.lastmove,
+            "san": self.steps.sans[-1],
+            "check": self.check,
+            "clocks": self.clocks,
+        }
+        if self.byoyomi:
+            response["byo"] = (self.byoyomi_periods["white"], self.byoyomi_periods["black"])
+        if self.board.ply <= 2:
+            response["berserk"] = {"w": self.wberserk, "b": self.bberserk}
+        return response
+
     def get_board(self, full=False):
         if full:
-            steps = self.steps
-
-            # To not touch self.ply_clocks we are creating deep copy from clocks
-            clocks = {"black": self.clocks["black"], "white": self.clocks["white"]}
+            steps = list(self.steps)
+            clocks = self.clocks
 
             if self.status == STARTED and self.board.ply >= 2:
                 # We have to adjust current player latest saved clock time
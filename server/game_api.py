@@ -1,17 +1,21 @@
 import asyncio
+import bz2
+import collections
 import json
 import logging
-from datetime import datetime
+from datetime import datetime, timezone
 from functools import partial
+import zlib
 
 from aiohttp import web
 import aiohttp_session
 from aiohttp_sse import sse_response
 
+from broadcast import broadcast_stats
 from const import GRANDS, STARTED, MATE, VARIANTS, INVALIDMOVE, VARIANTEND, CLAIM
-from compress import decode_moves, C2V, V2C, C2R
+from compress import decode_moves, C2V, V2C, C2R, INDEX_ENCODING
 from convert import zero2grand
-from utils import pgn
+from utils import decode_doc_moves, pgn_batch, PGN_PROJECTION
 from settings import ADMINS
 from tournaments import get_tournament_name
 
@@ -19,6 +23,33 @@ log = logging.getLogger(__name__)
 
 GAME_PAGE_SIZE = 12
 
+EXPORT_BATCH_SIZE = 100
+EXPORT_BATCHES = 4
+
+# {compression: (compressor, content type, file extension)}
+COMPRESSORS = {
+    "gzip": (partial(zlib.compressobj, wbits=31), "application/gzip", ".pgn.gz"),
+    "bz2": (bz2.BZ2Compressor, "application/x-bzip2", ".pgn.bz2"),
+}
+
+
+async def get_broadcast_stats(request):
+    return web.json_response(broadcast_stats.as_dict())
+
+
+async def get_game_cache_stats(request):
+    return web.json_response(request.app["game_cache"].as_dict())
+
+
+async def get_crosstable_cache_stats(request):
+    return web.json_response(request.app["crosstable"].as_dict())
+
+
+async def get_readiness(request):
+    """200 when every startup stage is done, 503 when a db stage failed"""
+    startup = request.app["startup"]
+    return web.json_response(startup, status=200 if startup["ready"] else 503)
+
 
 async def get_variant_stats(request):
     cur_period = datetime.now().isoformat()[:7]
@@ -112,7 +143,7 @@ async def get_tournament_games(request):
                 "users": doc["us"],
                 "result": doc["r"],
                 "fen": doc.get("if"),
-                "moves": decode_moves(doc["m"], doc["v"]),
+                "moves": decode_doc_moves(doc, doc["v"]),
             }
         )
 
@@ -121,10 +152,11 @@ async def get_tournament_games(request):
 
 async def get_user_games(request):
     users = request.app["users"]
+    titles = request.app["titles"]
     db = request.app["db"]
     profileId = request.match_info.get("profileId")
 
-    if profileId is not None and profileId not in users:
+    if profileId is not None and await users.load(profileId) is None:
         await asyncio.sleep(3)
         return web.json_response({})
 
@@ -223,11 +255,14 @@ async def get_user_games(request):
 
             doc["v"] = C2V[doc["v"]]
             doc["r"] = C2R[doc["r"]]
-            doc["wt"] = users[doc["us"][0]].title if doc["us"][0] in users else ""
-            doc["bt"] = users[doc["us"][1]].title if doc["us"][1] in users else ""
-            doc["lm"] = decode_moves((doc["m"][-1],), doc["v"])[-1] if len(doc["m"]) > 0 else ""
-            if doc["v"] in GRANDS and doc["lm"] != "":
-                doc["lm"] = zero2grand(doc["lm"])
+            doc["wt"] = titles.get(doc["us"][0], "")
+            doc["bt"] = titles.get(doc["us"][1], "")
+            if doc.get("mv") == INDEX_ENCODING:
+                doc["lm"] = doc.get("lm") or ""
+            else:
+                doc["lm"] = decode_moves((doc["m"][-1],), doc["v"])[-1] if len(doc["m"]) > 0 else ""
+                if doc["v"] in GRANDS and doc["lm"] != "":
+                    doc["lm"] = zero2grand(doc["lm"])
 
             tournament_id = doc.get("tid")
             if tournament_id is not None:
@@ -242,7 +277,7 @@ async def get_user_games(request):
                         "users": doc["us"],
                         "result": doc["r"],
                         "fen": doc.get("if"),
-                        "moves": decode_moves(doc["m"], doc["v"]),
+                        "moves": decode_doc_moves(doc, doc["v"]),
                     }
                 )
             else:
@@ -334,7 +369,7 @@ async def export(request):
     db = request.app["db"]
     users = request.app["users"]
     profileId = request.match_info.get("profileId")
-    if profileId is not None and profileId not in users:
+    if profileId is not None and await users.load(profileId) is None:
         await asyncio.sleep(3)
         return web.Response(text="")
 
@@ -343,44 +378,63 @@ async def export(request):
     session = await aiohttp_session.get_session(request)
     session_user = session.get("user_name")
 
-    game_list = []
-    game_counter = 0
-    failed = 0
-    cursor = None
-
+    filter_cond = None
     if profileId is not None:
-        cursor = db.game.find({"us": profileId})
+        filter_cond = {"us": profileId}
+        filename = profileId
     elif tournamentId is not None:
-        cursor = db.game.find({"tid": tournamentId})
+        filter_cond = {"tid": tournamentId}
+        filename = tournamentId
     elif session_user in ADMINS:
         yearmonth = request.match_info.get("yearmonth")
-        print("---", yearmonth[:4], yearmonth[4:])
-        filter_cond = {
-            "$and": [
-                {"$expr": {"$eq": [{"$year": "$d"}, int(yearmonth[:4])]}},
-                {"$expr": {"$eq": [{"$month": "$d"}, int(yearmonth[4:])]}},
-            ]
-        }
-        cursor = db.game.find(filter_cond)
-
-    if cursor is not None:
-        async for doc in cursor:
-            try:
-                # print(game_counter)
-                # log.info("%s %s %s" % (doc["d"].strftime("%Y.%m.%d"), doc["_id"], C2V[doc["v"]]))
-                pgn_text = pgn(doc)
-                if pgn_text is not None:
-                    game_list.append(pgn_text)
-                game_counter += 1
-            except Exception:
-                failed += 1
-                log.error(
-                    "Failed to load game %s %s %s (early games may contain invalid moves)",
-                    doc["_id"],
-                    C2V[doc["v"]],
-                    doc["d"].strftime("%Y.%m.%d"),
-                )
-                continue
-        print("failed/all:", failed, game_counter)
-    pgn_text = "\n".join(game_list)
-    return web.Response(text=pgn_text, content_type="text/pgn")
+        year, month = int(yearmonth[:4]), int(yearmonth[4:])
+        start = datetime(year, month, 1, tzinfo=timezone.utc)
+        end = datetime(year + month // 12, month % 12 + 1, 1, tzinfo=timezone.utc)
+        filter_cond = {"d": {"$gte": start, "$lt": end}}
+        filename = yearmonth
+
+    if filter_cond is None:
+        return web.Response(text="", content_type="text/pgn")
+
+    compression = request.rel_url.query.get("compression")
+    response = web.StreamResponse()
+    if compression in COMPRESSORS:
+        make_compressor, response.content_type, extension = COMPRESSORS[compression]
+        compressor = make_compressor()
+    else:
+        compressor = None
+        response.content_type = "text/pgn"
+        extension = ".pgn"
+    response.headers["Content-Disposition"] = 'attachment; filename="%s%s"' % (filename, extension)
+    await response.prepare(request)
+
+    async def write_pgns(batch):
+        data = "".join(text + "\n" for text in await batch).encode()
+        if compressor is not None:
+            data = compressor.compress(data)
+        if data:
+            await response.write(data)
+
+    # PGN conversion of EXPORT_BATCH_SIZE games runs in the process pool while the next
+    # ones are read, at most EXPORT_BATCHES of them are waiting to be written
+    loop = asyncio.get_running_loop()
+    pool = request.app["export_pool"]
+    batches = collections.deque()
+    docs = []
+    async for doc in db.game.find(filter_cond, PGN_PROJECTION):
+        docs.append(doc)
+        if len(docs) == EXPORT_BATCH_SIZE:
+            batches.append(loop.run_in_executor(pool, pgn_batch, docs))
+            docs = []
+            if len(batches) == EXPORT_BATCHES:
+                await write_pgns(batches.popleft())
+
+    if docs:
+        batches.append(loop.run_in_executor(pool, pgn_batch, docs))
+    while batches:
+        await write_pgns(batches.popleft())
+
+    if compressor is not None:
+        await response.write(compressor.flush())
+    await response.write_eof()
+    return response
@@ -0,0 +1,87 @@
+from collections import OrderedDict
+
+from const import STARTED
+
+# Most finished games we keep in memory, and their estimated total size
+GAME_CACHE_SIZE = 500
+GAME_CACHE_BYTES = 64 * 1024 * 1024
+
+# Rough memory use of a Game object without its steps
+GAME_BASE_BYTES = 16 * 1024
+# Move strings in board.move_stack and fen_history
+MOVE_BYTES = 160
+ANNOTATION_BYTES = 512
+
+
+def game_size(game):
+    """Estimated memory use of a finished game in bytes"""
+    steps = game.steps
+    return (
+        GAME_BASE_BYTES
+        + len(steps.fens.data)
+        + len(steps.sans.data)
+        + len(steps) * (2 * steps.fens.ends.itemsize + 1 + 2 * steps.wclocks.itemsize)
+        + len(game.board.move_stack) * MOVE_BYTES
+        + len(steps.annotations) * ANNOTATION_BYTES
+    )
+
+
+class GameCache:
+    """LRU cache of finished games loaded from the database.
+    Live games (and finished ones for KEEP_TIME) are in app["games"] instead."""
+
+    def __init__(self, max_games=GAME_CACHE_SIZE, max_bytes=GAME_CACHE_BYTES):
+        self.max_games = max_games
+        self.max_bytes = max_bytes
+        self.games = OrderedDict()
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self.games)
+
+    def values(self):
+        return (game for game, size in self.games.values())
+
+    def get(self, game_id):
+        try:
+            game, size = self.games[game_id]
+        except KeyError:
+            self.misses += 1
+            return None
+        self.games.move_to_end(game_id)
+        self.hits += 1
+        return game
+
+    def put(self, game):
+        if game.status <= STARTED:
+            return
+
+        size = game_size(game)
+        if size > self.max_bytes:
+            return
+
+        self.discard(game.id)
+        self.games[game.id] = (game, size)
+        self.bytes += size
+
+        while len(self.games) > self.max_games or self.bytes > self.max_bytes:
+            game_id, (game, size) = self.games.popitem(last=False)
+            self.bytes -= size
+            self.evictions += 1
+
+    def discard(self, game_id):
+        if game_id in self.games:
+            game, size = self.games.pop(game_id)
+            self.bytes -= size
+
+    def as_dict(self):
+        return {
+            "games": len(self.games),
+            "bytes": self.bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+        }
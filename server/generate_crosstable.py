@@ -1,61 +1,212 @@
-async def generate_crosstable(db):
-    ct = {}
-    cursor = db.game.find().sort("d")
-    async for doc in cursor:
-        game_id = doc["_id"]
-        wp, bp = doc["us"]
-        result = doc["r"]
-
-        if wp < bp:
-            s1p = wp
-            s2p = bp
-        else:
-            s1p = bp
-            s2p = wp
-        ct_id = s1p + "/" + s2p
-
-        # R2C = {"1-0": "a", "0-1": "b", "1/2-1/2": "c", "*": "d"}
-        if (
-            result == "d"
-            or wp.startswith("Anon ")
-            or bp.startswith("Anon ")
-            or wp == "Random-Mover"
-            or wp == "Fairy-Stockfish"
-            or bp == "Random-Mover"
-            or bp == "Fairy-Stockfish"
-        ):
+import asyncio
+import logging
+from collections import defaultdict
+
+from motor import motor_asyncio as ma
+from pymongo import UpdateOne
+from pymongo.errors import BulkWriteError
+
+from const import CREATED, STARTED
+from crosstable_cache import crosstable_id
+from settings import MONGO_HOST, MONGO_DB_NAME
+
+log = logging.getLogger(__name__)
+
+BATCH_SIZE = 1000
+
+# Pause between batches (in seconds) to leave room for the running server
+BATCH_PAUSE = 0.1
+
+# Results are collected here and renamed to "crosstable" when every game was processed
+REBUILD_COLLECTION = "crosstable_rebuild"
+
+# Progress of an unfinished rebuild, stored in the "checkpoint" collection
+CROSSTABLE_CHECKPOINT_ID = "crosstable"
+
+BOTS = ("Random-Mover", "Fairy-Stockfish")
+
+DUPLICATE_KEY_ERROR = 11000
+
+
+def game_result(doc):
+    """(ct_id, s1, s2, result string) of a game document or None if it doesn't count"""
+    wp, bp = doc["us"]
+    result = doc["r"]
+
+    # R2C = {"1-0": "a", "0-1": "b", "1/2-1/2": "c", "*": "d"}
+    if (
+        result == "d"
+        or wp.startswith("Anon-")
+        or bp.startswith("Anon-")
+        or wp in BOTS
+        or bp in BOTS
+    ):
+        return None
+
+    s1p = min(wp, bp)
+    if result == "c":
+        s1 = s2 = 5
+        tail = "="
+    elif (result == "a" and s1p == wp) or (result == "b" and s1p == bp):
+        s1 = 10
+        s2 = 0
+        tail = "+"
+    else:
+        s1 = 0
+        s2 = 10
+        tail = "-"
+
+    return crosstable_id(wp, bp), s1, s2, "%s%s" % (doc["_id"], tail)
+
+
+def batch_updates(docs, seq):
+    """One update per player pair adding the results of a batch of games.
+    Documents already updated by batch seq are left alone, so a batch can be safely repeated."""
+    pairs = defaultdict(lambda: [0, 0, []])
+    for doc in docs:
+        result = game_result(doc)
+        if result is None:
             continue
+        ct_id, s1, s2, tail = result
+        pair = pairs[ct_id]
+        pair[0] += s1
+        pair[1] += s2
+        pair[2].append(tail)
+
+    return [
+        UpdateOne(
+            {"_id": ct_id, "seq": {"$lt": seq}},
+            {
+                "$inc": {"s1": s1, "s2": s2},
+                "$push": {"r": {"$each": results, "$slice": -20}},
+                "$set": {"seq": seq},
+            },
+            upsert=True,
+        )
+        for ct_id, (s1, s2, results) in pairs.items()
+    ]
+
+
+def unfinished(doc):
+    return doc["r"] == "d" and doc.get("s", CREATED) <= STARTED
 
-        if result == "c":
-            s1 = s2 = 5
-            tail = "="
-        elif (result == "a" and s1p == wp) or (result == "b" and s1p == bp):
-            s1 = 10
-            s2 = 0
-            tail = "+"
+
+async def write_results(collection, docs, seq):
+    requests = batch_updates(docs, seq)
+    if requests:
+        try:
+            await collection.bulk_write(requests, ordered=False)
+        except BulkWriteError as e:
+            # Pairs already updated by a repeated batch don't match the filter
+            # and their upsert fails with duplicate key error
+            errors = e.details["writeErrors"]
+            if any(error["code"] != DUPLICATE_KEY_ERROR for error in errors):
+                raise
+
+
+async def generate_crosstable(db, batch_size=BATCH_SIZE, pause=BATCH_PAUSE, app=None):
+    """Rebuild the crosstable collection from the game collection.
+    Games are read in (date, _id) order batch by batch and the results are added to a
+    separate collection, so the live "crosstable" is neither dropped nor locked until the
+    final rename. The last processed game is checkpointed after every batch and an
+    interrupted rebuild continues from there.
+
+    Games still played when the scan passes them are remembered in the checkpoint and
+    counted before the rename if they finished meanwhile. When the running server (app)
+    does the rebuild, games finishing during the swap hand their results to
+    app["crosstable_swap"] instead of writing the old collection, and the games still
+    played get their crosstables reloaded from the new one."""
+    checkpoint = await db.checkpoint.find_one({"_id": CROSSTABLE_CHECKPOINT_ID})
+    if checkpoint is None:
+        await db[REBUILD_COLLECTION].drop()
+        checkpoint = {"_id": CROSSTABLE_CHECKPOINT_ID, "d": None, "g": None, "seq": 0}
+    else:
+        log.info("generate_crosstable() continues after game %s", checkpoint["g"])
+    pending = set(checkpoint.get("pending", ()))
+
+    projection = {"us": 1, "r": 1, "d": 1, "s": 1}
+    while True:
+        if checkpoint["g"] is None:
+            filter_cond = {}
         else:
-            s1 = 0
-            s2 = 10
-            tail = "-"
-
-        if ct_id not in ct:
-            ct[ct_id] = {
-                "_id": ct_id,
-                "s1": s1,
-                "s2": s2,
-                "r": ["%s%s" % (game_id, tail)],
+            filter_cond = {
+                "$or": [
+                    {"d": {"$gt": checkpoint["d"]}},
+                    {"d": checkpoint["d"], "_id": {"$gt": checkpoint["g"]}},
+                ]
             }
-        else:
-            ct[ct_id]["s1"] += s1
-            ct[ct_id]["s2"] += s2
-            ct[ct_id]["r"].append("%s%s" % (game_id, tail))
-
-    for i, item in enumerate(sorted(ct.values(), key=lambda x: x["_id"])):
-        # print(i, item)
-        ct[item["_id"]]["r"] = ct[item["_id"]]["r"][-20:]
-        # print(i, item)
-
-    await db.crosstable.drop()
-    # bulk insert to crosstable
-    if len(ct) > 0:
-        await db.crosstable.insert_many(ct.values())
+        cursor = db.game.find(filter_cond, projection).sort([("d", 1), ("_id", 1)])
+        docs = await cursor.limit(batch_size).to_list(batch_size)
+        if not docs:
+            break
+
+        seq = checkpoint["seq"] + 1
+        pending.update(doc["_id"] for doc in docs if unfinished(doc))
+        await write_results(db[REBUILD_COLLECTION], docs, seq)
+
+        checkpoint.update(
+            {"d": docs[-1]["d"], "g": docs[-1]["_id"], "seq": seq, "pending": list(pending)}
+        )
+        await db.checkpoint.replace_one({"_id": CROSSTABLE_CHECKPOINT_ID}, checkpoint, upsert=True)
+        log.debug("generate_crosstable() batch %s done, last game %s", seq, checkpoint["g"])
+        await asyncio.sleep(pause)
+
+    try:
+        if app is not None:
+            app["crosstable_swap"] = {}
+            # crosstable writes already queued must not land in the new collection
+            await app["db_writer"].drain()
+
+        seq = checkpoint["seq"] + 1
+        finished = {}
+        if pending:
+            cursor = db.game.find({"_id": {"$in": list(pending)}}, projection)
+            async for doc in cursor:
+                if not unfinished(doc):
+                    finished[doc["_id"]] = doc
+        if app is not None:
+            finished.update(app["crosstable_swap"])
+            app["crosstable_swap"].clear()
+        await write_results(db[REBUILD_COLLECTION], finished.values(), seq)
+
+        if REBUILD_COLLECTION in await db.list_collection_names():
+            await db[REBUILD_COLLECTION].rename("crosstable", dropTarget=True)
+        await db.checkpoint.delete_one({"_id": CROSSTABLE_CHECKPOINT_ID})
+
+        if app is not None:
+            await swap_live_games(app, seq)
+    finally:
+        if app is not None:
+            app["crosstable_swap"] = None
+    log.info("generate_crosstable() processed %s batches", checkpoint["seq"])
+
+
+async def swap_live_games(app, seq):
+    """Count the games finished during the rename and reload the crosstables
+    read from the old collection, until nothing finished meanwhile"""
+    swap = app["crosstable_swap"]
+    while True:
+        seq += 1
+        finished = list(swap.values())
+        swap.clear()
+        await write_results(app["db"].crosstable, finished, seq)
+
+        app["crosstable"].clear()
+        for game in list(app["games"].values()):
+            if game.status <= STARTED:
+                await game.load_crosstable()
+
+        if not swap:
+            break
+
+
+async def main():
+    client = ma.AsyncIOMotorClient(MONGO_HOST)
+    db = client[MONGO_DB_NAME]
+    await db.game.create_index([("d", 1), ("_id", 1)])
+    await generate_crosstable(db)
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    asyncio.run(main())
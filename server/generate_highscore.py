@@ -1,38 +1,77 @@
+import asyncio
 from decimal import Decimal
 
+from motor import motor_asyncio as ma
+from pymongo import ReplaceOne
+
 from const import VARIANTS, HIGHSCORE_MIN_GAMES
+from settings import MONGO_HOST, MONGO_DB_NAME
 
+# Number of players shown on the variant leaderboard pages
+HIGHSCORE_SIZE = 50
 
-async def generate_highscore(db, one_variant=None):
-    limit = 50
-    hs = []
-    variants = VARIANTS if one_variant is None else (one_variant,)
+# Number of players stored, the ones below HIGHSCORE_SIZE
+# fill the top when players drop out of it
+HIGHSCORE_STORED = 2 * HIGHSCORE_SIZE
+
+# Players with higher rating deviation are left out
+HIGHSCORE_MAX_DEVIATION = 350
+
+
+async def create_highscore_indexes(db):
+    """Partial (rating, deviation) indexes of players having enough games in a variant"""
+    await asyncio.gather(
+        *(
+            db.user.create_index(
+                [("perfs.%s.gl.r" % variant, -1), ("perfs.%s.gl.d" % variant, 1)],
+                name="highscore_%s" % variant,
+                partialFilterExpression={"perfs.%s.nb" % variant: {"$gte": HIGHSCORE_MIN_GAMES}},
+            )
+            for variant in VARIANTS
+        )
+    )
+
+
+async def variant_highscore(db, variant, limit=HIGHSCORE_STORED):
+    d = "perfs.%s.gl.d" % variant
+    r = "perfs.%s.gl.r" % variant
+    nb = "perfs.%s.nb" % variant
+    filt = {
+        d: {"$lt": HIGHSCORE_MAX_DEVIATION},
+        "enabled": {"$ne": False},
+        nb: {"$gte": HIGHSCORE_MIN_GAMES},
+    }
+
+    scores = {}
+    cursor = db.user.find(filt, {r: 1}, sort=[(r, -1)], limit=limit)
+    async for doc in cursor:
+        scores[doc["_id"]] = int(round(Decimal(doc["perfs"][variant]["gl"]["r"]), 0))
+    return scores
 
+
+async def generate_highscore(db, variants=VARIANTS):
+    """Recompute the leaderboards of variants from the user collection and store them.
+    The running server keeps them up to date from rating changes, so this is only needed
+    when the highscore collection is missing some variant or users were disabled."""
+    hs = []
     for variant in variants:
-        # print(variant)
-        d = "perfs.%s.gl.d" % variant
-        r = "perfs.%s.gl.r" % variant
-        nb = "perfs.%s.nb" % variant
-        filt = {
-            d: {"$lt": 350},
-            "enabled": {"$ne": False},
-            nb: {"$gte": HIGHSCORE_MIN_GAMES},
-        }
-
-        scores = {}
-        cursor = db.user.find(filt, sort=[(r, -1)], limit=limit)
-        async for doc in cursor:
-            scores[doc["_id"]] = int(round(Decimal(doc["perfs"][variant]["gl"]["r"]), 0))
-
-        if one_variant is None:
-            hs.append({"_id": variant, "scores": scores})
-        else:
-            hs = scores
-
-    if one_variant is None:
-        await db.highscore.drop()
-        # bulk insert to highscore
-        if len(hs) > 0:
-            await db.highscore.insert_many(hs)
+        hs.append({"_id": variant, "scores": await variant_highscore(db, variant)})
+
+    if len(hs) > 0:
+        await db.highscore.bulk_write(
+            [ReplaceOne({"_id": doc["_id"]}, doc, upsert=True) for doc in hs], ordered=False
+        )
 
     return hs
+
+
+async def main():
+    client = ma.AsyncIOMotorClient(MONGO_HOST)
+    db = client[MONGO_DB_NAME]
+    await create_highscore_indexes(db)
+    hs = await generate_highscore(db)
+    print("Rebuilt %s highscore lists" % len(hs))
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,101 @@
+import asyncio
+import logging
+from operator import neg
+
+from sortedcollections import ValueSortedDict
+
+from const import VARIANTS
+from generate_highscore import (
+    create_highscore_indexes,
+    generate_highscore,
+    variant_highscore,
+    HIGHSCORE_SIZE,
+    HIGHSCORE_STORED,
+)
+
+log = logging.getLogger(__name__)
+
+
+class Highscores(dict):
+    """Variant leaderboards {variant: ValueSortedDict(neg, {username: rating}), ...}
+    They are updated from rating changes, and the top HIGHSCORE_STORED of a variant is
+    written to the highscore collection only when it has changed.
+
+    Players are read from the db only down to the lowest stored rating (the cutoff of the
+    variant), everybody else below it is unknown until their rating changes. When less than
+    HIGHSCORE_SIZE known players are left above the cutoff the list is read again."""
+
+    def __init__(self, app):
+        super().__init__((variant, ValueSortedDict(neg)) for variant in VARIANTS)
+        self.app = app
+        # {variant: lowest rating read from the db}, None if every eligible player was read
+        self.cutoff = dict.fromkeys(VARIANTS)
+        self.refill_tasks = {}
+
+    def top(self, variant, n=10):
+        return dict(self[variant].items()[:n])
+
+    def update_score(self, variant, username, rating):
+        # We have to preserve players out of the top too!
+        # See test_win_and_in_then_lost_and_out() in test.py
+        scores = self[variant]
+        old_top = scores.items()[:HIGHSCORE_STORED]
+        scores[username] = rating
+        self.write_top(variant, old_top)
+
+        if self.needs_refill(variant) and variant not in self.refill_tasks:
+            self.refill_tasks[variant] = asyncio.create_task(self.refill(variant))
+
+    def write_top(self, variant, old_top):
+        new_top = self[variant].items()[:HIGHSCORE_STORED]
+        if new_top != old_top and self.app["db"] is not None:
+            self.app["db_writer"].update(
+                "highscore", variant, {"scores": dict(new_top)}, upsert=True
+            )
+
+    def needs_refill(self, variant):
+        cutoff = self.cutoff[variant]
+        if cutoff is None:
+            return False
+        scores = self[variant]
+        return len(scores) < HIGHSCORE_SIZE or scores.peekitem(HIGHSCORE_SIZE - 1)[1] < cutoff
+
+    def set_scores(self, variant, scores):
+        """Add the players read from the db, ratings already in memory are newer"""
+        self[variant].update(
+            {
+                username: rating
+                for username, rating in scores.items()
+                if username not in self[variant]
+            }
+        )
+        self.cutoff[variant] = min(scores.values()) if len(scores) >= HIGHSCORE_STORED else None
+
+    async def refill(self, variant):
+        try:
+            old_top = self[variant].items()[:HIGHSCORE_STORED]
+            self.set_scores(variant, await variant_highscore(self.app["db"], variant))
+            self.write_top(variant, old_top)
+            log.debug("Refilled %s highscore, cutoff %s", variant, self.cutoff[variant])
+        except Exception:
+            log.exception("Failed to refill %s highscore", variant)
+        finally:
+            del self.refill_tasks[variant]
+
+    async def load(self):
+        """Read the stored leaderboards. Variants missing from the db or stored with less
+        than HIGHSCORE_STORED players (older servers stored only the top 10) are generated."""
+        db = self.app["db"]
+        await create_highscore_indexes(db)
+
+        stored = set()
+        async for doc in db.highscore.find():
+            if doc["_id"] in self and len(doc["scores"]) >= HIGHSCORE_STORED:
+                self.set_scores(doc["_id"], doc["scores"])
+                stored.add(doc["_id"])
+
+        missing = [variant for variant in VARIANTS if variant not in stored]
+        if missing:
+            log.info("Generating highscore of %s", missing)
+            for doc in await generate_highscore(db, missing):
+                self.set_scores(doc["_id"], doc["scores"])
@@ -30,7 +30,7 @@ from const import (
     TRANSLATED_VARIANT_NAMES,
     TRANSLATED_PAIRING_SYSTEM_NAMES,
 )
-from fairy import FairyBoard
+from fairy import variant_info
 from glicko2.glicko2 import DEFAULT_PERF, PROVISIONAL_PHI
 from robots import ROBOTS_TXT
 from settings import (
@@ -43,7 +43,7 @@ from settings import (
     SOURCE_VERSION,
     DEV,
 )
-from generate_highscore import generate_highscore
+from generate_highscore import HIGHSCORE_SIZE
 from misc import time_control_str
 from news import NEWS
 from videos import VIDEO_TAGS, VIDEO_TARGETS
@@ -112,6 +112,8 @@ async def index(request):
 
         if session_user in users:
             user = users[session_user]
+        elif doc is not None:
+            user = users.add_doc(doc)
         else:
             if session_user.startswith("Anon-"):
                 session.invalidate()
@@ -239,7 +241,7 @@ async def index(request):
         view = "calendar"
 
     profileId = request.match_info.get("profileId")
-    if profileId is not None and profileId not in users:
+    if profileId is not None and await users.load(profileId) is None:
         await asyncio.sleep(3)
         raise web.HTTPNotFound()
 
@@ -301,8 +303,9 @@ async def index(request):
                     try:
                         # Put response data to sse subscribers queue
                         channels = request.app["invite_channels"]
+                        payload = json.dumps({"gameId": gameId})
                         for queue in channels:
-                            await queue.put(json.dumps({"gameId": gameId}))
+                            await queue.put(payload)
                         # return games[game_id]
                     except ConnectionResetError:
                         pass
@@ -446,29 +449,27 @@ async def index(request):
         anon_online = sum((1 for u in users.values() if u.anon and u.online))
 
         render["icons"] = VARIANT_ICONS
-        render["users"] = users
+        render["titles"] = request.app["titles"]
         render["online_users"] = online_users
         render["anon_online"] = anon_online
         render["admin"] = user.username in ADMINS
         if variant is None:
             hs = request.app["highscore"]
-            render["highscore"] = {variant: dict(hs[variant].items()[:10]) for variant in hs}
+            render["highscore"] = {variant: hs.top(variant) for variant in hs}
         else:
-            hs = await generate_highscore(request.app["db"], variant)
-            print(hs)
-            render["highscore"] = hs
+            render["highscore"] = request.app["highscore"].top(variant, HIGHSCORE_SIZE)
             view = "players50"
 
     elif view in ("shields", "winners"):
         wi = await get_winners(request.app, shield=(view == "shields"), variant=variant)
         render["view_css"] = "players.css"
-        render["users"] = users
+        render["titles"] = request.app["titles"]
         render["icons"] = VARIANT_ICONS
         render["winners"] = wi
 
     elif view == "allplayers":
-        allusers = [u for u in users.values() if not u.anon]
-        render["allusers"] = allusers
+        cursor = db.user.find({}, {"title": 1}).sort("_id")
+        render["allusers"] = [(doc["_id"], doc.get("title")) async for doc in cursor]
 
     elif view == "tournaments":
         render["icons"] = VARIANT_ICONS
@@ -595,7 +596,7 @@ async def index(request):
 
     elif view == "editor" or (view == "analysis" and gameId is None):
         if fen is None:
-            fen = FairyBoard(variant).start_fen(variant)
+            fen = variant_info(variant).start_fen
         else:
             fen = fen.replace(".", "+").replace("_", " ")
         render["variant"] = variant
@@ -8,7 +8,7 @@ import aiohttp
 from aiohttp import web
 import aiohttp_session
 
-from broadcast import round_broadcast
+from broadcast import round_broadcast, send_json
 from const import STARTED
 from settings import (
     CLIENT_ID,
@@ -163,6 +163,8 @@ async def login(request):
                     "perfs": {},
                 }
             )
+            if session.get("title"):
+                request.app["titles"][username] = session["title"]
             print("db insert user result %s" % repr(result.inserted_id))
         elif not doc.get("enabled", True):
             log.info("Closed account %s tried to log in.", username)
@@ -186,7 +188,7 @@ async def logout(request):
         response = {"type": "logout"}
         for ws in ws_set:
             try:
-                await ws.send_json(response)
+                await send_json(ws, response)
             except ConnectionResetError:
                 pass
 
@@ -0,0 +1,108 @@
+import asyncio
+import logging
+
+try:
+    import pyffish as sf
+
+    sf.set_option("VariantPath", "variants.ini")
+except ImportError:
+    print("No pyffish module installed!")
+
+from motor import motor_asyncio as ma
+from pymongo import UpdateOne
+
+from compress import C2V, decode_moves, encode_move_indexes, INDEX_ENCODING
+from const import GRANDS, STARTED
+from convert import zero2grand
+from fairy import FairyBoard
+from settings import MONGO_HOST, MONGO_DB_NAME
+
+log = logging.getLogger(__name__)
+
+BATCH_SIZE = 100
+
+# Pause between batches (in seconds) to leave room for the running server
+BATCH_PAUSE = 1.0
+
+
+def index_encode(doc):
+    """Index encoded move list and last move of an old game document.
+    Returns None when the document can't be converted."""
+    variant = C2V[doc["v"]]
+
+    # Old USI Shogi games have swapped players and mirrored moves, leave them as they are
+    if variant.endswith("shogi") and doc.get("uci") is None:
+        return None
+
+    try:
+        moves = decode_moves(doc["m"], variant)
+        if variant in GRANDS:
+            moves = map(zero2grand, moves)
+
+        board = FairyBoard(variant, doc.get("if") or "", bool(doc.get("z")))
+        indexes = []
+        for move in moves:
+            try:
+                indexes.append(board.move_index(move))
+            except KeyError:
+                log.error("%s %s invalid move %s at ply %s", doc["_id"], variant, move, board.ply)
+                return None
+            board.push(move)
+    except Exception:
+        # One broken document must not stop the whole migration
+        log.exception("%s %s can't be converted", doc["_id"], variant)
+        return None
+
+    return encode_move_indexes(indexes), board.move_stack[-1] if board.move_stack else ""
+
+
+async def migrate_moves(db, batch_size=BATCH_SIZE, pause=BATCH_PAUSE):
+    """Convert finished games to the index based move encoding batch by batch.
+    Converted documents are not selected again, so an interrupted run can be simply restarted."""
+    filter_cond = {"mv": {"$exists": False}, "s": {"$gt": STARTED}}
+    projection = {"v": 1, "m": 1, "if": 1, "z": 1, "uci": 1}
+
+    converted = skipped = 0
+    last_id = ""
+    while True:
+        cursor = db.game.find({**filter_cond, "_id": {"$gt": last_id}}, projection)
+        docs = await cursor.sort("_id").limit(batch_size).to_list(batch_size)
+        if not docs:
+            break
+
+        requests = []
+        for doc in docs:
+            encoded = index_encode(doc)
+            if encoded is None:
+                skipped += 1
+                continue
+            moves, lastmove = encoded
+            requests.append(
+                UpdateOne(
+                    {"_id": doc["_id"], "mv": {"$exists": False}},
+                    {"$set": {"m": moves, "mv": INDEX_ENCODING, "lm": lastmove}},
+                )
+            )
+
+        if requests:
+            await db.game.bulk_write(requests, ordered=False)
+            converted += len(requests)
+
+        last_id = docs[-1]["_id"]
+        log.info("migrate_moves() converted %s skipped %s games", converted, skipped)
+        await asyncio.sleep(pause)
+
+    return converted, skipped
+
+
+async def main():
+    client = ma.AsyncIOMotorClient(MONGO_HOST)
+    db = client[MONGO_DB_NAME]
+
+    converted, skipped = await migrate_moves(db)
+    print("Converted %s games, skipped %s games" % (converted, skipped))
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    asyncio.run(main())
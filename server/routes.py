@@ -30,6 +30,10 @@ from game_api import (
     subscribe_games,
     subscribe_invites,
     get_variant_stats,
+    get_broadcast_stats,
+    get_game_cache_stats,
+    get_crosstable_cache_stats,
+    get_readiness,
     cancel_invite,
 )
 from utils import import_game, get_names
@@ -107,6 +111,10 @@ get_routes = (
     ("/api/calendar", tournament_calendar),
     ("/api/stats", get_variant_stats),
     ("/api/stats/humans", get_variant_stats),
+    ("/api/stats/broadcast", get_broadcast_stats),
+    ("/api/stats/games", get_game_cache_stats),
+    ("/api/stats/crosstables", get_crosstable_cache_stats),
+    ("/api/ready", get_readiness),
     ("/api/games", get_games),
     ("/api/invites", subscribe_invites),
     ("/api/ongoing", subscribe_games),
@@ -1,8 +1,14 @@
+import asyncio
+
+from broadcast import lobby_broadcast
 from misc import time_control_str
 from newid import new_id
 
 MAX_USER_SEEKS = 10
 
+# Seek list changes are collected for SEEK_FEED_DELAY secs and sent to the lobby in one message
+SEEK_FEED_DELAY = 0.5
+
 
 class Seek:
     gen_id = 0
@@ -123,6 +129,36 @@ async def create_seek(db, invites, seeks, user, data, ws=None, empty=False):
     return seek
 
 
+class SeekFeed:
+    """Sends the lobby what changed in the seek list instead of the whole list on every change.
+    Lobby sockets get the full list with get_seeks() only when they connect."""
+
+    def __init__(self, app):
+        self.app = app
+        # seeks as the lobby knows them {seek.id: seek.as_json, ...}
+        self.sent = {}
+        self.flush_task = None
+
+    def changed(self):
+        if self.flush_task is None:
+            self.flush_task = asyncio.create_task(self.flush_later())
+
+    async def flush_later(self):
+        await asyncio.sleep(SEEK_FEED_DELAY)
+        self.flush_task = None
+        await self.flush()
+
+    async def flush(self):
+        current = {seek_id: seek.as_json for seek_id, seek in self.app["seeks"].items()}
+        add = [seek for seek_id, seek in current.items() if self.sent.get(seek_id) != seek]
+        remove = [seek_id for seek_id in self.sent if seek_id not in current]
+        self.sent = current
+
+        if add or remove:
+            response = {"type": "seeks_update", "add": add, "remove": remove}
+            await lobby_broadcast(self.app["lobbysockets"], response)
+
+
 def get_seeks(seeks):
     return {"type": "get_seeks", "seeks": [seek.as_json for seek in seeks.values()]}
 
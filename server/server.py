@@ -4,11 +4,13 @@ import argparse
 import gettext
 import collections
 import logging
+import multiprocessing
 import os
-from operator import neg
+from concurrent.futures import ProcessPoolExecutor
 from urllib.parse import urlparse
 from datetime import datetime, timezone, timedelta
 from sys import platform
+from time import monotonic
 
 if platform not in ("win32", "darwin"):
     import uvloop
@@ -21,12 +23,11 @@ from aiohttp.web_app import Application
 from aiohttp_session.cookie_storage import EncryptedCookieStorage
 from aiohttp_session import setup
 from motor import motor_asyncio as ma
-from sortedcollections import ValueSortedDict
 from pythongettext.msgfmt import Msgfmt
 from pythongettext.msgfmt import PoSyntaxError
 
 from ai import BOT_task
-from broadcast import lobby_broadcast, round_broadcast
+from broadcast import flush_writers, lobby_broadcast, round_broadcast, send_json
 from const import (
     VARIANTS,
     STARTED,
@@ -40,14 +41,19 @@ from const import (
     MONTHLY,
     SHIELD,
 )
-from generate_crosstable import generate_crosstable
-from generate_highscore import generate_highscore
+from fairy import load_variant_info
+from db_writer import DbWriter
+from tournament_clock import TournamentClock
+from crosstable_cache import CrosstableCache
+from game_cache import GameCache
+from highscore import Highscores
+from generate_crosstable import generate_crosstable, CROSSTABLE_CHECKPOINT_ID
 from generate_shield import generate_shield
-from glicko2.glicko2 import DEFAULT_PERF
 from index import handle_404
 from routes import get_routes, post_routes
 from settings import (
     DEV,
+    EXPORT_WORKERS,
     MAX_AGE,
     SECRET_KEY,
     MONGO_HOST,
@@ -56,10 +62,11 @@ from settings import (
     URI,
     static_url,
 )
-from user import User
+from user import User, Users
 from tournaments import load_tournament, get_scheduled_tournaments, translated_tournament_name
 from twitch import Twitch
 from youtube import Youtube
+from seek import SeekFeed
 from scheduler import (
     create_scheduled_tournaments,
     new_scheduled_tournaments,
@@ -141,11 +148,22 @@ async def init_state(app):
     if "db" not in app:
         app["db"] = None
 
-    app["users"] = {
-        "Random-Mover": User(app, bot=True, username="Random-Mover"),
-        "Fairy-Stockfish": User(app, bot=True, username="Fairy-Stockfish"),
-        "Discord-Relay": User(app, anon=True, username="Discord-Relay"),
-    }
+    app["db_writer"] = DbWriter(app["db"])
+    # Forked workers would inherit the motor client threads and their locks
+    app["export_pool"] = ProcessPoolExecutor(
+        EXPORT_WORKERS, mp_context=multiprocessing.get_context("spawn")
+    )
+
+    app["users"] = Users(
+        app,
+        {
+            "Random-Mover": User(app, bot=True, username="Random-Mover"),
+            "Fairy-Stockfish": User(app, bot=True, username="Fairy-Stockfish"),
+            "Discord-Relay": User(app, anon=True, username="Discord-Relay"),
+        },
+    )
+    # {username: title} of titled users for player lists
+    app["titles"] = {}
     app["users"]["Random-Mover"].online = True
     app["lobbysockets"] = {}  # one dict only! {user.username: user.tournament_sockets, ...}
     app["lobbychat"] = collections.deque([], MAX_CHAT_LINES)
@@ -157,6 +175,7 @@ async def init_state(app):
     app["tourneynames"] = {lang: {} for lang in LANGUAGES}
 
     app["tournaments"] = {}
+    app["tournament_clock"] = TournamentClock()
 
     # lichess allows 7 team message per week, so we will send one (comulative) per day only
     app["sent_lichess_team_msg"] = []
@@ -164,13 +183,19 @@ async def init_state(app):
     # one deque per tournament! {tournamentId: collections.deque([], MAX_CHAT_LINES), ...}
     app["tourneychat"] = {}
 
+    load_variant_info()
+
     app["seeks"] = {}
+    app["seek_feed"] = SeekFeed(app)
     app["games"] = {}
+    app["game_cache"] = GameCache()
     app["invites"] = {}
     app["game_channels"] = set()
     app["invite_channels"] = set()
-    app["highscore"] = {variant: ValueSortedDict(neg) for variant in VARIANTS}
-    app["crosstable"] = {}
+    app["highscore"] = Highscores(app)
+    app["crosstable"] = CrosstableCache(app["db"])
+    # {game id: result} of games finished while a rebuilt crosstable collection is swapped in
+    app["crosstable_swap"] = None
     app["shield"] = {}
     app["shield_owners"] = {}  # {variant: username, ...}
 
@@ -207,24 +232,65 @@ async def init_state(app):
     asyncio.create_task(BOT_task(ai, app))
     asyncio.create_task(BOT_task(rm, app))
 
-    # Configure translations and templating.
+    # Startup stage timings, reported by /api/ready
+    app["startup"] = {"ready": False, "stages": {}}
+
+    await run_stage(app, "translations", init_translations)
+
+    if app["db"] is None:
+        app["startup"]["ready"] = True
+        return
+
+    # Users are loaded on demand, idle ones are dropped from memory
+    asyncio.create_task(app["users"].evict_idle_task())
+
+    # Tournaments, titles, shield owners and highscores have to be in place
+    # before the server takes requests, the stages still run concurrently
+    await init_db_state(app)
+
+    # create test tournament
+    if 1:
+        pass
+        # from test_tournament import create_arena_test
+        # await create_arena_test(app)
+
+        # from test_tournament import create_dev_arena_tournament
+        # await create_dev_arena_tournament(app)
+
+
+async def run_stage(app, name, stage):
+    start = monotonic()
+    await stage(app)
+    elapsed = monotonic() - start
+    app["startup"]["stages"][name] = round(elapsed, 3)
+    log.info("Startup stage %s done in %.2f s", name, elapsed)
+
+
+def compile_translation(lang):
+    """Compile server.po to server.mo unless the .mo file is up to date"""
+    folder = os.path.join(os.path.dirname(__file__), "../lang/", lang, "LC_MESSAGES")
+    poname = os.path.join(folder, "server.po")
+    moname = os.path.join(folder, "server.mo")
+    if os.path.exists(moname) and os.path.getmtime(moname) >= os.path.getmtime(poname):
+        return
+
+    try:
+        with open(poname, "rb") as po_file:
+            po_lines = [line for line in po_file if line[:8] != b"#, fuzzy"]
+            mo = Msgfmt(po_lines).get()
+            with open(moname, "wb") as mo_file:
+                mo_file.write(mo)
+    except PoSyntaxError:
+        log.error("PoSyntaxError in %s", poname)
+
+
+async def init_translations(app):
+    """Configure translations and templating"""
+    await asyncio.gather(*(asyncio.to_thread(compile_translation, lang) for lang in LANGUAGES))
+
     app["gettext"] = {}
     app["jinja"] = {}
-    base = os.path.dirname(__file__)
     for lang in LANGUAGES:
-        # Generate compiled mo file
-        folder = os.path.join(base, "../lang/", lang, "LC_MESSAGES")
-        poname = os.path.join(folder, "server.po")
-        moname = os.path.join(folder, "server.mo")
-        try:
-            with open(poname, "rb") as po_file:
-                po_lines = [line for line in po_file if line[:8] != b"#, fuzzy"]
-                mo = Msgfmt(po_lines).get()
-                with open(moname, "wb") as mo_file:
-                    mo_file.write(mo)
-        except PoSyntaxError:
-            log.error("PoSyntaxError in %s", poname)
-
         # Create translation class
         try:
             translation = gettext.translation("server", localedir="lang", languages=[lang])
@@ -257,82 +323,87 @@ async def init_state(app):
                 tname = translated_tournament_name(variant, SHIELD, ARENA, translation)
                 app["tourneynames"][lang][(variant, SHIELD, ARENA)] = tname
 
-    if app["db"] is None:
-        return
 
-    # Read tournaments, users and highscore from db
-    try:
-        cursor = app["db"].user.find()
-        async for doc in cursor:
-            if doc["_id"] not in app["users"]:
-                perfs = doc.get("perfs")
-                if perfs is None:
-                    perfs = {variant: DEFAULT_PERF for variant in VARIANTS}
-
-                app["users"][doc["_id"]] = User(
-                    app,
-                    username=doc["_id"],
-                    title=doc.get("title"),
-                    bot=doc.get("title") == "BOT",
-                    perfs=perfs,
-                    enabled=doc.get("enabled", True),
-                    lang=doc.get("lang", "en"),
-                )
-
-        await app["db"].tournament.create_index("startsAt")
-        await app["db"].tournament.create_index("status")
-
-        cursor = app["db"].tournament.find({"$or": [{"status": T_STARTED}, {"status": T_CREATED}]})
-        cursor.sort("startsAt", -1)
-        to_date = (datetime.now() + timedelta(days=SCHEDULE_MAX_DAYS)).date()
-        async for doc in cursor:
-            if doc["status"] == T_STARTED or (
-                doc["status"] == T_CREATED and doc["startsAt"].date() <= to_date
-            ):
-                await load_tournament(app, doc["_id"])
-
-        already_scheduled = await get_scheduled_tournaments(app)
-        new_tournaments_data = new_scheduled_tournaments(already_scheduled)
-        await create_scheduled_tournaments(app, new_tournaments_data)
-
-        asyncio.create_task(generate_shield(app))
-
-        db_collections = await app["db"].list_collection_names()
-
-        # if "highscore" not in db_collections:
-        # Always create new highscore lists on server start
-        hs = await generate_highscore(app["db"])
-        for doc in hs:
-            app["highscore"][doc["_id"]] = ValueSortedDict(neg, doc["scores"])
-
-        if "crosstable" not in db_collections:
-            await generate_crosstable(app["db"])
-        cursor = app["db"].crosstable.find()
-        async for doc in cursor:
-            app["crosstable"][doc["_id"]] = doc
-
-        await app["db"].game.create_index("us")
-        await app["db"].game.create_index("v")
-        await app["db"].game.create_index("y")
-        await app["db"].game.create_index("by")
-
-        if "video" not in db_collections:
-            if DEV:
-                await app["db"].video.drop()
-            await app["db"].video.insert_many(VIDEOS)
+async def init_titles(app):
+    await app["db"].user.create_index("title", sparse=True)
+    cursor = app["db"].user.find({"title": {"$nin": [None, ""]}}, {"title": 1})
+    async for doc in cursor:
+        app["titles"][doc["_id"]] = doc["title"]
+
+
+async def init_tournaments(app):
+    await app["db"].tournament.create_index("startsAt")
+    await app["db"].tournament.create_index("status")
+
+    cursor = app["db"].tournament.find({"$or": [{"status": T_STARTED}, {"status": T_CREATED}]})
+    cursor.sort("startsAt", -1)
+    to_date = (datetime.now() + timedelta(days=SCHEDULE_MAX_DAYS)).date()
+    async for doc in cursor:
+        if doc["status"] == T_STARTED or (
+            doc["status"] == T_CREATED and doc["startsAt"].date() <= to_date
+        ):
+            await load_tournament(app, doc["_id"])
+
+    already_scheduled = await get_scheduled_tournaments(app)
+    new_tournaments_data = new_scheduled_tournaments(already_scheduled)
+    await create_scheduled_tournaments(app, new_tournaments_data)
+
+
+async def init_highscore(app):
+    await app["highscore"].load()
+
+
+async def init_crosstable(app):
+    # Crosstables are loaded on demand, only (re)build the collection when it's missing
+    # or a previous rebuild was interrupted
+    db = app["db"]
+    db_collections = await db.list_collection_names()
+    checkpoint = await db.checkpoint.find_one({"_id": CROSSTABLE_CHECKPOINT_ID})
+    if "crosstable" not in db_collections or checkpoint is not None:
+        asyncio.create_task(rebuild_crosstable(app))
 
+
+async def rebuild_crosstable(app):
+    try:
+        await generate_crosstable(app["db"], app=app)
     except Exception:
-        print("Maybe mongodb is not running...")
-        raise
+        log.exception("Failed to rebuild crosstable")
 
-    # create test tournament
-    if 1:
-        pass
-        # from test_tournament import create_arena_test
-        # await create_arena_test(app)
 
-        # from test_tournament import create_dev_arena_tournament
-        # await create_dev_arena_tournament(app)
+async def init_game_indexes(app):
+    keys = ("us", "v", "y", "by", [("d", 1), ("_id", 1)])
+    await asyncio.gather(*(app["db"].game.create_index(key) for key in keys))
+
+
+async def init_videos(app):
+    db_collections = await app["db"].list_collection_names()
+    if "video" not in db_collections:
+        if DEV:
+            await app["db"].video.drop()
+        await app["db"].video.insert_many(VIDEOS)
+
+
+# Independent startup stages reading the db, they run concurrently
+DB_STAGES = (
+    ("titles", init_titles),
+    ("tournaments", init_tournaments),
+    ("shields", generate_shield),
+    ("highscore", init_highscore),
+    ("crosstable", init_crosstable),
+    ("game_indexes", init_game_indexes),
+    ("videos", init_videos),
+)
+
+
+async def init_db_state(app):
+    try:
+        await asyncio.gather(*(run_stage(app, name, stage) for name, stage in DB_STAGES))
+    except Exception:
+        log.exception("Maybe mongodb is not running...")
+        return
+
+    app["startup"]["ready"] = True
+    log.info("Server is ready, startup stages: %s", app["startup"]["stages"])
 
 
 async def shutdown(app):
@@ -364,10 +435,12 @@ async def shutdown(app):
                 if not player.bot and game.id in player.game_sockets:
                     ws = player.game_sockets[game.id]
                     try:
-                        await ws.send_json(response)
+                        await send_json(ws, response)
                     except Exception:
                         print("Failed to send game %s abort to %s" % (game.id, player.username))
 
+    await flush_writers()
+
     # close lobbysockets
     for user in list(app["users"].values()):
         if not user.bot:
@@ -381,6 +454,13 @@ async def shutdown(app):
         for ws in list(ws_set):
             await ws.close()
 
+    app["tournament_clock"].stop()
+
+    # write out queued game, rating and tournament updates
+    await app["db_writer"].drain()
+
+    app["export_pool"].shutdown(wait=False, cancel_futures=True)
+
     if "client" in app:
         app["client"].close()
 
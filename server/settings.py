@@ -38,6 +38,9 @@ MAX_AGE = 3600 * 24 * 365
 MONGO_HOST = os.getenv("MONGO_HOST", "mongodb://127.0.0.1:27017")
 MONGO_DB_NAME = "pychess-variants"
 
+# processes making PGN exports
+EXPORT_WORKERS = int(os.getenv("EXPORT_WORKERS", "2"))
+
 BOT_TOKENS = json.loads(os.getenv("BOT_TOKENS", "{}"))
 FISHNET_KEYS = json.loads(os.getenv("FISHNET_KEYS", "{}"))
 
@@ -0,0 +1,154 @@
+import zlib
+from array import array
+from collections import namedtuple
+
+# flag bits of a step
+CHECK = 1
+BLACK_TO_MOVE = 2
+
+# clock value of steps without clock times (e.g. loaded casual games)
+NO_CLOCK = -1
+
+# version of the step snapshots saved with finished games
+SNAPSHOT_VERSION = 2
+
+StepSnapshot = namedtuple("StepSnapshot", "sans, flags")
+
+
+def read_snapshot(snapshot):
+    """Unpack a snapshot made by Steps.snapshot(), None if it has an unknown version"""
+    if snapshot.get("v") != SNAPSHOT_VERSION:
+        return None
+    flags = zlib.decompress(snapshot["f"])
+    sans = zlib.decompress(snapshot["d"]).decode().split("\n") if len(flags) > 1 else []
+    return StepSnapshot(sans, flags)
+
+
+class PackedStrings:
+    """Append only list of strings kept in a single buffer"""
+
+    __slots__ = "data", "ends"
+
+    def __init__(self):
+        self.data = bytearray()
+        self.ends = array("L")
+
+    def __len__(self):
+        return len(self.ends)
+
+    def __getitem__(self, i):
+        if i < 0:
+            i += len(self.ends)
+        start = self.ends[i - 1] if i > 0 else 0
+        return self.data[start : self.ends[i]].decode()
+
+    def __setitem__(self, i, text):
+        start = self.ends[i - 1] if i > 0 else 0
+        end = self.ends[i]
+        encoded = text.encode()
+        self.data[start:end] = encoded
+        delta = len(encoded) - (end - start)
+        for j in range(i, len(self.ends)):
+            self.ends[j] += delta
+
+    def append(self, text):
+        self.data += text.encode()
+        self.ends.append(len(self.data))
+
+
+class Steps:
+    """Game steps (the position after every ply) stored column-wise.
+    Indexing and iterating give the same step dicts the client gets in board messages.
+    Moves are not stored again, they are read from the board move stack."""
+
+    __slots__ = "moves", "fens", "sans", "flags", "wclocks", "bclocks", "annotations"
+
+    def __init__(self, move_stack, fen, turn_color, check, clocks):
+        self.moves = move_stack
+        self.fens = PackedStrings()
+        self.sans = PackedStrings()
+        self.flags = bytearray()
+        self.wclocks = array("l")
+        self.bclocks = array("l")
+        # sparse {ply: {"analysis": ..., "eval": ...}}
+        self.annotations = {}
+        self.append(fen, "", turn_color, check, clocks)
+
+    def append(self, fen, san, turn_color, check, clocks=None):
+        self.fens.append(fen)
+        self.sans.append(san)
+        self.flags.append((CHECK if check else 0) | (BLACK_TO_MOVE if turn_color == "black" else 0))
+        # clock times are kept in whole milliseconds
+        self.wclocks.append(NO_CLOCK if clocks is None else round(clocks["white"]))
+        self.bclocks.append(NO_CLOCK if clocks is None else round(clocks["black"]))
+
+    def __len__(self):
+        return len(self.flags)
+
+    def __getitem__(self, ply):
+        if ply < 0:
+            ply += len(self.flags)
+        if not 0 <= ply < len(self.flags):
+            raise IndexError("step index out of range")
+
+        flags = self.flags[ply]
+        step = {"fen": self.fens[ply]}
+        if ply > 0:
+            step["move"] = self.moves[ply - 1]
+        step["san"] = self.sans[ply] if ply > 0 else None
+        step["turnColor"] = "black" if flags & BLACK_TO_MOVE else "white"
+        step["check"] = bool(flags & CHECK)
+        if self.wclocks[ply] != NO_CLOCK:
+            step["clocks"] = {"white": self.wclocks[ply], "black": self.bclocks[ply]}
+        if ply in self.annotations:
+            step.update(self.annotations[ply])
+        return step
+
+    def __iter__(self):
+        return (self[ply] for ply in range(len(self.flags)))
+
+    def snapshot(self):
+        """Compact form of the steps saved with finished games, so loading them needs no
+        get_san() and is_checked() engine calls. Moves are decoded from the "m" field and
+        FENs are computed again, clock times and analysis have their own fields as well."""
+        sans = "\n".join(self.sans[ply] for ply in range(1, len(self.flags)))
+        return {
+            "v": SNAPSHOT_VERSION,
+            "d": zlib.compress(sans.encode()),
+            "f": zlib.compress(bytes(self.flags)),
+        }
+
+    def set_fen(self, ply, fen):
+        self.fens[ply] = fen
+
+    def clocks(self, ply):
+        if self.wclocks[ply] == NO_CLOCK:
+            return None
+        return {"white": self.wclocks[ply], "black": self.bclocks[ply]}
+
+    def last_clocks(self):
+        """Clock times of the latest step having them"""
+        ply = len(self.flags) - 1
+        while self.wclocks[ply] == NO_CLOCK:
+            ply -= 1
+        return self.clocks(ply)
+
+    def set_clock(self, ply, color, clock):
+        if color == "white":
+            self.wclocks[ply] = round(clock)
+        else:
+            self.bclocks[ply] = round(clock)
+
+    def annotate(self, ply, key, value):
+        if ply < 0:
+            ply += len(self.flags)
+        self.annotations.setdefault(ply, {})[key] = value
+
+    def annotation(self, ply, key):
+        if ply < 0:
+            ply += len(self.flags)
+        return self.annotations.get(ply, {}).get(key)
+
+    def remove_annotations(self, key):
+        for annotation in self.annotations.values():
+            annotation.pop(key, None)
@@ -1,27 +1,103 @@
-import random
-
 from const import SWISS
-from tournament import Tournament, ByeGame
+from dutch import SwissPlayer, dutch_pairing, WHITE, BLACK
+from tournament import Tournament, ByeGame, SCORE_SHIFT
+
+# Leaderboard value of a Swiss player is
+# SCORE_SHIFT * score + BUCHHOLZ_SHIFT * Buchholz + Sonneborn-Berger
+BUCHHOLZ_SHIFT = 300
+MAX_BUCHHOLZ = (SCORE_SHIFT - 1) // BUCHHOLZ_SHIFT - 1
+
+
+def player_score(player_data):
+    return sum(point[0] for point in player_data.points if point not in ("-", "*"))
+
+
+def game_result(game, user):
+    """2 for a win, 1 for a draw and 0 for a loss of user, None for unfinished games"""
+    if game.result == "1/2-1/2":
+        return 1
+    if game.result == "1-0":
+        return 2 if game.wplayer == user else 0
+    if game.result == "0-1":
+        return 0 if game.wplayer == user else 2
+    return None
+
+
+def tiebreaks(results, scores):
+    """Buchholz and Sonneborn-Berger of every player
+    results: {player: [(opponent, result), ...]} where result is 2/1/0 for win/draw/loss
+    scores: {player: score}"""
+    return {
+        player: (
+            sum(scores[opp] for opp, result in player_results),
+            sum(scores[opp] * result for opp, result in player_results) // 2,
+        )
+        for player, player_results in results.items()
+    }
 
 
 class SwissTournament(Tournament):
     system = SWISS
 
-    def create_pairing(self, waiting_players):
-        pairing = []
+    def played_games(self, user):
+        return [
+            game
+            for game in self.players[user].games
+            if not isinstance(game, ByeGame) and game_result(game, user) is not None
+        ]
+
+    def update_tiebreaks(self):
+        results = {
+            user: [
+                (game.bplayer if game.wplayer == user else game.wplayer, game_result(game, user))
+                for game in self.played_games(user)
+            ]
+            for user in self.leaderboard
+        }
+        scores = {user: player_score(player) for user, player in self.players.items()}
 
-        # TODO: use bbpPairings instead of random pairings
-        while len(waiting_players) > 1:
-            wp = random.choice(waiting_players)
-            waiting_players.remove(wp)
+        changed = {}
+        for user, (buchholz, sb) in tiebreaks(results, scores).items():
+            value = (
+                SCORE_SHIFT * scores[user]
+                + BUCHHOLZ_SHIFT * min(buchholz, MAX_BUCHHOLZ)
+                + min(sb, BUCHHOLZ_SHIFT - 1)
+            )
+            if self.leaderboard[user] != value:
+                changed[user] = value
+        self.leaderboard.update(changed)
 
-            bp = random.choice(waiting_players)
-            waiting_players.remove(bp)
+    async def game_update(self, game):
+        await Tournament.game_update(self, game)
+        self.update_tiebreaks()
+
+    async def finalize(self, status):
+        self.update_tiebreaks()
+        await Tournament.finalize(self, status)
+
+    def create_pairing(self, waiting_players):
+        # pairing numbers come from the ratings
+        by_rating = sorted(waiting_players, key=lambda user: -self.players[user].rating)
+        players = {}
+        for rank, user in enumerate(by_rating, start=1):
+            player = self.players[user]
+            games = self.played_games(user)
+            players[user] = SwissPlayer(
+                user,
+                rank,
+                score=player_score(player),
+                colors=[WHITE if game.wplayer == user else BLACK for game in games],
+                opponents=[
+                    game.bplayer if game.wplayer == user else game.wplayer for game in games
+                ],
+                had_bye="-" in player.points,
+            )
 
-            pairing.append((wp, bp))
+        pairs, bye = dutch_pairing(players.values())
+        pairing = [(wp.id, bp.id) for wp, bp in pairs]
 
-        if len(waiting_players) == 1:
-            self.players[waiting_players[0]].games.append(ByeGame())
-            self.players[waiting_players[0]].points.append("-")
+        if bye is not None:
+            self.players[bye.id].games.append(ByeGame())
+            self.players[bye.id].points.append("-")
 
         return pairing
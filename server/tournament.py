@@ -3,6 +3,7 @@ import asyncio
 import collections
 import logging
 import random
+import time
 from abc import ABC, abstractmethod
 from datetime import datetime, timedelta, timezone
 from operator import neg
@@ -11,7 +12,8 @@ from sortedcollections import ValueSortedDict
 from sortedcontainers import SortedKeysView
 from pymongo import ReturnDocument
 
-from broadcast import lobby_broadcast, discord_message
+from broadcast import lobby_broadcast, discord_message, fan_out, json_dumps, send_json
+from clock import estimate_game_time
 from compress import R2C
 from const import (
     ABORTED,
@@ -52,6 +54,16 @@ SCORE_SHIFT = 100000
 NOTIFY1_MINUTES = 60 * 6
 NOTIFY2_MINUTES = 10
 
+# Arena pairing wave limits in seconds
+MIN_WAVE = 1
+MAX_WAVE = 10
+# The longest wave is this part of the estimated game time
+WAVE_GAME_TIME_DIVISOR = 40
+# Below this many waiting players the longest wave is used
+FEW_WAITING_PLAYERS = 4
+# Waves are at least this many times longer than the last create_pairing()
+PAIRING_COST_FACTOR = 5
+
 Point = Tuple[int, int]
 
 
@@ -233,11 +245,10 @@ class Tournament(ABC):
         else:
             self.starts_at = starts_at
 
-        # TODO: calculate wave from TC, variant, number of players
-        self.wave = timedelta(seconds=3)
-        self.wave_delta = timedelta(seconds=1)
+        self.pairing_cost = 0.0
+        self.adapt_wave(0)
         self.current_round = 0
-        self.prev_pairing = None
+        self.next_wave = None
 
         self.messages = collections.deque([], MAX_CHAT_LINES)
         self.spectators = set()
@@ -269,8 +280,11 @@ class Tournament(ABC):
         else:
             self.ends_at = self.starts_at + timedelta(minutes=minutes)
 
+        # resolved when the clock of the tournament stopped
+        self.clock_done = None
         if with_clock:
-            self.clock_task = asyncio.create_task(self.clock())
+            self.clock_done = asyncio.get_running_loop().create_future()
+            app["tournament_clock"].schedule(self, datetime.now(timezone.utc))
 
         self.browser_title = "%s Tournament • %s" % (
             variant_display_name(self.variant),
@@ -372,6 +386,9 @@ class Tournament(ABC):
     # TODO: cache this
     def games_json(self, player_name):
         player = self.app["users"].get(player_name)
+        if player not in self.players:
+            # players of finished tournaments may have been reloaded since
+            player = next(p for p in self.players if p.username == player_name)
         return {
             "type": "get_games",
             "rank": self.leaderboard.index(player) + 1,
@@ -406,6 +423,18 @@ class Tournament(ABC):
             "lastMove": self.top_game.lastmove,
         }
 
+    def adapt_wave(self, nb_waiting_players):
+        """Set the arena pairing wave from the time control, the number of waiting players
+        and the cost of the last pairing. Many waiting players are paired sooner,
+        few of them wait longer for others to finish their games."""
+        longest = estimate_game_time(self.base, self.inc) / WAVE_GAME_TIME_DIVISOR
+        longest = min(MAX_WAVE, max(MIN_WAVE, longest))
+        wave = longest * FEW_WAITING_PLAYERS / max(nb_waiting_players, 1)
+        wave = max(MIN_WAVE, min(longest, wave), PAIRING_COST_FACTOR * self.pairing_cost)
+
+        self.wave = timedelta(seconds=wave)
+        self.wave_delta = self.wave / 3
+
     def waiting_players(self):
         return [
             p
@@ -417,97 +446,117 @@ class Tournament(ABC):
             and not self.players[p].withdrawn
         ]
 
-    async def clock(self):
+    def wake(self):
+        """Run clock_tick() now instead of at the next scheduled event"""
+        if self.clock_done is not None:
+            self.app["tournament_clock"].wake(self)
+
+    def stop_clock(self):
+        if self.clock_done is not None and not self.clock_done.done():
+            self.clock_done.set_result(None)
+
+    async def clock_tick(self, now):
+        """Called by the shared TournamentClock. Do what is due at now and return
+        the time of the next event, or None when only wake() can bring one."""
         try:
-            while self.status not in (T_ABORTED, T_FINISHED, T_ARCHIVED):
-                now = datetime.now(timezone.utc)
+            return await self.clock_event(now)
+        except Exception:
+            log.exception("Exception in tournament clock_tick()")
+            self.stop_clock()
+            return None
 
-                if self.status == T_CREATED:
-                    remaining_time = self.starts_at - now
-                    remaining_mins_to_start = int(
-                        ((remaining_time.days * 3600 * 24) + remaining_time.seconds) / 60
+    async def clock_event(self, now):
+        if self.status in (T_ABORTED, T_FINISHED, T_ARCHIVED):
+            self.stop_clock()
+            return None
+
+        if self.status == T_CREATED:
+            remaining_time = self.starts_at - now
+            remaining_mins_to_start = int(
+                ((remaining_time.days * 3600 * 24) + remaining_time.seconds) / 60
+            )
+            if now >= self.starts_at:
+                if self.system != ARENA and len(self.players) < 3:
+                    # Swiss and RR Tournaments need at least 3 players to start
+                    await self.abort()
+                    print("T_ABORTED: less than 3 player joined")
+                    return None
+
+                await self.start(now)
+                return now
+
+            elif (not self.notify2) and remaining_mins_to_start <= NOTIFY2_MINUTES:
+                self.notify1 = True
+                self.notify2 = True
+                await discord_message(
+                    self.app,
+                    "notify_tournament",
+                    self.notify_discord_msg(remaining_mins_to_start),
+                )
+                return now
+
+            elif (not self.notify1) and remaining_mins_to_start <= NOTIFY1_MINUTES:
+                self.notify1 = True
+                await discord_message(
+                    self.app,
+                    "notify_tournament",
+                    self.notify_discord_msg(remaining_mins_to_start),
+                )
+                asyncio.create_task(lichess_team_msg(self.app))
+                return now
+
+            # first moment when the remaining whole minutes reach the notify limits
+            events = [self.starts_at]
+            if not self.notify2:
+                events.append(self.starts_at - timedelta(minutes=NOTIFY2_MINUTES + 1, seconds=-1))
+            if not self.notify1:
+                events.append(self.starts_at - timedelta(minutes=NOTIFY1_MINUTES + 1, seconds=-1))
+            return min(events)
+
+        elif (self.minutes is not None) and now >= self.ends_at:
+            await self.finish()
+            print("T_FINISHED: no more time left")
+            return None
+
+        elif self.status == T_STARTED:
+            ends_at = self.ends_at if self.minutes is not None else None
+
+            if self.system == ARENA:
+                # In case of server restart
+                if self.next_wave is None:
+                    self.next_wave = now
+
+                if now >= self.next_wave:
+                    waiting_players = self.waiting_players()
+                    nb_waiting_players = len(waiting_players)
+                    if nb_waiting_players >= 2:
+                        log.debug("Enough player (%s), do pairing", nb_waiting_players)
+                        await self.create_new_pairings(waiting_players)
+                    else:
+                        log.debug("Too few player (%s) to make pairing", nb_waiting_players)
+                    # Players waiting now tell how fast games end, the next wave
+                    # comes sooner when many, later when few of them were waiting
+                    self.adapt_wave(nb_waiting_players)
+                    self.next_wave = (
+                        now + self.wave + random.uniform(-self.wave_delta, self.wave_delta)
                     )
-                    if now >= self.starts_at:
-                        if self.system != ARENA and len(self.players) < 3:
-                            # Swiss and RR Tournaments need at least 3 players to start
-                            await self.abort()
-                            print("T_ABORTED: less than 3 player joined")
-                            break
-
-                        await self.start(now)
-                        continue
-
-                    elif (not self.notify2) and remaining_mins_to_start <= NOTIFY2_MINUTES:
-                        self.notify1 = True
-                        self.notify2 = True
-                        await discord_message(
-                            self.app,
-                            "notify_tournament",
-                            self.notify_discord_msg(remaining_mins_to_start),
-                        )
-                        continue
-
-                    elif (not self.notify1) and remaining_mins_to_start <= NOTIFY1_MINUTES:
-                        self.notify1 = True
-                        await discord_message(
-                            self.app,
-                            "notify_tournament",
-                            self.notify_discord_msg(remaining_mins_to_start),
-                        )
-                        asyncio.create_task(lichess_team_msg(self.app))
-                        continue
-
-                elif (self.minutes is not None) and now >= self.ends_at:
+
+                return self.next_wave if ends_at is None else min(self.next_wave, ends_at)
+
+            elif self.ongoing_games == 0:
+                if self.current_round < self.rounds:
+                    self.current_round += 1
+                    log.debug("Do %s. round pairing", self.current_round)
+                    waiting_players = self.waiting_players()
+                    await self.create_new_pairings(waiting_players)
+                    # delayed_free() wakes us up when the last game of the round ends
+                    return now if self.ongoing_games == 0 else ends_at
+                else:
                     await self.finish()
-                    print("T_FINISHED: no more time left")
-                    break
-
-                elif self.status == T_STARTED:
-                    if self.system == ARENA:
-                        # In case of server restart
-                        if self.prev_pairing is None:
-                            self.prev_pairing = now - self.wave
-
-                        if now >= self.prev_pairing + self.wave + random.uniform(
-                            -self.wave_delta, self.wave_delta
-                        ):
-                            waiting_players = self.waiting_players()
-                            nb_waiting_players = len(waiting_players)
-                            if nb_waiting_players >= 2:
-                                log.debug("Enough player (%s), do pairing", nb_waiting_players)
-                                await self.create_new_pairings(waiting_players)
-                                self.prev_pairing = now
-                            else:
-                                log.debug(
-                                    "Too few player (%s) to make pairing",
-                                    nb_waiting_players,
-                                )
-                        else:
-                            log.debug("Waiting for new pairing wave...")
-
-                    elif self.ongoing_games == 0:
-                        if self.current_round < self.rounds:
-                            self.current_round += 1
-                            log.debug("Do %s. round pairing", self.current_round)
-                            waiting_players = self.waiting_players()
-                            await self.create_new_pairings(waiting_players)
-                        else:
-                            await self.finish()
-                            log.debug("T_FINISHED: no more round left")
-                            break
-                    else:
-                        print(
-                            "%s has %s ongoing game(s)..."
-                            % (
-                                "RR" if self.system == RR else "Swiss",
-                                self.ongoing_games,
-                            )
-                        )
-
-                    log.debug("%s CLOCK %s", self.id, now.strftime("%H:%M:%S"))
-                await asyncio.sleep(1)
-        except Exception:
-            log.exception("Exception in tournament clock()")
+                    log.debug("T_FINISHED: no more round left")
+                    return None
+
+            return ends_at
 
     async def start(self, now):
         self.status = T_STARTED
@@ -524,7 +573,7 @@ class Tournament(ABC):
 
         # force first pairing wave in arena
         if self.system == ARENA:
-            self.prev_pairing = now - self.wave
+            self.next_wave = now
 
         if self.app["db"] is not None:
             print(
@@ -581,6 +630,8 @@ class Tournament(ABC):
 
         await self.broadcast_spotlight()
 
+        self.stop_clock()
+
     async def broadcast_spotlight(self):
         spotlights = tournament_spotlights(self.app)
         lobby_sockets = self.app["lobbysockets"]
@@ -659,7 +710,9 @@ class Tournament(ABC):
         self.spectators.discard(spectator)
 
     async def create_new_pairings(self, waiting_players):
+        start = time.monotonic()
         pairing = self.create_pairing(waiting_players)
+        self.pairing_cost = time.monotonic() - start
 
         if self.first_pairing:
             self.first_pairing = False
@@ -714,6 +767,7 @@ class Tournament(ABC):
 
             games.append(game)
             self.app["games"][game_id] = game
+            await game.load_crosstable()
             await insert_game_to_db(game, self.app)
 
             # TODO: save new game to db
@@ -762,7 +816,7 @@ class Tournament(ABC):
             try:
                 ws = next(iter(wp.tournament_sockets[self.id]))
                 if ws is not None:
-                    await ws.send_json(response)
+                    await send_json(ws, response)
             except Exception:
                 self.pause(wp)
                 log.debug("White player %s left the tournament", wp.username)
@@ -770,7 +824,7 @@ class Tournament(ABC):
             try:
                 ws = next(iter(bp.tournament_sockets[self.id]))
                 if ws is not None:
-                    await ws.send_json(response)
+                    await send_json(ws, response)
             except Exception:
                 self.pause(bp)
                 log.debug("Black player %s left the tournament", bp.username)
@@ -958,7 +1012,7 @@ class Tournament(ABC):
         wplayer.rating = game.white_rating.rating_prov[0] + (int(game.wrdiff) if game.wrdiff else 0)
         bplayer.rating = game.black_rating.rating_prov[0] + (int(game.brdiff) if game.brdiff else 0)
 
-        # TODO: in Swiss we will need Berger instead of performance to calculate tie breaks
+        # Swiss tournaments replace performance with Buchholz/Sonneborn-Berger tie breaks
         nb = wplayer.nb_games
         wplayer.performance = int(round((wplayer.performance * (nb - 1) + wperf) / nb, 0))
 
@@ -987,9 +1041,9 @@ class Tournament(ABC):
         asyncio.create_task(self.delayed_free(game, wplayer, bplayer))
 
         # save player points to db
-        asyncio.create_task(self.db_update_player(game.wplayer, wplayer))
-        asyncio.create_task(self.db_update_player(game.bplayer, bplayer))
-        asyncio.create_task(self.db_update_pairing(game))
+        await self.db_update_player(game.wplayer, wplayer)
+        await self.db_update_player(game.bplayer, bplayer)
+        self.db_update_pairing(game)
 
         self.set_top_player()
 
@@ -1037,19 +1091,19 @@ class Tournament(ABC):
 
         self.ongoing_games -= 1
 
+        if self.system != ARENA and self.ongoing_games == 0:
+            # the round is over
+            self.wake()
+
     async def broadcast(self, response):
+        sockets = []
         for spectator in self.spectators:
-            try:
-                for ws in spectator.tournament_sockets[self.id]:
-                    try:
-                        await ws.send_json(response)
-                    except ConnectionResetError:
-                        pass
-            except KeyError:
-                # spectator was removed
-                pass
-            except Exception:
-                log.exception("Exception in tournament broadcast()")
+            # spectator may have been removed
+            sockets.extend(spectator.tournament_sockets.get(self.id, ()))
+        try:
+            await fan_out(sockets, json_dumps(response))
+        except Exception:
+            log.exception("Exception in tournament broadcast()")
 
     async def db_insert_pairing(self, games):
         if self.app["db"] is None:
@@ -1077,32 +1131,16 @@ class Tournament(ABC):
         if len(pairing_documents) > 0:
             await pairing_table.insert_many(pairing_documents)
 
-    async def db_update_pairing(self, game):
+    def db_update_pairing(self, game):
         if self.app["db"] is None:
             return
-        pairing_table = self.app["db"].tournament_pairing
 
-        try:
-            new_data = {
-                "r": R2C[game.result],
-                "wb": game.wberserk,
-                "bb": game.bberserk,
-            }
-
-            print(
-                await pairing_table.find_one_and_update(
-                    {"_id": game.id},
-                    {"$set": new_data},
-                    return_document=ReturnDocument.AFTER,
-                )
-            )
-        except Exception:
-            if self.app["db"] is not None:
-                log.error(
-                    "db find_one_and_update pairing_table %s into %s failed !!!",
-                    game.id,
-                    self.id,
-                )
+        new_data = {
+            "r": R2C[game.result],
+            "wb": game.wberserk,
+            "bb": game.bberserk,
+        }
+        self.app["db_writer"].update("tournament_pairing", game.id, new_data)
 
     async def db_update_player(self, user, player_data):
         if self.app["db"] is None:
@@ -1138,31 +1176,11 @@ class Tournament(ABC):
                 "wd": False,
             }
 
-        try:
-            print(
-                await player_table.find_one_and_update(
-                    {"_id": player_id},
-                    {"$set": new_data},
-                    upsert=True,
-                    return_document=ReturnDocument.AFTER,
-                )
-            )
-        except Exception:
-            if self.app["db"] is not None:
-                log.error(
-                    "db find_one_and_update tournament_player %s into %s failed !!!",
-                    player_id,
-                    self.id,
-                )
+        db_writer = self.app["db_writer"]
+        db_writer.update("tournament_player", player_id, new_data, upsert=True)
 
         new_data = {"nbPlayers": self.nb_players, "nbBerserk": self.nb_berserk}
-        print(
-            await self.app["db"].tournament.find_one_and_update(
-                {"_id": self.id},
-                {"$set": new_data},
-                return_document=ReturnDocument.AFTER,
-            )
-        )
+        db_writer.update("tournament", self.id, new_data)
 
     async def save(self):
         if self.app["db"] is None:
@@ -0,0 +1,93 @@
+import asyncio
+import heapq
+import itertools
+import logging
+from datetime import datetime, timezone
+
+log = logging.getLogger(__name__)
+
+
+class TournamentClock:
+    """One timer task for all tournaments.
+    Tournament.clock_tick() does what is due and returns the time of its next event
+    (notification, start, pairing wave, end). The clock sleeps until the earliest one,
+    so tournaments waiting for their start cost nothing meanwhile."""
+
+    def __init__(self):
+        # heap of (when, seq, tournament), entries not in next_run are stale
+        self.timers = []
+        # {tournament id: (when, seq)}
+        self.next_run = {}
+        # {tournament id: earliest wake up requested while its tick is running}
+        self.running = {}
+        self.counter = itertools.count()
+        self.task = None
+        # set when a new timer became the earliest one
+        self.wakeup = asyncio.Event()
+
+    def schedule(self, tournament, when):
+        """Run tournament.clock_tick() at when, or earlier if it's already scheduled so"""
+        tid = tournament.id
+        if tid in self.running:
+            requested = self.running[tid]
+            self.running[tid] = when if requested is None else min(requested, when)
+            return
+
+        current = self.next_run.get(tid)
+        if current is not None and current[0] <= when:
+            return
+
+        seq = next(self.counter)
+        self.next_run[tid] = (when, seq)
+        heapq.heappush(self.timers, (when, seq, tournament))
+
+        if self.task is None or self.task.done():
+            self.task = asyncio.create_task(self.run())
+        elif self.timers[0][1] == seq:
+            self.wakeup.set()
+
+    def wake(self, tournament):
+        self.schedule(tournament, datetime.now(timezone.utc))
+
+    def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+
+    async def run(self):
+        while True:
+            while self.timers and self.next_run.get(self.timers[0][2].id) != self.timers[0][:2]:
+                heapq.heappop(self.timers)
+
+            if not self.timers:
+                await self.wakeup.wait()
+                self.wakeup.clear()
+                continue
+
+            now = datetime.now(timezone.utc)
+            when, seq, tournament = self.timers[0]
+            if when > now:
+                try:
+                    await asyncio.wait_for(self.wakeup.wait(), (when - now).total_seconds())
+                except asyncio.TimeoutError:
+                    pass
+                self.wakeup.clear()
+                continue
+
+            heapq.heappop(self.timers)
+            del self.next_run[tournament.id]
+            self.running[tournament.id] = None
+            # ticks may wait for the db, they must not hold up the other tournaments
+            asyncio.create_task(self.tick(tournament, now))
+
+    async def tick(self, tournament, now):
+        try:
+            when = await tournament.clock_tick(now)
+        except Exception:
+            log.exception("Exception in tournament clock_tick()")
+            when = None
+
+        requested = self.running.pop(tournament.id)
+        if requested is not None:
+            when = requested if when is None else min(when, requested)
+        if when is not None:
+            self.schedule(tournament, when)
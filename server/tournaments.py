@@ -419,9 +419,8 @@ async def load_tournament(app, tournament_id, tournament_klass=None):
 
     async for doc in cursor:
         uid = doc["uid"]
-        if uid in users:
-            user = users[uid]
-        else:
+        user = await users.load(uid)
+        if user is None:
             user = User(app, username=uid, title="TEST" if tournament_id == "12345678" else "")
             users[uid] = user
 
@@ -503,6 +502,9 @@ async def load_tournament(app, tournament_id, tournament_klass=None):
     tournament.draw = draw
     tournament.nb_berserk = berserk
 
+    if tournament.system == SWISS:
+        tournament.update_tiebreaks()
+
     return tournament
 
 
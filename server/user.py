@@ -1,19 +1,22 @@
 import asyncio
 import logging
 from datetime import datetime, timezone
+from time import monotonic
 
-from const import VARIANTS
-from broadcast import lobby_broadcast
+from const import T_CREATED, T_STARTED, VARIANTS
 from glicko2.glicko2 import gl2, DEFAULT_PERF, Rating
 from login import RESERVED_USERS
 from newid import id8
-from seek import get_seeks
 
 log = logging.getLogger(__name__)
 
 SILENCE = 10 * 60
 ANON_TIMEOUT = 10 * 60
 
+# Registered users not used for USER_IDLE_TIME sec are dropped from memory
+USER_IDLE_TIME = 60 * 60
+USER_EVICT_INTERVAL = 10 * 60
+
 
 class MissingRatingsException(Exception):
     pass
@@ -55,6 +58,7 @@ class User:
             self.title = "BOT"
 
         self.online = False
+        self.last_seen = monotonic()
 
         if perfs is None:
             if (not anon) and (not bot) and (title != "TEST"):
@@ -97,6 +101,7 @@ class User:
             or len(self.lobby_sockets) > 0
             or len(self.tournament_sockets) > 0
         )
+        self.last_seen = monotonic()
 
     def get_rating(self, variant: str, chess960: bool) -> Rating:
         if variant in self.perfs:
@@ -121,16 +126,18 @@ class User:
             return
         gl = {"r": rating.mu, "d": rating.phi, "v": rating.sigma}
         la = datetime.now(timezone.utc)
-        nb = self.perfs[variant + ("960" if chess960 else "")].get("nb", 0)
-        self.perfs[variant + ("960" if chess960 else "")] = {
+        perf_key = variant + ("960" if chess960 else "")
+        nb = self.perfs[perf_key].get("nb", 0)
+        self.perfs[perf_key] = {
             "gl": gl,
             "la": la,
             "nb": nb + 1,
         }
 
+        # Only the changed variant, white and black updates are written in one bulk_write()
         if self.db is not None:
-            await self.db.user.find_one_and_update(
-                {"_id": self.username}, {"$set": {"perfs": self.perfs}}
+            self.app["db_writer"].update(
+                "user", self.username, {"perfs.%s" % perf_key: self.perfs[perf_key]}
             )
 
     def as_json(self, requester):
@@ -144,7 +151,6 @@ class User:
         has_seek = len(self.seeks) > 0
         if has_seek and (len(self.lobby_sockets) == 0 or force):
             seeks = self.app["seeks"]
-            sockets = self.app["lobbysockets"]
             for seek in self.seeks:
                 game_id = self.seeks[seek].game_id
                 # preserve invites (seek with game_id)!
@@ -152,7 +158,93 @@ class User:
                     del seeks[seek]
             self.seeks.clear()
 
-            await lobby_broadcast(sockets, get_seeks(seeks))
+            self.app["seek_feed"].changed()
 
     def __str__(self):
         return "%s %s bot=%s" % (self.title, self.username, self.bot)
+
+
+class Users(dict):
+    """Users in memory by username.
+    Registered users are loaded from the db on first use by load() instead of all at startup,
+    and evict_idle() drops the ones nobody needs for a while."""
+
+    def __init__(self, app, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.app = app
+
+    def add_doc(self, doc):
+        perfs = doc.get("perfs")
+        if perfs is None:
+            perfs = {variant: DEFAULT_PERF for variant in VARIANTS}
+
+        user = User(
+            self.app,
+            username=doc["_id"],
+            title=doc.get("title"),
+            bot=doc.get("title") == "BOT",
+            perfs=perfs,
+            enabled=doc.get("enabled", True),
+            lang=doc.get("lang", "en"),
+        )
+        self[user.username] = user
+        return user
+
+    async def load(self, username):
+        """Return the user from memory or from the db, None if there is no such user"""
+        user = self.get(username)
+        if user is not None:
+            user.last_seen = monotonic()
+            return user
+
+        db = self.app["db"]
+        if username is None or db is None or username.startswith("Anon-"):
+            return None
+
+        doc = await db.user.find_one({"_id": username})
+        if doc is None:
+            return None
+
+        # somebody else may have loaded it while we were waiting for the db
+        if username in self:
+            return self[username]
+        return self.add_doc(doc)
+
+    async def connected(self, username):
+        """Return the user of a (re)connected socket, guests are created when needed"""
+        user = await self.load(username)
+        if user is None:
+            user = User(self.app, username=username, anon=username.startswith("Anon-"))
+            self[user.username] = user
+        return user
+
+    def evict_idle(self):
+        """Drop offline registered users not playing, seeking or taking part in tournaments.
+        Players of games still in memory are kept as well, their Game objects refer to them."""
+        busy = set()
+        for games in (self.app["games"].values(), self.app["game_cache"].values()):
+            for game in games:
+                busy.add(game.wplayer.username)
+                busy.add(game.bplayer.username)
+        for tournament in self.app["tournaments"].values():
+            if tournament.status in (T_CREATED, T_STARTED):
+                busy.update(player.username for player in tournament.players)
+
+        idle_since = monotonic() - USER_IDLE_TIME
+        idle = [
+            username
+            for username, user in self.items()
+            if not (user.anon or user.bot or user.online or user.seeks)
+            and user.game_in_progress is None
+            and user.last_seen < idle_since
+            and username not in busy
+        ]
+        for username in idle:
+            del self[username]
+        return len(idle)
+
+    async def evict_idle_task(self):
+        while True:
+            await asyncio.sleep(USER_EVICT_INTERVAL)
+            evicted = self.evict_idle()
+            log.debug("Evicted %s idle users, %s users in memory", evicted, len(self))
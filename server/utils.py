@@ -13,7 +13,7 @@ except ImportError:
     print("No pyffish module installed!")
 
 from glicko2.glicko2 import gl2
-from broadcast import round_broadcast
+from broadcast import round_broadcast, send_json
 from const import (
     STARTED,
     VARIANT_960_TO_PGN,
@@ -26,13 +26,24 @@ from const import (
     CONSERVATIVE_CAPA_FEN,
     T_STARTED,
 )
-from compress import decode_moves, encode_moves, R2C, C2R, V2C, C2V
+from compress import (
+    decode_moves,
+    decode_move_indexes,
+    encode_moves,
+    iter_move_indexes,
+    INDEX_ENCODING,
+    R2C,
+    C2R,
+    V2C,
+    C2V,
+)
 from convert import mirror5, mirror9, usi2uci, grand2zero, zero2grand
-from fairy import BLACK, STANDARD_FEN, FairyBoard
+from fairy import BLACK, STANDARD_FEN, FairyBoard, variant_info
 from game import Game, MAX_PLY
 from newid import new_id
 from user import User
 from settings import URI
+from steps import BLACK_TO_MOVE, CHECK, read_snapshot
 
 log = logging.getLogger(__name__)
 
@@ -58,13 +69,16 @@ async def tv_game(db, app):
 
 async def tv_game_user(db, users, profileId):
     """Get latest played game id by a given user name"""
-    if users[profileId].tv is not None:
-        return users[profileId].tv
+    user = await users.load(profileId)
+    if user is None:
+        return None
+    if user.tv is not None:
+        return user.tv
     game_id = None
     doc = await db.game.find_one({"us": profileId}, sort=[("$natural", -1)])
     if doc is not None:
         game_id = doc["_id"]
-        users[profileId].tv = game_id
+        user.tv = game_id
     return game_id
 
 
@@ -76,21 +90,24 @@ async def load_game(app, game_id):
     if game_id in games:
         return games[game_id]
 
+    game_cache = app["game_cache"]
+    game = game_cache.get(game_id)
+    if game is not None:
+        return game
+
     doc = await db.game.find_one({"_id": game_id})
 
     if doc is None:
         return None
 
     wp, bp = doc["us"]
-    if wp in users:
-        wplayer = users[wp]
-    else:
+    wplayer = await users.load(wp)
+    if wplayer is None:
         wplayer = User(app, username=wp, anon=True)
         users[wp] = wplayer
 
-    if bp in users:
-        bplayer = users[bp]
-    else:
+    bplayer = await users.load(bp)
+    if bplayer is None:
         bplayer = User(app, username=bp, anon=True)
         users[bp] = bplayer
 
@@ -132,26 +149,34 @@ async def load_game(app, game_id):
         tournamentId=doc.get("tid"),
     )
 
-    mlist = decode_moves(doc["m"], variant)
-
-    if mlist or (game.tournamentId is not None and doc["s"] > STARTED):
+    if doc["m"] or (game.tournamentId is not None and doc["s"] > STARTED):
         game.saved = True
 
     if usi_format and variant == "shogi":
         mirror = mirror9
-        mlist = map(mirror, mlist)
 
     elif usi_format and (variant in ("minishogi", "kyotoshogi")):
         mirror = mirror5
-        mlist = map(mirror, mlist)
 
-    elif variant in GRANDS:
-        mlist = map(zero2grand, mlist)
+    # Finished games saved with a step snapshot are restored without get_san() and is_checked()
+    snapshot = read_snapshot(doc["st"]) if doc["s"] > STARTED and "st" in doc else None
+
+    index_encoded = doc.get("mv") == INDEX_ENCODING
+    if index_encoded:
+        mlist = iter_move_indexes(doc["m"], game.board)
+    else:
+        mlist = decode_moves(doc["m"], variant)
+
+        if usi_format and (variant in ("shogi", "minishogi", "kyotoshogi")):
+            mlist = map(mirror, mlist)
+
+        elif variant in GRANDS:
+            mlist = map(zero2grand, mlist)
 
     if "a" in doc:
         if usi_format and "m" in doc["a"][0]:
             doc["a"][0]["m"] = mirror(usi2uci(doc["a"][0]["m"]))
-        game.steps[0]["analysis"] = doc["a"][0]
+        game.steps.annotate(0, "analysis", doc["a"][0])
 
     if "cw" in doc:
         base_clock_time = (game.base * 1000 * 60) + (0 if game.base > 0 else game.inc * 1000)
@@ -181,45 +206,46 @@ async def load_game(app, game_id):
                     # print("Count started", count_started)
                     game.board.count_started = ply
 
-            san = game.board.get_san(move)
-            game.board.push(move)
-            game.check = game.board.is_checked()
-            turnColor = "black" if game.board.color == BLACK else "white"
-            if usi_format:
-                turnColor = "black" if turnColor == "white" else "white"
-            step = {
-                "fen": game.board.fen,
-                "move": move,
-                "san": san,
-                "turnColor": turnColor,
-                "check": game.check,
-            }
+            if snapshot is None:
+                san = game.board.get_san(move)
+                game.board.push(move)
+                game.check = game.board.is_checked()
+                turnColor = "black" if game.board.color == BLACK else "white"
+                if usi_format:
+                    turnColor = "black" if turnColor == "white" else "white"
+            else:
+                san = snapshot.sans[ply]
+                game.board.push(move)
+                flags = snapshot.flags[ply + 1]
+                game.check = bool(flags & CHECK)
+                turnColor = "black" if flags & BLACK_TO_MOVE else "white"
+            clocks = None
             if "cw" in doc:
                 move_number = ((ply + 1) // 2) + (1 if ply % 2 == 0 else 0)
                 if ply >= 2:
                     if ply % 2 == 0:
-                        step["clocks"] = {
+                        clocks = {
                             "white": clocktimes_w[move_number - 1],
                             "black": clocktimes_b[move_number - 2],
                         }
                     else:
-                        step["clocks"] = {
+                        clocks = {
                             "white": clocktimes_w[move_number - 1],
                             "black": clocktimes_b[move_number - 1],
                         }
                 else:
-                    step["clocks"] = {
+                    clocks = {
                         "white": clocktimes_w[move_number - 1],
                         "black": clocktimes_b[move_number - 1],
                     }
 
-            game.steps.append(step)
+            game.steps.append(game.board.fen, san, turnColor, game.check, clocks)
 
             if "a" in doc:
                 if usi_format and "m" in doc["a"][ply + 1]:
                     doc["a"][ply + 1]["m"] = mirror(usi2uci(doc["a"][ply + 1]["m"]))
                 try:
-                    game.steps[-1]["analysis"] = doc["a"][ply + 1]
+                    game.steps.annotate(-1, "analysis", doc["a"][ply + 1])
                 except IndexError:
                     print("IndexError", ply, move, san)
 
@@ -230,10 +256,20 @@ async def load_game(app, game_id):
                 variant,
                 doc.get("if"),
                 move,
-                list(mlist),
+                doc["m"] if index_encoded else list(mlist),
             )
             break
 
+    # Old finished games get their snapshot on first load
+    if snapshot is None and doc["s"] > STARTED and 1 < len(game.steps) == len(doc["m"]) + 1:
+        app["db_writer"].update("game", game_id, {"st": game.steps.snapshot()})
+
+    if index_encoded:
+        ply = len(game.board.move_stack)
+        if ply < len(doc["m"]):
+            log.error("load_game() %s invalid move index at ply %s", game_id, ply)
+        game.move_indexes.extend(map(ord, doc["m"][:ply]))
+
     if len(game.steps) > 1:
         move = game.steps[-1]["move"]
         game.lastmove = move
@@ -272,6 +308,10 @@ async def load_game(app, game_id):
     if doc.get("by") is not None:
         game.imported_by = doc.get("by")
 
+    await game.load_crosstable()
+
+    game_cache.put(game)
+
     return game
 
 
@@ -287,15 +327,13 @@ async def import_game(request):
 
     wp = data["White"]
     bp = data["Black"]
-    if wp in users:
-        wplayer = users[wp]
-    else:
+    wplayer = await users.load(wp)
+    if wplayer is None:
         wplayer = User(app, username=wp, anon=True)
         users[wp] = wplayer
 
-    if bp in users:
-        bplayer = users[bp]
-    else:
+    bplayer = await users.load(bp)
+    if bplayer is None:
         bplayer = User(app, username=bp, anon=True)
         users[bp] = bplayer
 
@@ -500,6 +538,7 @@ async def new_game(app, seek_id, game_id=None):
 
     remove_seek(seeks, seek)
 
+    await game.load_crosstable()
     await insert_game_to_db(game, app)
 
     return {
@@ -590,13 +629,12 @@ async def analysis_move(app, user, game, move, fen, ply):
         }
 
     ws = user.game_sockets[game.id]
-    await ws.send_json(analysis_board_response)
+    await send_json(ws, analysis_board_response)
 
 
 async def play_move(app, user, game, move, clocks=None, ply=None):
     gameId = game.id
     users = app["users"]
-    invalid_move = False
     # log.info("%s move %s %s %s - %s" % (user.username, move, gameId, game.wplayer.username, game.bplayer.username))
 
     if game.status <= STARTED:
@@ -605,31 +643,33 @@ async def play_move(app, user, game, move, clocks=None, ply=None):
                 "invalid ply received - probably a re-sent move that has already been processed"
             )
             return
-        try:
+        if game.board.is_legal(move):
             await game.play_move(move, clocks, ply)
-        except SystemError:
-            invalid_move = True
-            log.exception(
+        else:
+            log.error(
                 "Game %s aborted because invalid move %s by %s !!!",
                 gameId,
                 move,
                 user.username,
             )
-            game.status = INVALIDMOVE
-            game.result = "0-1" if user.username == game.wplayer.username else "1-0"
+            result = "0-1" if user.username == game.wplayer.username else "1-0"
+            game.update_status(INVALIDMOVE, result)
+            await game.save_game()
     else:
         # never play moves in finished games!
         return
 
-    if not invalid_move:
+    if game.status > STARTED:
         board_response = game.get_board(full=game.board.ply == 1)
+    else:
+        board_response = game.get_move()
 
-        if not user.bot:
-            try:
-                ws = user.game_sockets[gameId]
-                await ws.send_json(board_response)
-            except (KeyError, ConnectionResetError):
-                pass
+    if not user.bot:
+        try:
+            ws = user.game_sockets[gameId]
+            await send_json(ws, board_response)
+        except (KeyError, ConnectionResetError):
+            pass
 
     if user.bot and game.status > STARTED:
         await user.game_queues[gameId].put(game.game_end)
@@ -645,8 +685,7 @@ async def play_move(app, user, game, move, clocks=None, ply=None):
     else:
         try:
             opp_ws = users[opp_name].game_sockets[gameId]
-            if not invalid_move:
-                await opp_ws.send_json(board_response)
+            await send_json(opp_ws, board_response)
             if game.status > STARTED:
                 response = {
                     "type": "gameEnd",
@@ -655,32 +694,46 @@ async def play_move(app, user, game, move, clocks=None, ply=None):
                     "gameId": game.id,
                     "pgn": game.pgn,
                 }
-                await opp_ws.send_json(response)
+                await send_json(opp_ws, response)
         except (KeyError, ConnectionResetError):
             pass
 
-    if not invalid_move:
-        await round_broadcast(game, board_response, channels=app["game_channels"])
+    await round_broadcast(game, board_response, channels=app["game_channels"])
 
-        if game.tournamentId is not None:
-            tournament = app["tournaments"][game.tournamentId]
-            if (
-                (tournament.top_game is not None)
-                and tournament.status == T_STARTED
-                and tournament.top_game.id == gameId
-            ):
+    if game.tournamentId is not None:
+        tournament = app["tournaments"][game.tournamentId]
+        if (
+            (tournament.top_game is not None)
+            and tournament.status == T_STARTED
+            and tournament.top_game.id == gameId
+        ):
+            if board_response["type"] == "board":
                 # no need to send lots of data to tournament top game
                 del board_response["pgn"]
                 del board_response["uci_usi"]
                 del board_response["ct"]
 
-                await tournament.broadcast(board_response)
+            await tournament.broadcast(board_response)
+
+
+def decode_doc_moves(doc, variant):
+    """Move list of a game document as the API always returned it (zero based grand moves)"""
+    if doc.get("mv") == INDEX_ENCODING:
+        board = FairyBoard(variant, doc.get("if") or "", bool(doc.get("z")))
+        moves = decode_move_indexes(doc["m"], board)
+        return list(map(grand2zero, moves)) if variant in GRANDS else moves
+    return decode_moves(doc["m"], variant)
+
+
+# Game document fields needed by pgn()
+PGN_PROJECTION = dict.fromkeys(
+    ("v", "m", "mv", "st", "s", "if", "z", "uci", "us", "r", "d", "y", "b", "i", "p0", "p1"), 1
+)
 
 
 def pgn(doc):
     variant = C2V[doc["v"]]
-    mlist = decode_moves(doc["m"], variant)
-    if len(mlist) == 0:
+    if len(doc["m"]) == 0:
         return None
 
     chess960 = bool(int(doc.get("z"))) if "z" in doc else False
@@ -688,6 +741,17 @@ def pgn(doc):
     initial_fen = doc.get("if")
     usi_format = variant.endswith("shogi") and doc.get("uci") is None
 
+    # SAN moves of finished games are saved in their step snapshot
+    snapshot = read_snapshot(doc["st"]) if doc.get("s", 0) > STARTED and "st" in doc else None
+    san_saved = snapshot is not None and variant_info(variant).notation == sf.NOTATION_SAN
+
+    if san_saved:
+        mlist = snapshot.sans
+    elif doc.get("mv") == INDEX_ENCODING:
+        mlist = decode_move_indexes(doc["m"], FairyBoard(variant, initial_fen or "", chess960))
+    else:
+        mlist = decode_moves(doc["m"], variant)
+
     if usi_format:
         # wplayer, bplayer = bplayer, wplayer
         if initial_fen:
@@ -710,19 +774,22 @@ def pgn(doc):
         mirror = mirror5
         mlist = list(map(mirror, mlist))
 
-    elif variant in GRANDS:
+    elif variant in GRANDS and doc.get("mv") != INDEX_ENCODING and not san_saved:
         mlist = list(map(zero2grand, mlist))
 
-    fen = initial_fen if initial_fen is not None else sf.start_fen(variant)
+    fen = initial_fen if initial_fen is not None else variant_info(variant).start_fen
     # print(variant, fen, mlist)
-    try:
-        mlist = sf.get_san_moves(variant, fen, mlist, chess960, sf.NOTATION_SAN)
-    except Exception:
+    if not san_saved:
         try:
-            mlist = sf.get_san_moves(variant, fen, mlist[:-1], chess960, sf.NOTATION_SAN)
+            mlist = sf.get_san_moves(variant, fen, mlist, chess960, sf.NOTATION_SAN)
         except Exception:
-            log.exception("%s %s %s movelist contains invalid move", doc["_id"], variant, doc["d"])
-            mlist = mlist[0]
+            try:
+                mlist = sf.get_san_moves(variant, fen, mlist[:-1], chess960, sf.NOTATION_SAN)
+            except Exception:
+                log.exception(
+                    "%s %s %s movelist contains invalid move", doc["_id"], variant, doc["d"]
+                )
+                mlist = mlist[0]
 
     moves = " ".join(
         (
@@ -753,6 +820,28 @@ def pgn(doc):
     )
 
 
+def pgn_batch(docs, failed=None):
+    """PGN texts of a list of game documents, used by the export process pool.
+    The _id of the games failing to convert are appended to failed if given."""
+    texts = []
+    for doc in docs:
+        try:
+            pgn_text = pgn(doc)
+        except Exception:
+            if failed is not None:
+                failed.append(doc["_id"])
+            log.error(
+                "Failed to load game %s %s %s (early games may contain invalid moves)",
+                doc["_id"],
+                C2V[doc["v"]],
+                doc["d"].strftime("%Y.%m.%d"),
+            )
+            continue
+        if pgn_text is not None:
+            texts.append(pgn_text)
+    return texts
+
+
 def sanitize_fen(variant, initial_fen, chess960):
     # Prevent this particular one to fail on our general sastling check
     if variant == "capablanca" and initial_fen == CONSERVATIVE_CAPA_FEN:
@@ -761,7 +850,7 @@ def sanitize_fen(variant, initial_fen, chess960):
     # Initial_fen needs validation to prevent segfaulting in pyffish
     sanitized_fen = initial_fen
 
-    start_fen = sf.start_fen(variant)  # self.board.start_fen(self.variant)
+    start_fen = variant_info(variant).start_fen
     start = start_fen.split()
     init = initial_fen.split()
 
@@ -7,12 +7,11 @@ from aiohttp import web
 import aiohttp_session
 
 from admin import silence
-from broadcast import lobby_broadcast, discord_message, broadcast_streams
+from broadcast import lobby_broadcast, discord_message, broadcast_streams, send_json, send_str
 from chat import chat_response
 from const import STARTED
 from settings import ADMINS, TOURNAMENT_DIRECTORS
 from seek import challenge, create_seek, get_seeks, Seek
-from user import User
 from utils import join_seek, load_game, online_count, MyWebSocketResponse, remove_seek
 from misc import server_state
 from tournament_spotlights import tournament_spotlights
@@ -31,7 +30,7 @@ async def is_playing(request, user, ws):
             user.game_in_progress = None
             return False
         response = {"type": "game_in_progress", "gameId": user.game_in_progress}
-        await ws.send_json(response)
+        await send_json(ws, response)
         return True
     else:
         return False
@@ -58,7 +57,7 @@ async def lobby_socket_handler(request):
 
     session = await aiohttp_session.get_session(request)
     session_user = session.get("user_name")
-    user = users[session_user] if session_user is not None and session_user in users else None
+    user = await users.load(session_user)
 
     if (user is not None) and (not user.enabled):
         await ws.close()
@@ -74,7 +73,7 @@ async def lobby_socket_handler(request):
                     log.debug("Got 'close' msg.")
                     break
                 elif msg.data == "/n":
-                    await ws.send_str("/n")
+                    await send_str(ws, "/n")
                 else:
                     data = json.loads(msg.data)
                     if not data["type"] == "pong":
@@ -82,7 +81,7 @@ async def lobby_socket_handler(request):
 
                     if data["type"] == "get_seeks":
                         response = get_seeks(seeks)
-                        await ws.send_json(response)
+                        await send_json(ws, response)
 
                     elif data["type"] == "create_ai_challenge":
                         no = await is_playing(request, user, ws)
@@ -114,7 +113,7 @@ async def lobby_socket_handler(request):
                         seeks[seek.id] = seek
 
                         response = await join_seek(request.app, engine, seek.id)
-                        await ws.send_json(response)
+                        await send_json(ws, response)
 
                         if response["type"] != "error":
                             gameId = response["gameId"]
@@ -128,7 +127,7 @@ async def lobby_socket_handler(request):
 
                         print("create_seek", data)
                         seek = await create_seek(db, invites, seeks, user, data, ws)
-                        await lobby_broadcast(sockets, get_seeks(seeks))
+                        request.app["seek_feed"].changed()
                         await discord_message(request.app, "create_seek", seek.discord_msg)
 
                     elif data["type"] == "create_invite":
@@ -140,7 +139,7 @@ async def lobby_socket_handler(request):
                         seek = await create_seek(db, invites, seeks, user, data, ws)
 
                         response = {"type": "invite_created", "gameId": seek.game_id}
-                        await ws.send_json(response)
+                        await send_json(ws, response)
 
                     elif data["type"] == "create_host":
                         no = user.username not in TOURNAMENT_DIRECTORS
@@ -151,7 +150,7 @@ async def lobby_socket_handler(request):
                         seek = await create_seek(db, invites, seeks, user, data, ws, True)
 
                         response = {"type": "host_created", "gameId": seek.game_id}
-                        await ws.send_json(response)
+                        await send_json(ws, response)
 
                     elif data["type"] == "delete_seek":
                         try:
@@ -164,7 +163,7 @@ async def lobby_socket_handler(request):
                         except KeyError:
                             # Seek was already deleted
                             pass
-                        await lobby_broadcast(sockets, get_seeks(seeks))
+                        request.app["seek_feed"].changed()
 
                     elif data["type"] == "accept_seek":
                         no = await is_playing(request, user, ws)
@@ -177,7 +176,7 @@ async def lobby_socket_handler(request):
                         seek = seeks[data["seekID"]]
                         # print("accept_seek", seek.as_json)
                         response = await join_seek(request.app, user, data["seekID"])
-                        await ws.send_json(response)
+                        await send_json(ws, response)
 
                         if seek.creator.bot:
                             gameId = response["gameId"]
@@ -186,12 +185,12 @@ async def lobby_socket_handler(request):
                         else:
                             if seek.ws is None:
                                 remove_seek(seeks, seek)
-                                await lobby_broadcast(sockets, get_seeks(seeks))
+                                request.app["seek_feed"].changed()
                             else:
-                                await seek.ws.send_json(response)
+                                await send_json(seek.ws, response)
 
                         # Inform others, new_game() deleted accepted seek allready.
-                        await lobby_broadcast(sockets, get_seeks(seeks))
+                        request.app["seek_feed"].changed()
 
                     elif data["type"] == "lobby_user_connected":
                         if session_user is not None:
@@ -202,40 +201,16 @@ async def lobby_socket_handler(request):
                                     data["username"],
                                 )
                                 session_user = data["username"]
-                                if session_user in users:
-                                    user = users[session_user]
-                                else:
-                                    user = User(
-                                        request.app,
-                                        username=data["username"],
-                                        anon=data["username"].startswith("Anon-"),
-                                    )
-                                    users[user.username] = user
+                                user = await users.connected(session_user)
                             else:
-                                if session_user in users:
-                                    user = users[session_user]
-                                else:
-                                    user = User(
-                                        request.app,
-                                        username=data["username"],
-                                        anon=data["username"].startswith("Anon-"),
-                                    )
-                                    users[user.username] = user
+                                user = await users.connected(session_user)
                         else:
                             log.info(
                                 "+++ Existing lobby_user %s socket reconnected.",
                                 data["username"],
                             )
                             session_user = data["username"]
-                            if session_user in users:
-                                user = users[session_user]
-                            else:
-                                user = User(
-                                    request.app,
-                                    username=data["username"],
-                                    anon=data["username"].startswith("Anon-"),
-                                )
-                                users[user.username] = user
+                            user = await users.connected(session_user)
 
                         # update websocket
                         user.lobby_sockets.add(ws)
@@ -246,29 +221,29 @@ async def lobby_socket_handler(request):
                             "type": "lobby_user_connected",
                             "username": user.username,
                         }
-                        await ws.send_json(response)
+                        await send_json(ws, response)
 
                         response = {"type": "fullchat", "lines": list(lobbychat)}
-                        await ws.send_json(response)
+                        await send_json(ws, response)
 
                         # send game count
                         response = {"type": "g_cnt", "cnt": request.app["g_cnt"][0]}
-                        await ws.send_json(response)
+                        await send_json(ws, response)
 
                         # send user count
                         response = {"type": "u_cnt", "cnt": online_count(users)}
                         if len(user.game_sockets) == 0:
                             await lobby_broadcast(sockets, response)
                         else:
-                            await ws.send_json(response)
+                            await send_json(ws, response)
 
                         spotlights = tournament_spotlights(request.app)
                         if len(spotlights) > 0:
-                            await ws.send_json({"type": "spotlights", "items": spotlights})
+                            await send_json(ws, {"type": "spotlights", "items": spotlights})
 
                         streams = twitch.live_streams + youtube.live_streams
                         if len(streams) > 0:
-                            await ws.send_json({"type": "streams", "items": streams})
+                            await send_json(ws, {"type": "streams", "items": streams})
 
                     elif data["type"] == "lobbychat":
                         if user.username.startswith("Anon-"):
@@ -8,12 +8,11 @@ import aiohttp
 from aiohttp import web
 import aiohttp_session
 
-from broadcast import lobby_broadcast, round_broadcast
+from broadcast import lobby_broadcast, round_broadcast, send_json, send_str
 from chat import chat_response
 from const import ANALYSIS, STARTED
 from fairy import WHITE, BLACK
 from seek import challenge, Seek
-from user import User
 from draw import draw, reject_draw
 from utils import (
     analysis_move,
@@ -48,7 +47,7 @@ async def round_socket_handler(request):
 
     session = await aiohttp_session.get_session(request)
     session_user = session.get("user_name")
-    user = users[session_user] if session_user is not None and session_user in users else None
+    user = await users.load(session_user)
 
     game = None
     opp_ws = None
@@ -62,7 +61,7 @@ async def round_socket_handler(request):
                     log.debug("Got 'close' msg.")
                     break
                 elif msg.data == "/n":
-                    await ws.send_str("/n")
+                    await send_str(ws, "/n")
                 else:
                     data = json.loads(msg.data)
                     # log.debug("Websocket (%s) message: %s" % (id(ws), msg))
@@ -122,10 +121,10 @@ async def round_socket_handler(request):
                                 await opp_player.event_queue.put(game.game_start)
 
                             response = {"type": "gameStart", "gameId": data["gameId"]}
-                            await ws.send_json(response)
+                            await send_json(ws, response)
                         else:
                             response = {"type": "gameStart", "gameId": data["gameId"]}
-                            await ws.send_json(response)
+                            await send_json(ws, response)
 
                             response = {
                                 "type": "user_present",
@@ -138,27 +137,29 @@ async def round_socket_handler(request):
                         if game.variant == "janggi":
                             if (game.bsetup or game.wsetup) and game.status <= STARTED:
                                 if game.bsetup:
-                                    await ws.send_json(
+                                    await send_json(
+                                        ws,
                                         {
                                             "type": "setup",
                                             "color": "black",
                                             "fen": game.board.initial_fen,
-                                        }
+                                        },
                                     )
                                 elif game.wsetup:
-                                    await ws.send_json(
+                                    await send_json(
+                                        ws,
                                         {
                                             "type": "setup",
                                             "color": "white",
                                             "fen": game.board.initial_fen,
-                                        }
+                                        },
                                     )
                             else:
                                 board_response = game.get_board(full=True)
-                                await ws.send_json(board_response)
+                                await send_json(ws, board_response)
                         else:
                             board_response = game.get_board(full=True)
-                            await ws.send_json(board_response)
+                            await send_json(ws, board_response)
 
                     elif data["type"] == "setup":
                         # Janggi game starts with a prelude phase to set up horses and elephants
@@ -167,6 +168,7 @@ async def round_socket_handler(request):
                         game.board.initial_fen = data["fen"]
                         game.initial_fen = game.board.initial_fen
                         game.board.fen = game.board.initial_fen
+                        game.board.reset_history()
                         # print("--- Got FEN from %s %s" % (data["color"], data["fen"]))
 
                         opp_name = (
@@ -176,7 +178,7 @@ async def round_socket_handler(request):
                         )
                         opp_player = users[opp_name]
 
-                        game.steps[0]["fen"] = data["fen"]
+                        game.steps.set_fen(0, data["fen"])
 
                         if data["color"] == "black":
                             game.bsetup = False
@@ -185,25 +187,25 @@ async def round_socket_handler(request):
                                 "color": "white",
                                 "fen": data["fen"],
                             }
-                            await ws.send_json(response)
+                            await send_json(ws, response)
 
                             if opp_player.bot:
                                 game.board.janggi_setup("w")
-                                game.steps[0]["fen"] = game.board.initial_fen
+                                game.steps.set_fen(0, game.board.initial_fen)
                             else:
                                 opp_ws = users[opp_name].game_sockets[data["gameId"]]
-                                await opp_ws.send_json(response)
+                                await send_json(opp_ws, response)
                         else:
                             game.wsetup = False
                             game.status = STARTED
 
                             response = game.get_board(full=True)
                             # log.info("User %s asked board. Server sent: %s" % (user.username, board_response["fen"]))
-                            await ws.send_json(response)
+                            await send_json(ws, response)
 
                             if not opp_player.bot:
                                 opp_ws = users[opp_name].game_sockets[data["gameId"]]
-                                await opp_ws.send_json(response)
+                                await send_json(opp_ws, response)
 
                         if opp_player.bot:
                             await opp_player.event_queue.put(game.game_start)
@@ -255,7 +257,7 @@ async def round_socket_handler(request):
                             "Analysis request sent...",
                             room="spectator",
                         )
-                        await ws.send_json(response)
+                        await send_json(ws, response)
 
                     elif data["type"] == "rematch":
 
@@ -299,7 +301,7 @@ async def round_socket_handler(request):
                             seeks[seek.id] = seek
 
                             response = await join_seek(request.app, engine, seek.id)
-                            await ws.send_json(response)
+                            await send_json(ws, response)
 
                             await engine.event_queue.put(challenge(seek, response))
                             gameId = response["gameId"]
@@ -333,8 +335,8 @@ async def round_socket_handler(request):
 
                                 response = await join_seek(request.app, opp_player, seek.id)
                                 rematch_id = response["gameId"]
-                                await ws.send_json(response)
-                                await opp_ws.send_json(response)
+                                await send_json(ws, response)
+                                await send_json(opp_ws, response)
                             else:
                                 game.rematch_offers.add(user.username)
                                 response = {
@@ -345,8 +347,8 @@ async def round_socket_handler(request):
                                     "user": "",
                                 }
                                 game.messages.append(response)
-                                await ws.send_json(response)
-                                await opp_ws.send_json(response)
+                                await send_json(ws, response)
+                                await send_json(opp_ws, response)
                         if rematch_id:
                             await round_broadcast(
                                 game, {"type": "view_rematch", "gameId": rematch_id}
@@ -381,14 +383,14 @@ async def round_socket_handler(request):
                         response = await draw(
                             game, user.username, agreement=opp_name in game.draw_offers
                         )
-                        await ws.send_json(response)
+                        await send_json(ws, response)
                         if opp_player.bot:
                             if game.status > STARTED and data["gameId"] in opp_player.game_queues:
                                 await opp_player.game_queues[data["gameId"]].put(game.game_end)
                         else:
                             try:
                                 opp_ws = users[opp_name].game_sockets[data["gameId"]]
-                                await opp_ws.send_json(response)
+                                await send_json(opp_ws, response)
                             except KeyError:
                                 # opp disconnected
                                 pass
@@ -431,7 +433,7 @@ async def round_socket_handler(request):
                         async with game.move_lock:
                             response = await game.game_ended(user, data["type"])
 
-                        await ws.send_json(response)
+                        await send_json(ws, response)
 
                         opp_name = (
                             game.wplayer.username
@@ -445,14 +447,14 @@ async def round_socket_handler(request):
                         else:
                             if data["gameId"] in users[opp_name].game_sockets:
                                 opp_ws = users[opp_name].game_sockets[data["gameId"]]
-                                await opp_ws.send_json(response)
+                                await send_json(opp_ws, response)
 
                         await round_broadcast(game, response)
 
                     elif data["type"] == "embed_user_connected":
 
                         response = {"type": "embed_user_connected"}
-                        await ws.send_json(response)
+                        await send_json(ws, response)
 
                     elif data["type"] == "game_user_connected":
 
@@ -464,15 +466,7 @@ async def round_socket_handler(request):
                                     data["username"],
                                 )
                                 session_user = data["username"]
-                                if session_user in users:
-                                    user = users[session_user]
-                                else:
-                                    user = User(
-                                        request.app,
-                                        username=data["username"],
-                                        anon=data["username"].startswith("Anon-"),
-                                    )
-                                    users[user.username] = user
+                                user = await users.connected(session_user)
 
                                 # Update logged in users as spactators
                                 if (
@@ -482,30 +476,14 @@ async def round_socket_handler(request):
                                 ):
                                     game.spectators.add(user)
                             else:
-                                if session_user in users:
-                                    user = users[session_user]
-                                else:
-                                    user = User(
-                                        request.app,
-                                        username=data["username"],
-                                        anon=data["username"].startswith("Anon-"),
-                                    )
-                                    users[user.username] = user
+                                user = await users.connected(session_user)
                         else:
                             log.info(
                                 "+++ Existing game_user %s socket reconnected.",
                                 data["username"],
                             )
                             session_user = data["username"]
-                            if session_user in users:
-                                user = users[session_user]
-                            else:
-                                user = User(
-                                    request.app,
-                                    username=data["username"],
-                                    anon=data["username"].startswith("Anon-"),
-                                )
-                                users[user.username] = user
+                            user = await users.connected(session_user)
 
                         # update websocket
                         if data["gameId"] in user.game_sockets:
@@ -535,10 +513,10 @@ async def round_socket_handler(request):
                             "ply": game.board.ply,
                             "firstmovetime": game.stopwatch.secs,
                         }
-                        await ws.send_json(response)
+                        await send_json(ws, response)
 
                         response = {"type": "fullchat", "lines": list(game.messages)}
-                        await ws.send_json(response)
+                        await send_json(ws, response)
 
                         response = {"type": "user_present", "username": user.username}
                         await round_broadcast(game, response, full=True)
@@ -561,7 +539,7 @@ async def round_socket_handler(request):
                                 "type": "user_disconnected",
                                 "username": player_name,
                             }
-                        await ws.send_json(response)
+                        await send_json(ws, response)
 
                     elif data["type"] == "moretime":
                         # TODO: stop and update game stopwatch time with updated secs
@@ -581,7 +559,7 @@ async def round_socket_handler(request):
                         if not opp_player.bot:
                             opp_ws = users[opp_name].game_sockets[data["gameId"]]
                             response = {"type": "moretime", "username": opp_name}
-                            await opp_ws.send_json(response)
+                            await send_json(opp_ws, response)
                             await round_broadcast(game, response)
 
                     elif data["type"] == "roundchat":
@@ -595,10 +573,8 @@ async def round_socket_handler(request):
                             data["message"] == "!analysis"
                             and user.username in request.app["fishnet_versions"]
                         ):
-                            for step in game.steps:
-                                if "analysis" in step:
-                                    del step["analysis"]
-                            await ws.send_json({"type": "request_analysis"})
+                            game.steps.remove_annotations("analysis")
+                            await send_json(ws, {"type": "request_analysis"})
                             continue
 
                         response = chat_response(
@@ -609,8 +585,7 @@ async def round_socket_handler(request):
                         )
                         game.messages.append(response)
 
-                        for name in (game.wplayer.username, game.bplayer.username):
-                            player = users[name]
+                        for player in (game.wplayer, game.bplayer):
                             if player.bot:
                                 if gameId in player.game_queues:
                                     await player.game_queues[gameId].put(
@@ -620,7 +595,7 @@ async def round_socket_handler(request):
                             else:
                                 if gameId in player.game_sockets:
                                     player_ws = player.game_sockets[gameId]
-                                    await player_ws.send_json(response)
+                                    await send_json(player_ws, response)
 
                         await round_broadcast(game, response)
 
@@ -643,13 +618,13 @@ async def round_socket_handler(request):
                         opp_player = users[opp_name]
                         if not opp_player.bot and gameId in opp_player.game_sockets:
                             opp_player_ws = opp_player.game_sockets[gameId]
-                            await opp_player_ws.send_json(response)
+                            await send_json(opp_player_ws, response)
 
                             response = {
                                 "type": "user_disconnected",
                                 "username": user.username,
                             }
-                            await opp_player_ws.send_json(response)
+                            await send_json(opp_player_ws, response)
 
                         await round_broadcast(game, response)
 
@@ -661,7 +636,7 @@ async def round_socket_handler(request):
 
                         if gameId != data["gameId"] and gameId is not None:
                             response = {"type": "updateTV", "gameId": gameId}
-                            await ws.send_json(response)
+                            await send_json(ws, response)
 
                     elif data["type"] == "count":
 
@@ -683,8 +658,8 @@ async def round_socket_handler(request):
                                     "room": "player",
                                     "user": "",
                                 }
-                                await ws.send_json(response)
-                                await opp_ws.send_json(response)
+                                await send_json(ws, response)
+                                await send_json(opp_ws, response)
                                 await round_broadcast(game, response)
                             elif data["mode"] == "stop":
                                 game.stop_manual_count()
@@ -694,8 +669,8 @@ async def round_socket_handler(request):
                                     "room": "player",
                                     "user": "",
                                 }
-                                await ws.send_json(response)
-                                await opp_ws.send_json(response)
+                                await send_json(ws, response)
+                                await send_json(opp_ws, response)
                                 await round_broadcast(game, response)
                         else:
                             response = {
@@ -704,12 +679,12 @@ async def round_socket_handler(request):
                                 "room": "player",
                                 "user": "",
                             }
-                            await ws.send_json(response)
+                            await send_json(ws, response)
 
                     elif data["type"] == "delete":
                         await db.game.delete_one({"_id": data["gameId"]})
                         response = {"type": "deleted"}
-                        await ws.send_json(response)
+                        await send_json(ws, response)
 
             elif msg.type == aiohttp.WSMsgType.CLOSED:
                 log.debug(
@@ -11,10 +11,9 @@ from chat import chat_response
 from const import STARTED, SHIELD
 from settings import ADMINS
 from utils import MyWebSocketResponse, online_count
-from user import User
 from tournaments import load_tournament
 from tournament import T_CREATED, T_STARTED
-from broadcast import lobby_broadcast
+from broadcast import lobby_broadcast, send_json, send_str
 
 
 log = logging.getLogger(__name__)
@@ -37,7 +36,7 @@ async def tournament_socket_handler(request):
 
     session = await aiohttp_session.get_session(request)
     session_user = session.get("user_name")
-    user = users[session_user] if session_user is not None and session_user in users else None
+    user = await users.load(session_user)
 
     if (user is not None) and (not user.enabled):
         await ws.close()
@@ -53,7 +52,7 @@ async def tournament_socket_handler(request):
                     log.debug("Got 'close' msg.")
                     break
                 elif msg.data == "/n":
-                    await ws.send_str("/n")
+                    await send_str(ws, "/n")
                 else:
                     data = json.loads(msg.data)
                     if not data["type"] == "pong":
@@ -66,7 +65,7 @@ async def tournament_socket_handler(request):
                             if user in tournament.players and tournament.players[user].page != page:
                                 tournament.players[user].page = page
                             response = tournament.players_json(page=page)
-                            await ws.send_json(response)
+                            await send_json(ws, response)
 
                     elif data["type"] == "my_page":
                         tournament = await load_tournament(request.app, data["tournamentId"])
@@ -75,13 +74,13 @@ async def tournament_socket_handler(request):
                                 # force to get users current page by leaderbord status
                                 tournament.players[user].page = -1
                             response = tournament.players_json(user=user)
-                            await ws.send_json(response)
+                            await send_json(ws, response)
 
                     elif data["type"] == "get_games":
                         tournament = await load_tournament(request.app, data["tournamentId"])
                         if tournament is not None:
                             response = tournament.games_json(data["player"])
-                            await ws.send_json(response)
+                            await send_json(ws, response)
 
                     elif data["type"] == "join":
                         tournament = await load_tournament(request.app, data["tournamentId"])
@@ -92,7 +91,7 @@ async def tournament_socket_handler(request):
                                 "username": user.username,
                                 "ustatus": tournament.user_status(user),
                             }
-                            await ws.send_json(response)
+                            await send_json(ws, response)
 
                     elif data["type"] == "pause":
                         tournament = await load_tournament(request.app, data["tournamentId"])
@@ -103,7 +102,7 @@ async def tournament_socket_handler(request):
                                 "username": user.username,
                                 "ustatus": tournament.user_status(user),
                             }
-                            await ws.send_json(response)
+                            await send_json(ws, response)
 
                     elif data["type"] == "withdraw":
                         tournament = await load_tournament(request.app, data["tournamentId"])
@@ -114,7 +113,7 @@ async def tournament_socket_handler(request):
                                 "username": user.username,
                                 "ustatus": tournament.user_status(user),
                             }
-                            await ws.send_json(response)
+                            await send_json(ws, response)
 
                     elif data["type"] == "tournament_user_connected":
                         tournamentId = data["tournamentId"]
@@ -130,40 +129,16 @@ async def tournament_socket_handler(request):
                                     data["username"],
                                 )
                                 session_user = data["username"]
-                                if session_user in users:
-                                    user = users[session_user]
-                                else:
-                                    user = User(
-                                        request.app,
-                                        username=data["username"],
-                                        anon=data["username"].startswith("Anon-"),
-                                    )
-                                    users[user.username] = user
+                                user = await users.connected(session_user)
                             else:
-                                if session_user in users:
-                                    user = users[session_user]
-                                else:
-                                    user = User(
-                                        request.app,
-                                        username=data["username"],
-                                        anon=data["username"].startswith("Anon-"),
-                                    )
-                                    users[user.username] = user
+                                user = await users.connected(session_user)
                         else:
                             log.info(
                                 "+++ Existing lobby_user %s socket reconnected.",
                                 data["username"],
                             )
                             session_user = data["username"]
-                            if session_user in users:
-                                user = users[session_user]
-                            else:
-                                user = User(
-                                    request.app,
-                                    username=data["username"],
-                                    anon=data["username"].startswith("Anon-"),
-                                )
-                                users[user.username] = user
+                            user = await users.connected(session_user)
 
                         # update websocket
                         if tournamentId not in user.tournament_sockets:
@@ -198,25 +173,26 @@ async def tournament_socket_handler(request):
                             variant_name = tournament.variant + (
                                 "960" if tournament.chess960 else ""
                             )
-                            defender = users[request.app["shield_owners"][variant_name]]
-                            response["defender_title"] = defender.title
-                            response["defender_name"] = defender.username
+                            # the defender may not be loaded, titles are always in memory
+                            defender = request.app["shield_owners"][variant_name]
+                            response["defender_title"] = request.app["titles"].get(defender)
+                            response["defender_name"] = defender
 
-                        await ws.send_json(response)
+                        await send_json(ws, response)
 
                         if (tournament.top_game is not None) and (
                             tournament.top_game.status <= STARTED
                         ):
-                            await ws.send_json(tournament.top_game_json)
+                            await send_json(ws, tournament.top_game_json)
 
                         if tournament.status > T_STARTED:
-                            await ws.send_json(tournament.summary)
+                            await send_json(ws, tournament.summary)
 
                         response = {
                             "type": "fullchat",
                             "lines": list(tourneychat[tournamentId]),
                         }
-                        await ws.send_json(response)
+                        await send_json(ws, response)
 
                         if user.username not in tournament.spectators:
                             tournament.spactator_join(user)
@@ -0,0 +1,62 @@
+import logging
+import random
+import time
+
+from arena import ArenaTournament
+from const import VARIANTS
+from glicko2.glicko2 import DEFAULT_PERF
+from newid import id8
+from tournament import PlayerData, SCORE_SHIFT
+from user import User
+
+PERFS = {variant: DEFAULT_PERF for variant in VARIANTS}
+
+NB_PLAYERS = (10, 100, 500, 1000, 2000, 5000)
+NB_WAVES = 5
+
+
+def make_arena(nb_players):
+    app = {"db": None}
+    arena = ArenaTournament(app, id8(), with_clock=False)
+    for i in range(nb_players):
+        player = User(app, username=id8(), perfs=PERFS)
+        arena.players[player] = PlayerData(1500, "")
+        arena.leaderboard[player] = random.randint(0, 40) * SCORE_SHIFT + random.randint(0, 3000)
+    return arena
+
+
+def play_wave(arena, pairing):
+    """Fake the effects of the games played in a wave on the next pairing"""
+    for wp, bp in pairing:
+        arena.players[wp].prev_opp = bp.username
+        arena.players[bp].prev_opp = wp.username
+        arena.players[wp].color_balance += 1
+        arena.players[bp].color_balance -= 1
+        arena.players[wp].nb_not_paired = 0
+        arena.players[bp].nb_not_paired = 0
+        winner = random.choice((wp, bp))
+        arena.leaderboard[winner] += 2 * SCORE_SHIFT
+
+
+def main():
+    logging.disable(logging.DEBUG)
+    print("%8s %10s %10s %10s" % ("players", "avg sec", "max sec", "unpaired"))
+    for nb_players in NB_PLAYERS:
+        arena = make_arena(nb_players)
+        times = []
+        unpaired = 0
+        for wave in range(NB_WAVES):
+            waiting_players = list(arena.leaderboard)
+            start = time.perf_counter()
+            pairing = arena.create_pairing(waiting_players)
+            times.append(time.perf_counter() - start)
+            unpaired += nb_players - 2 * len(pairing)
+            play_wave(arena, pairing)
+        print(
+            "%8s %10.3f %10.3f %10.1f"
+            % (nb_players, sum(times) / NB_WAVES, max(times), unpaired / NB_WAVES)
+        )
+
+
+if __name__ == "__main__":
+    main()
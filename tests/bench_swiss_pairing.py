@@ -0,0 +1,42 @@
+import logging
+import random
+import time
+
+from dutch import SwissPlayer, dutch_pairing, color_preference, WHITE, BLACK
+
+NB_PLAYERS = (100, 500, 1000)
+NB_ROUNDS = 11
+
+
+def play_round(pairs, bye):
+    for wp, bp in pairs:
+        # the higher ranked player wins more often
+        wresult = random.choice((0, 1, 2, 2) if wp.rank < bp.rank else (0, 0, 1, 2))
+        wp.score += wresult
+        bp.score += 2 - wresult
+        wp.colors.append(WHITE)
+        bp.colors.append(BLACK)
+        wp.opponents.add(bp.id)
+        bp.opponents.add(wp.id)
+        wp.preference = color_preference(wp.colors)
+        bp.preference = color_preference(bp.colors)
+    if bye is not None:
+        bye.had_bye = True
+
+
+def main():
+    logging.disable(logging.DEBUG)
+    print("%8s %10s %10s" % ("players", "avg sec", "max sec"))
+    for nb_players in NB_PLAYERS:
+        players = [SwissPlayer(rank, rank) for rank in range(1, nb_players + 1)]
+        times = []
+        for round_no in range(NB_ROUNDS):
+            start = time.perf_counter()
+            pairs, bye = dutch_pairing(players)
+            times.append(time.perf_counter() - start)
+            play_round(pairs, bye)
+        print("%8s %10.3f %10.3f" % (nb_players, sum(times) / NB_ROUNDS, max(times)))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,27 +1,59 @@
 # -*- coding: utf-8 -*-
 
 import asyncio
+import bz2
+import gzip
+import json
 import logging
+import os
 import random
+import tempfile
 import unittest
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timezone
 from operator import neg
+from types import SimpleNamespace
+from unittest.mock import patch
 
+from pymongo import ReplaceOne
 from sortedcollections import ValueSortedDict
 
 from aiohttp.test_utils import AioHTTPTestCase
 
-from const import CREATED, STARTED, VARIANTS, STALEMATE, MATE
-from fairy import FairyBoard
-from glicko2.glicko2 import DEFAULT_PERF, Glicko2, WIN, LOSS
+import pyffish as sf
+
+from compress import encode_move_indexes, INDEX_ENCODING, V2C
+from crosstable_cache import CrosstableCache, empty_crosstable
+from db_writer import DbWriter
+from const import CREATED, STARTED, VARIANTS, STALEMATE, MATE, INVALIDMOVE, DRAW
+from export2pgn import export_archives, id_ranges, months, read_manifest
+from fairy import FairyBoard, HISTORY_MARGIN, load_variant_info, variant_info
+from glicko2.glicko2 import DEFAULT_PERF, Glicko2, WIN, LOSS, gl2
 from game import Game
+from game_cache import GameCache
+from generate_highscore import HIGHSCORE_SIZE, HIGHSCORE_STORED
+from highscore import Highscores
+from generate_crosstable import batch_updates, generate_crosstable, REBUILD_COLLECTION
 from login import RESERVED_USERS
 from newid import id8
-from user import User
-from utils import sanitize_fen, join_seek
+from user import User, Users, USER_IDLE_TIME
+from utils import sanitize_fen, join_seek, load_game, pgn, pgn_batch, play_move, tv_game_user
 from server import make_app
 import game
-from seek import Seek
+import game_api
+import seek
+from seek import Seek, SeekFeed
+import broadcast
+import export2pgn
+from broadcast import (
+    broadcast_stats,
+    fan_out,
+    flush_writers,
+    json_dumps,
+    lobby_broadcast,
+    send_json,
+)
+from steps import Steps
 
 game.KEEP_TIME = 0
 game.MAX_PLY = 120
@@ -102,6 +134,43 @@ class GameResultTestCase(AioHTTPTestCase):
         self.assertEqual(game.result, "1-0")
         self.assertEqual(game.status, MATE)
 
+    async def test_pgn_san_moves(self):
+        for variant in ("chess", "xiangqi"):
+            game = Game(self.app, "12345678", variant, "", self.wplayer, self.bplayer, rated=False)
+            for i in range(6):
+                await game.play_move(random.choice(game.legal_moves))
+                san_moves = sf.get_san_moves(
+                    variant, game.initial_fen, game.board.move_stack, False, sf.NOTATION_SAN
+                )
+                self.assertEqual(game.san_moves, san_moves)
+
+            pgn = game.pgn
+            self.assertIs(game.pgn, pgn)
+            self.assertIn(" ".join(san_moves[-2:]), pgn)
+
+    async def test_move_delta(self):
+        game = Game(self.app, "12345678", "chess", "", self.wplayer, self.bplayer, rated=False)
+        await game.play_move("e2e4", clocks={"white": 60000, "black": 60000})
+
+        response = game.get_move()
+        self.assertEqual(response["type"], "move")
+        self.assertEqual(response["ply"], 1)
+        self.assertEqual(response["fen"], game.board.fen)
+        self.assertEqual(response["lastMove"], "e2e4")
+        self.assertEqual(response["san"], "e4")
+        self.assertEqual(response["clocks"], {"white": 60000, "black": 60000})
+        self.assertNotIn("steps", response)
+
+    async def test_invalid_move(self):
+        game = Game(self.app, "12345678", "chess", "", self.wplayer, self.bplayer, rated=False)
+        self.app["users"]["wplayer"] = self.wplayer
+        self.app["users"]["bplayer"] = self.bplayer
+        await play_move(self.app, self.wplayer, game, "e2e5")
+
+        self.assertEqual(game.board.move_stack, [])
+        self.assertEqual(game.result, "0-1")
+        self.assertEqual(game.status, INVALIDMOVE)
+
     async def test_janggi_flag_0(self):
         game = Game(self.app, "12345678", "janggi", "", self.wplayer, self.bplayer)
         await game.game_ended(self.bplayer, "flag")
@@ -132,6 +201,464 @@ class GameResultTestCase(AioHTTPTestCase):
         self.assertEqual(game.result, "1-0")
 
 
+# Stand-in for a missing field in FakeCollection queries
+MISSING = object()
+
+
+def get_field(doc, key):
+    for part in key.split("."):
+        if not isinstance(doc, dict) or part not in doc:
+            return MISSING
+        doc = doc[part]
+    return doc
+
+
+def set_field(doc, key, value):
+    *parents, last = key.split(".")
+    for part in parents:
+        doc = doc.setdefault(part, {})
+    doc[last] = value
+
+
+def field_matches(value, cond):
+    if not (isinstance(cond, dict) and any(op.startswith("$") for op in cond)):
+        # array fields match any of their elements, like in mongodb
+        return value == cond or (isinstance(value, list) and cond in value)
+    for op, arg in cond.items():
+        if op == "$ne":
+            ok = value != arg
+        elif op == "$nin":
+            ok = value not in arg
+        elif value is MISSING:
+            ok = False
+        elif op == "$eq":
+            ok = value == arg
+        elif op == "$in":
+            ok = value in arg
+        elif op == "$gt":
+            ok = value > arg
+        elif op == "$gte":
+            ok = value >= arg
+        elif op == "$lt":
+            ok = value < arg
+        elif op == "$lte":
+            ok = value <= arg
+        else:
+            raise NotImplementedError(op)
+        if not ok:
+            return False
+    return True
+
+
+def matches(doc, query):
+    for key, cond in query.items():
+        if key == "$or":
+            if not any(matches(doc, sub_query) for sub_query in cond):
+                return False
+        elif key == "$and":
+            if not all(matches(doc, sub_query) for sub_query in cond):
+                return False
+        elif not field_matches(get_field(doc, key), cond):
+            return False
+    return True
+
+
+class FakeCursor:
+    def __init__(self, docs):
+        self.docs = docs
+
+    def sort(self, keys, direction=1):
+        if isinstance(keys, str):
+            keys = [(keys, direction)]
+        for key, direction in reversed(keys):
+            if key == "$natural":
+                if direction < 0:
+                    self.docs.reverse()
+            else:
+                self.docs.sort(key=lambda doc: get_field(doc, key), reverse=direction < 0)
+        return self
+
+    def skip(self, skip):
+        self.docs = self.docs[skip:]
+        return self
+
+    def limit(self, limit):
+        if limit:
+            self.docs = self.docs[:limit]
+        return self
+
+    async def to_list(self, length):
+        return self.docs[:length]
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        if not self.docs:
+            raise StopAsyncIteration
+        return self.docs.pop(0)
+
+
+class FakeCollection:
+    """In memory motor collection, supporting the queries and updates used by the server.
+    bulk_write() calls are recorded in batches, find_one() calls are counted in queries."""
+
+    def __init__(self, db, name, docs=()):
+        self.db = db
+        self.name = name
+        self.docs = {doc["_id"]: dict(doc) for doc in docs}
+        self.batches = []
+        self.queries = 0
+
+    def find(self, query=None, projection=None, sort=None, limit=0):
+        docs = [dict(doc) for doc in self.docs.values() if matches(doc, query or {})]
+        cursor = FakeCursor(docs)
+        if sort is not None:
+            cursor.sort(sort)
+        return cursor.limit(limit)
+
+    async def find_one(self, query, projection=None, sort=None):
+        self.queries += 1
+        docs = self.find(query, sort=sort).docs
+        return docs[0] if docs else None
+
+    def update(self, query, update, upsert):
+        doc = self.docs.get(query["_id"])
+        if doc is None:
+            if not upsert:
+                return
+            doc = self.docs[query["_id"]] = {"_id": query["_id"]}
+        elif not matches(doc, query):
+            return
+
+        for key, value in update.get("$set", {}).items():
+            set_field(doc, key, value)
+        for key, value in update.get("$inc", {}).items():
+            doc[key] = doc.get(key, 0) + value
+        for key, value in update.get("$push", {}).items():
+            doc[key] = doc.get(key, []) + value["$each"]
+            if "$slice" in value:
+                doc[key] = doc[key][value["$slice"] :]
+
+    async def update_one(self, query, update, upsert=False):
+        self.update(query, update, upsert)
+
+    async def replace_one(self, query, doc, upsert=False):
+        if upsert or query["_id"] in self.docs:
+            self.docs[query["_id"]] = dict(doc)
+        self.db.on_replace()
+
+    async def bulk_write(self, requests, ordered=True):
+        self.batches.append(requests)
+        for request in requests:
+            if isinstance(request, ReplaceOne):
+                self.docs[request._filter["_id"]] = dict(request._doc)
+            else:
+                self.update(request._filter, request._doc, request._upsert)
+
+    async def delete_one(self, query):
+        self.docs.pop(query["_id"], None)
+
+    async def create_index(self, *args, **kwargs):
+        pass
+
+    async def drop(self):
+        self.db.collections.pop(self.name, None)
+
+    async def rename(self, name, dropTarget=False):
+        self.db.collections[name] = self
+        del self.db.collections[self.name]
+        self.name = name
+        self.db.on_rename()
+
+
+class FakeDb:
+    """In memory motor database, collections are created on first use.
+    on_replace and on_rename are called after replace_one() and rename() calls."""
+
+    def __init__(self, **collections):
+        self.collections = {
+            name: FakeCollection(self, name, docs) for name, docs in collections.items()
+        }
+        self.on_replace = self.on_rename = lambda: None
+
+    def __getitem__(self, name):
+        if name not in self.collections:
+            self.collections[name] = FakeCollection(self, name)
+        return self.collections[name]
+
+    def __getattr__(self, name):
+        if name.startswith("_"):
+            raise AttributeError(name)
+        return self[name]
+
+    async def list_collection_names(self):
+        return list(self.collections)
+
+
+class LoadGameTestCase(AioHTTPTestCase):
+    async def startup(self, app):
+        self.bplayer = User(self.app, username="bplayer", perfs=PERFS["newplayer"])
+        self.wplayer = User(self.app, username="wplayer", perfs=PERFS["newplayer"])
+
+    async def get_application(self):
+        app = make_app(with_db=False)
+        app.on_startup.append(self.startup)
+        return app
+
+    async def tearDownAsync(self):
+        await self.client.close()
+
+    async def load(self, db, game_id, game_cache=None):
+        # load_game() with an empty live game dict and a fresh game cache by default
+        if game_cache is None:
+            game_cache = GameCache()
+        app = dict(self.app, db=db, db_writer=DbWriter(db), games={}, game_cache=game_cache)
+        game = await load_game(app, game_id)
+        await app["db_writer"].drain()
+        return game
+
+    async def finished_game(self, variant, game_id="12345678"):
+        game = Game(self.app, game_id, variant, "", self.wplayer, self.bplayer, rated=False)
+        clocks = {"white": 60000, "black": 60000}
+        while game.status <= STARTED and game.board.ply < 30:
+            await game.play_move(random.choice(game.legal_moves), clocks=clocks)
+        self.assertNotEqual(game.status, INVALIDMOVE)
+        return game
+
+    def game_doc(self, game):
+        return {
+            "_id": game.id,
+            "us": ["wplayer", "bplayer"],
+            "v": V2C[game.variant],
+            "b": 5,
+            "i": 3,
+            "bp": 0,
+            "m": encode_move_indexes(game.move_indexes),
+            "mv": INDEX_ENCODING,
+            "d": game.date,
+            "f": game.board.fen,
+            "s": DRAW,
+            "r": "c",
+            "x": 0,
+            "y": 0,
+            "z": 0,
+            "if": game.initial_fen,
+            "uci": 1,
+        }
+
+    async def test_snapshot(self):
+        for variant in ("chess", "shogi", "grand"):
+            game = await self.finished_game(variant)
+            db = FakeDb()
+            db.game.docs[game.id] = self.game_doc(game)
+
+            # the first load replays the moves and saves the snapshot
+            replayed = await self.load(db, game.id)
+            self.assertIn("st", db.game.docs[game.id])
+
+            # the second one takes SANs and check flags from the snapshot
+            with patch.object(FairyBoard, "get_san", side_effect=AssertionError), patch.object(
+                FairyBoard, "is_checked", side_effect=AssertionError
+            ):
+                restored = await self.load(db, game.id)
+
+            for loaded in (replayed, restored):
+                self.assertEqual(loaded.board.move_stack, game.board.move_stack)
+                self.assertEqual(loaded.board.fen, game.board.fen)
+                self.assertEqual(list(loaded.move_indexes), list(game.move_indexes))
+                self.assertEqual(
+                    [(s["fen"], s["san"], s["check"], s["turnColor"]) for s in loaded.steps],
+                    [(s["fen"], s["san"], s["check"], s["turnColor"]) for s in game.steps],
+                )
+
+    async def test_pgn_from_snapshot(self):
+        for variant in ("chess", "grand", "shogi"):
+            game = await self.finished_game(variant)
+            db = FakeDb()
+            db.game.docs[game.id] = self.game_doc(game)
+            await self.load(db, game.id)
+
+            doc = db.game.docs[game.id]
+            without_snapshot = pgn(dict(doc, st=None, s=STARTED))
+            if variant_info(variant).notation == sf.NOTATION_SAN:
+                # SAN moves are read from the snapshot
+                with patch.object(sf, "get_san_moves", side_effect=AssertionError):
+                    self.assertEqual(pgn(doc), without_snapshot)
+            else:
+                self.assertEqual(pgn(doc), without_snapshot)
+
+    async def test_game_cache(self):
+        db = FakeDb()
+        games = [await self.finished_game("chess", game_id) for game_id in ("game0001", "game0002")]
+        for finished in games:
+            db.game.docs[finished.id] = self.game_doc(finished)
+
+        game_cache = GameCache(max_games=1)
+        loaded = await self.load(db, "game0001", game_cache)
+        self.assertIs(await self.load(db, "game0001", game_cache), loaded)
+        self.assertEqual(len(game_cache), 1)
+
+        # the least recently used game is evicted
+        await self.load(db, "game0002", game_cache)
+        self.assertIsNot(await self.load(db, "game0001", game_cache), loaded)
+
+        stats = game_cache.as_dict()
+        self.assertEqual((stats["hits"], stats["misses"], stats["evictions"]), (1, 3, 2))
+        self.assertEqual(stats["games"], 1)
+        self.assertGreater(stats["bytes"], 0)
+
+        # unfinished games are not cached
+        db.game.docs["game0001"]["s"] = STARTED
+        game_cache = GameCache()
+        await self.load(db, "game0001", game_cache)
+        self.assertEqual(len(game_cache), 0)
+
+
+class ExportTestCase(AioHTTPTestCase):
+    async def startup(self, app):
+        self.app["db"] = FakeDb()
+        for i in range(20):
+            board = FairyBoard("chess")
+            indexes = []
+            for ply in range(20):
+                move = random.choice(board.legal_moves())
+                indexes.append(board.move_index(move))
+                board.push(move)
+            game_id = "game%04d" % i
+            self.app["db"].game.docs[game_id] = {
+                "_id": game_id,
+                "us": ["wplayer", "bplayer"],
+                "v": "n",
+                "b": 5,
+                "i": 3,
+                "m": encode_move_indexes(indexes),
+                "mv": INDEX_ENCODING,
+                "d": datetime.now(timezone.utc),
+                "s": DRAW,
+                "r": "c",
+                "y": 0,
+                "tid": "abcdefgh",
+            }
+
+    async def get_application(self):
+        app = make_app(with_db=False)
+        app.on_startup.append(self.startup)
+        return app
+
+    async def tearDownAsync(self):
+        await self.client.close()
+
+    @patch.object(game_api, "EXPORT_BATCHES", 2)
+    @patch.object(game_api, "EXPORT_BATCH_SIZE", 3)
+    async def test_export(self):
+        docs = list(self.app["db"].game.docs.values())
+        expected = "".join(text + "\n" for text in pgn_batch(docs))
+
+        resp = await self.client.request("GET", "/games/export/tournament/abcdefgh")
+        self.assertEqual(resp.content_type, "text/pgn")
+        self.assertEqual(await resp.text(), expected)
+
+        resp = await self.client.request(
+            "GET", "/games/export/tournament/abcdefgh", params={"compression": "gzip"}
+        )
+        self.assertEqual(resp.content_type, "application/gzip")
+        # aiohttp client doesn't decode it, there is no Content-Encoding
+        self.assertEqual(gzip.decompress(await resp.read()).decode(), expected)
+
+        resp = await self.client.request(
+            "GET", "/games/export/tournament/abcdefgh", params={"compression": "bz2"}
+        )
+        self.assertEqual(bz2.decompress(await resp.read()).decode(), expected)
+
+
+class ExportArchiveTestCase(unittest.TestCase):
+    def test_months(self):
+        self.assertEqual(
+            months("2021-11", "2022-02"), [(2021, 11), (2021, 12), (2022, 1), (2022, 2)]
+        )
+        self.assertEqual(months("2021-06", "2021-06"), [(2021, 6)])
+
+    def test_id_ranges(self):
+        ranges = id_ranges(4)
+        self.assertEqual(len(ranges), 4)
+        for i in range(100):
+            game_id = id8()
+            matching = [
+                (first, last)
+                for first, last in ranges
+                if (first is None or game_id >= first) and (last is None or game_id < last)
+            ]
+            self.assertEqual(len(matching), 1)
+
+    def test_resume(self):
+        calls = []
+        # the worker of this part dies in the first run
+        killed = {"pychess_2021-12.pgn.gz.2of2"}
+
+        def fake_export_part(year, month, variants, id_range, path, compression):
+            name = os.path.basename(path)
+            calls.append(name)
+            if name in killed:
+                killed.remove(name)
+                raise RuntimeError("worker killed")
+            with gzip.open(path, "wt") as f:
+                f.write("[Event %s]\n" % name)
+            return 2, ["%s-bad" % name]
+
+        with tempfile.TemporaryDirectory() as out_dir, patch.object(
+            export2pgn, "export_part", fake_export_part
+        ), patch.object(export2pgn, "ProcessPoolExecutor", ThreadPoolExecutor):
+
+            def export():
+                calls.clear()
+                return export_archives(
+                    "2021-11", "2021-12", out_dir=out_dir, workers=2, parts=2, compression="gzip"
+                )
+
+            export()
+            self.assertEqual(len(calls), 4)
+            # November is merged, December waits for its missing part
+            self.assertEqual(
+                sorted(read_manifest(out_dir)),
+                ["pychess_2021-11.pgn.gz", "pychess_2021-12.pgn.gz.1of2"],
+            )
+            self.assertEqual(
+                sorted(os.listdir(out_dir)),
+                ["manifest.json", "pychess_2021-11.pgn.gz", "pychess_2021-12.pgn.gz.1of2"],
+            )
+
+            # only the missing part is exported again, then December is merged
+            export()
+            self.assertEqual(calls, ["pychess_2021-12.pgn.gz.2of2"])
+            manifest = read_manifest(out_dir)
+            self.assertEqual(sorted(manifest), ["pychess_2021-11.pgn.gz", "pychess_2021-12.pgn.gz"])
+            self.assertEqual(
+                manifest["pychess_2021-12.pgn.gz"],
+                {
+                    "games": 4,
+                    "failed": 2,
+                    "failed_games": [
+                        "pychess_2021-12.pgn.gz.1of2-bad",
+                        "pychess_2021-12.pgn.gz.2of2-bad",
+                    ],
+                },
+            )
+            with gzip.open(os.path.join(out_dir, "pychess_2021-12.pgn.gz"), "rt") as f:
+                self.assertEqual(
+                    f.read(),
+                    "[Event pychess_2021-12.pgn.gz.1of2]\n[Event pychess_2021-12.pgn.gz.2of2]\n",
+                )
+            self.assertEqual(
+                sorted(os.listdir(out_dir)),
+                ["manifest.json", "pychess_2021-11.pgn.gz", "pychess_2021-12.pgn.gz"],
+            )
+
+            # finished archives are skipped
+            export()
+            self.assertEqual(calls, [])
+
+
 class SanitizeFenTestCase(unittest.TestCase):
     def test_fen_default(self):
         for variant in VARIANTS:
@@ -177,6 +704,467 @@ class SanitizeFenTestCase(unittest.TestCase):
         self.assertFalse(valid)
 
 
+class VariantInfoTestCase(unittest.TestCase):
+    def test_variant_info(self):
+        load_variant_info()
+        for variant in VARIANTS:
+            variant = variant[:-3] if variant.endswith("960") else variant
+            info = variant_info(variant)
+            self.assertEqual(info.start_fen, sf.start_fen(variant))
+            self.assertEqual(info.notation, FairyBoard(variant).notation)
+
+        self.assertEqual(variant_info("xiangqi").notation, sf.NOTATION_XIANGQI_WXF)
+        self.assertEqual(variant_info("janggi").notation, sf.NOTATION_JANGGI)
+        self.assertEqual(variant_info("crazyhouse").notation, sf.NOTATION_SAN)
+
+
+class BoardHistoryTestCase(unittest.TestCase):
+    SHUFFLE = ("g1f3", "g8f6", "f3g1", "f6g8") * 2
+
+    def assert_same_as_full_replay(self, board):
+        fen, moves = board.initial_fen, board.move_stack
+        variant, chess960 = board.variant, board.chess960
+        self.assertEqual(board.legal_moves(), sf.legal_moves(variant, fen, moves, chess960))
+        self.assertEqual(
+            board.is_optional_game_end()[0],
+            sf.is_optional_game_end(variant, fen, moves, chess960, board.count_started)[0],
+        )
+        self.assertEqual(
+            board.is_immediate_game_end()[0],
+            sf.is_immediate_game_end(variant, fen, moves, chess960)[0],
+        )
+
+    def test_window_starts_after_irreversible_move(self):
+        board = FairyBoard("chess")
+        for move in ("e2e4", "e7e5") + self.SHUFFLE:
+            board.push(move)
+            self.assert_same_as_full_replay(board)
+
+        self.assertTrue(board.is_claimable_draw())
+        self.assertEqual(board.history_start, 0)
+
+        board.push("d2d4")
+        board.push("d7d5")
+        self.assertEqual(board.history_start, board.ply - HISTORY_MARGIN)
+        self.assert_same_as_full_replay(board)
+
+    def test_drop_variant_repetition(self):
+        board = FairyBoard("crazyhouse")
+        opening = ("e2e4", "d7d5", "e4d5", "d8d5", "b1c3", "d5a5", "a2a3", "a7a6")
+        for move in opening + self.SHUFFLE:
+            board.push(move)
+            self.assert_same_as_full_replay(board)
+
+        self.assertTrue(board.is_claimable_draw())
+        self.assertEqual(board.history_start, len(opening) - HISTORY_MARGIN)
+
+    def test_janggi_setup_resets_history(self):
+        board = FairyBoard("janggi")
+        board.janggi_setup("b")
+        self.assertEqual(board.history, (board.initial_fen, []))
+        board.push("e4e5")
+        self.assert_same_as_full_replay(board)
+
+
+class BoardPlayTestCase(unittest.TestCase):
+    def test_legal_moves_cache(self):
+        board = FairyBoard("chess")
+        self.assertTrue(board.is_legal("e2e4"))
+        self.assertFalse(board.is_legal("e2e5"))
+        self.assertIs(board.legal_moves(), board.legal_moves())
+
+        board.push("e2e4")
+        self.assertFalse(board.is_legal("e2e4"))
+        self.assertTrue(board.is_legal("e7e5"))
+        self.assertEqual(board.legal_moves(), sf.legal_moves("chess", board.fen, [], False))
+
+    def test_mate(self):
+        board = FairyBoard("chess")
+        for move in ("f2f3", "e7e5", "g2g4"):
+            after = board.play(move)
+            self.assertFalse(after.check)
+            self.assertTrue(after.legal_moves)
+
+        after = board.play("d8h4")
+        self.assertEqual(after.san, "Qh4#")
+        self.assertEqual(after.fen, board.fen)
+        self.assertTrue(after.check)
+        self.assertEqual(after.legal_moves, [])
+        self.assertFalse(after.immediate_end)
+        self.assertEqual(after.result, board.game_result())
+
+    def test_repetition(self):
+        board = FairyBoard("chess")
+        for move in ("g1f3", "g8f6", "f3g1", "f6g8") * 2:
+            after = board.play(move)
+            self.assertEqual(after.optional_end, board.is_optional_game_end()[0])
+        self.assertTrue(after.optional_end)
+        self.assertEqual(after.result, 0)
+
+
+class StepsTestCase(unittest.TestCase):
+    def test_step_dicts(self):
+        board = FairyBoard("chess")
+        clocks = {"white": 60000, "black": 60000}
+        steps = Steps(board.move_stack, board.fen, "white", False, clocks)
+        san = board.get_san("e2e4")
+        board.push("e2e4")
+        steps.append(board.fen, san, "black", False, {"white": 59000, "black": 60000})
+        san = board.get_san("d7d5")
+        board.push("d7d5")
+        steps.append(board.fen, san, "white", False)
+
+        self.assertEqual(len(steps), 3)
+        self.assertEqual(
+            steps[0],
+            {
+                "fen": board.initial_fen,
+                "san": None,
+                "turnColor": "white",
+                "check": False,
+                "clocks": clocks,
+            },
+        )
+        self.assertEqual(
+            steps[1],
+            {
+                "fen": board.fen_history[1],
+                "move": "e2e4",
+                "san": "e4",
+                "turnColor": "black",
+                "check": False,
+                "clocks": {"white": 59000, "black": 60000},
+            },
+        )
+        self.assertEqual(steps[-1]["fen"], board.fen)
+        self.assertNotIn("clocks", steps[-1])
+        self.assertEqual(steps.last_clocks(), {"white": 59000, "black": 60000})
+
+        steps.annotate(-1, "analysis", {"s": {"cp": 20}})
+        self.assertEqual(steps[2]["analysis"], {"s": {"cp": 20}})
+        steps.remove_annotations("analysis")
+        self.assertNotIn("analysis", steps[2])
+
+        steps.set_fen(0, "8/8/8/8/8/8/8/K6k w - - 0 1")
+        self.assertEqual(steps[0]["fen"], "8/8/8/8/8/8/8/K6k w - - 0 1")
+        self.assertEqual([step["fen"] for step in steps][1:], board.fen_history[1:])
+
+
+class FakeWs:
+    def __init__(self, delay=0):
+        self.delay = delay
+        self.closed = False
+        self.sent = []
+
+    async def send_str(self, text):
+        # like aiohttp: the frame is written at once, then we wait for the buffer to drain
+        self.sent.append(text)
+        await asyncio.sleep(self.delay)
+
+    async def close(self):
+        self.closed = True
+
+
+class BroadcastTestCase(unittest.IsolatedAsyncioTestCase):
+    async def test_encode_once(self):
+        sockets = {"user%s" % i: {FakeWs(), FakeWs()} for i in range(3)}
+        response = {"type": "get_seeks", "seeks": [{"seekID": "abc", "rated": True}]}
+        await lobby_broadcast(sockets, response)
+
+        sent = [ws.sent[0] for ws_set in sockets.values() for ws in ws_set]
+        self.assertEqual(len(sent), 6)
+        self.assertTrue(all(text is sent[0] for text in sent))
+        self.assertEqual(json.loads(sent[0]), response)
+
+    async def test_slow_consumer(self):
+        self.addCleanup(setattr, broadcast, "SEND_TIMEOUT", broadcast.SEND_TIMEOUT)
+        broadcast.SEND_TIMEOUT = 0.1
+        slow = FakeWs(delay=10)
+        sockets = {"slow": {slow}, "fast": {FakeWs() for i in range(100)}}
+        slow_consumers = broadcast_stats.slow_consumers
+
+        # the broadcast doesn't wait for the slow client
+        await asyncio.wait_for(lobby_broadcast(sockets, {"type": "ping"}), 0.05)
+        self.assertTrue(all(ws.sent for ws in sockets["fast"]))
+        self.assertFalse(slow.closed)
+
+        await asyncio.sleep(0.2)
+        self.assertEqual(broadcast_stats.slow_consumers, slow_consumers + 1)
+        self.assertEqual(broadcast_stats.pending, 0)
+        self.assertTrue(slow.closed)
+        self.assertEqual(broadcast.socket_writers, {})
+
+        # closed sockets are skipped
+        await lobby_broadcast(sockets, {"type": "ping"})
+        self.assertEqual(broadcast_stats.slow_consumers, slow_consumers + 1)
+
+    async def test_full_send_queue(self):
+        self.addCleanup(setattr, broadcast, "SEND_TIMEOUT", broadcast.SEND_TIMEOUT)
+        broadcast.SEND_TIMEOUT = 0.1
+        slow = FakeWs(delay=10)
+        slow_consumers = broadcast_stats.slow_consumers
+
+        # one message is being sent, the queue is full with the next ones
+        for i in range(broadcast.SEND_QUEUE_SIZE + 1):
+            await fan_out([slow], "ping")
+        self.assertEqual(broadcast_stats.pending, broadcast.SEND_QUEUE_SIZE)
+        self.assertEqual(broadcast_stats.slow_consumers, slow_consumers)
+
+        await fan_out([slow], "ping")
+        self.assertEqual(broadcast_stats.slow_consumers, slow_consumers + 1)
+        await asyncio.sleep(0.2)
+        self.assertTrue(slow.closed)
+        self.assertEqual(len(slow.sent), 1)
+        self.assertEqual(broadcast_stats.pending, 0)
+
+    async def test_send_keeps_order(self):
+        ws = FakeWs(delay=0.01)
+        await fan_out([ws], json_dumps({"type": "board", "ply": 1}))
+        await fan_out([ws], json_dumps({"type": "board", "ply": 2}))
+        # a direct reply to the player can't overtake the queued broadcasts
+        await send_json(ws, {"type": "board", "ply": 3})
+        await flush_writers()
+        self.assertEqual([json.loads(text)["ply"] for text in ws.sent], [1, 2, 3])
+
+
+def written(collection):
+    """(_id, $set, upsert) of the updates in each bulk_write() batch"""
+    return [
+        [(r._filter["_id"], r._doc["$set"], r._upsert) for r in batch]
+        for batch in collection.batches
+    ]
+
+
+class DbWriterTestCase(unittest.IsolatedAsyncioTestCase):
+    async def test_coalesce(self):
+        db = FakeDb()
+        db_writer = DbWriter(db, delay=0.01)
+        db_writer.update("game", "game0001", {"s": 1, "r": "d"})
+        db_writer.update("user", "user0001", {"perfs": 1})
+        db_writer.update("game", "game0001", {"r": "a"}, upsert=True)
+        self.assertEqual(len(db_writer.pending), 2)
+
+        await db_writer.flush_task
+        self.assertEqual(written(db.game), [[("game0001", {"s": 1, "r": "a"}, True)]])
+        self.assertEqual(written(db.user), [[("user0001", {"perfs": 1}, False)]])
+
+    async def test_rating_updates(self):
+        db = FakeDb()
+        app = {"db": db, "db_writer": DbWriter(db, delay=0.01)}
+        wplayer = User(app, username="wplayer", perfs=dict(PERFS["newplayer"]))
+        bplayer = User(app, username="bplayer", perfs=dict(PERFS["newplayer"]))
+        await wplayer.set_rating("chess", False, gl2.create_rating(1600))
+        await bplayer.set_rating("crazyhouse", True, gl2.create_rating(1400))
+        await wplayer.set_rating("xiangqi", False, gl2.create_rating(1700))
+
+        await app["db_writer"].drain()
+        (batch,) = written(db.user)
+        self.assertEqual(
+            [(doc_id, sorted(new_data)) for doc_id, new_data, upsert in batch],
+            [
+                ("wplayer", ["perfs.chess", "perfs.xiangqi"]),
+                ("bplayer", ["perfs.crazyhouse960"]),
+            ],
+        )
+        self.assertEqual(batch[0][1]["perfs.chess"]["gl"]["r"], 1600)
+
+    async def test_drain_batches(self):
+        db = FakeDb()
+        db_writer = DbWriter(db, delay=60, batch_size=2)
+        for i in range(5):
+            db_writer.update("game", i, {"s": i})
+
+        # drain doesn't wait for the flush delay
+        await asyncio.wait_for(db_writer.drain(), 1)
+        self.assertEqual([len(batch) for batch in db.game.batches], [2, 2, 1])
+        self.assertEqual(db_writer.pending, {})
+
+
+class UsersTestCase(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        perfs = {"chess": {"gl": {"r": 1900, "d": 80, "v": 0.06}, "la": None, "nb": 10}}
+        db = FakeDb(
+            user=[
+                {"_id": "wplayer", "perfs": perfs, "title": "FM"},
+                {"_id": "bplayer", "perfs": perfs},
+            ],
+            game=[{"_id": "12345678", "us": ["wplayer", "bplayer"]}],
+        )
+        self.app = {"db": db, "games": {}, "game_cache": GameCache(), "tournaments": {}}
+        self.users = Users(self.app)
+
+    async def test_load(self):
+        wplayer = await self.users.load("wplayer")
+        self.assertEqual(wplayer.title, "FM")
+        self.assertEqual(wplayer.get_rating("chess", False).mu, 1900)
+        self.assertIs(await self.users.load("wplayer"), wplayer)
+        self.assertEqual(self.app["db"].user.queries, 1)
+
+        self.assertIsNone(await self.users.load("nobody"))
+        self.assertIsNone(await self.users.load("Anon-12345678"))
+        self.assertIsNone(await self.users.load(None))
+        self.assertEqual(self.app["db"].user.queries, 2)
+
+    async def test_evict_idle(self):
+        wplayer = await self.users.load("wplayer")
+        bplayer = await self.users.load("bplayer")
+        for user in (wplayer, bplayer):
+            user.last_seen -= USER_IDLE_TIME + 1
+
+        self.assertEqual(self.users.evict_idle(), 2)
+        self.assertEqual(len(self.users), 0)
+
+        # online users and players of games in memory are kept
+        wplayer = await self.users.load("wplayer")
+        wplayer.online = True
+        bplayer = await self.users.load("bplayer")
+        self.app["games"]["12345678"] = SimpleNamespace(wplayer=wplayer, bplayer=bplayer)
+        for user in (wplayer, bplayer):
+            user.last_seen -= USER_IDLE_TIME + 1
+
+        self.assertEqual(self.users.evict_idle(), 0)
+
+        del self.app["games"]["12345678"]
+        wplayer.online = False
+        self.assertEqual(self.users.evict_idle(), 2)
+
+    async def test_tv_game_user(self):
+        # users not in memory are loaded instead of raising KeyError
+        db = self.app["db"]
+        self.assertEqual(await tv_game_user(db, self.users, "wplayer"), "12345678")
+        self.assertEqual(self.users["wplayer"].tv, "12345678")
+        self.assertIsNone(await tv_game_user(db, self.users, "nobody"))
+
+
+class CrosstableTestCase(unittest.IsolatedAsyncioTestCase):
+    async def test_load(self):
+        db = FakeDb(crosstable=[{"_id": "a/b", "s1": 15, "s2": 5, "r": []}])
+        crosstables = CrosstableCache(db, max_size=2)
+
+        crosstable = await crosstables.load("a/b")
+        self.assertEqual(crosstable["s1"], 15)
+        self.assertIs(await crosstables.load("a/b"), crosstable)
+        self.assertEqual(db.crosstable.queries, 1)
+
+        # pairs without games get an empty crosstable
+        self.assertEqual(await crosstables.load("a/c"), empty_crosstable("a/c"))
+        await crosstables.load("b/c")
+        self.assertEqual(len(crosstables), 2)
+        self.assertIsNone(crosstables.get("a/b"))
+        self.assertEqual(crosstables.as_dict()["evictions"], 1)
+
+    def test_batch_updates(self):
+        docs = [
+            {"_id": "game0001", "us": ["b", "a"], "r": "a"},
+            {"_id": "game0002", "us": ["a", "b"], "r": "c"},
+            {"_id": "game0003", "us": ["a", "Anon-abcdefgh"], "r": "a"},
+            {"_id": "game0004", "us": ["a", "Fairy-Stockfish"], "r": "b"},
+            {"_id": "game0005", "us": ["a", "b"], "r": "d"},
+        ]
+        requests = batch_updates(docs, 3)
+        self.assertEqual(len(requests), 1)
+
+        update = requests[0]._doc
+        self.assertEqual(requests[0]._filter, {"_id": "a/b", "seq": {"$lt": 3}})
+        self.assertEqual(update["$inc"], {"s1": 5, "s2": 15})
+        self.assertEqual(update["$push"]["r"]["$each"], ["game0001-", "game0002="])
+
+
+class FakeLiveGame:
+    def __init__(self):
+        self.status = STARTED
+        self.reloaded = 0
+
+    async def load_crosstable(self):
+        self.reloaded += 1
+
+
+class CrosstableRebuildTestCase(unittest.IsolatedAsyncioTestCase):
+    async def test_games_finished_during_rebuild(self):
+        games = [
+            {"_id": "game0001", "us": ["a", "b"], "r": "a", "d": 1, "s": MATE},
+            {"_id": "game0002", "us": ["a", "b"], "r": "d", "d": 2, "s": STARTED},
+            {"_id": "game0003", "us": ["a", "c"], "r": "b", "d": 3, "s": MATE},
+        ]
+        db = FakeDb(game=games, crosstable=[{"_id": "a/b", "s1": 10, "s2": 0, "r": ["game0001+"]}])
+        live_game = FakeLiveGame()
+        app = {
+            "db": db,
+            "db_writer": DbWriter(None),
+            "games": {"game0004": live_game},
+            "crosstable": CrosstableCache(None),
+            "crosstable_swap": None,
+        }
+        app["crosstable"].put(empty_crosstable("a/c"))
+
+        def finish_game0002():
+            # the scan already passed game0002 when it finished
+            db.game.docs["game0002"].update({"r": "b", "s": MATE})
+
+        def finish_game0004():
+            # game0004 finished while the rebuilt collection was renamed
+            app["crosstable_swap"]["game0004"] = {"_id": "game0004", "us": ["c", "a"], "r": "c"}
+
+        db.on_replace = finish_game0002
+        db.on_rename = finish_game0004
+        await generate_crosstable(db, batch_size=2, pause=0, app=app)
+
+        self.assertNotIn(REBUILD_COLLECTION, db.collections)
+        crosstables = db.crosstable.docs
+        self.assertEqual(crosstables["a/b"]["r"], ["game0001+", "game0002-"])
+        self.assertEqual((crosstables["a/b"]["s1"], crosstables["a/b"]["s2"]), (10, 10))
+        self.assertEqual(crosstables["a/c"]["r"], ["game0003-", "game0004="])
+        self.assertEqual((crosstables["a/c"]["s1"], crosstables["a/c"]["s2"]), (5, 15))
+        self.assertEqual(db.checkpoint.docs, {})
+
+        # crosstables read from the old collection are forgotten
+        self.assertEqual(len(app["crosstable"]), 0)
+        self.assertEqual(live_game.reloaded, 1)
+        self.assertIsNone(app["crosstable_swap"])
+
+
+class FakeSeek:
+    def __init__(self, seek_id, user):
+        self.as_json = {"seekID": seek_id, "user": user}
+
+
+class SeekFeedTestCase(unittest.IsolatedAsyncioTestCase):
+    async def test_seek_changes_are_coalesced(self):
+        self.addCleanup(setattr, seek, "SEEK_FEED_DELAY", seek.SEEK_FEED_DELAY)
+        seek.SEEK_FEED_DELAY = 0.01
+        ws = FakeWs()
+        app = {"seeks": {}, "lobbysockets": {"lobbyuser": {ws}}}
+        feed = SeekFeed(app)
+
+        for i in range(1, 4):
+            app["seeks"][i] = FakeSeek(i, "user%s" % i)
+            feed.changed()
+        await asyncio.sleep(0.05)
+        self.assertEqual(len(ws.sent), 1)
+        self.assertEqual(
+            json.loads(ws.sent[0]),
+            {
+                "type": "seeks_update",
+                "add": [s.as_json for s in app["seeks"].values()],
+                "remove": [],
+            },
+        )
+
+        del app["seeks"][1]
+        app["seeks"][2].as_json = {"seekID": 2, "user": "user2", "player2": "user4"}
+        feed.changed()
+        await asyncio.sleep(0.05)
+        self.assertEqual(
+            json.loads(ws.sent[1]),
+            {"type": "seeks_update", "add": [app["seeks"][2].as_json], "remove": [1]},
+        )
+
+        # nothing changed, nothing sent
+        feed.changed()
+        await asyncio.sleep(0.05)
+        self.assertEqual(len(ws.sent), 2)
+
+
 class RequestLobbyTestCase(AioHTTPTestCase):
     async def tearDownAsync(self):
         for user in self.app["users"].values():
@@ -199,6 +1187,13 @@ class RequestLobbyTestCase(AioHTTPTestCase):
         text = await resp.text()
         self.assertIn("<title>PyChess", text)
 
+    async def test_readiness(self):
+        resp = await self.client.request("GET", "/api/ready")
+        self.assertEqual(resp.status, 200)
+        startup = await resp.json()
+        self.assertTrue(startup["ready"])
+        self.assertIn("translations", startup["stages"])
+
 
 class GamePlayTestCase(AioHTTPTestCase):
     async def startup(self, app):
@@ -250,7 +1245,6 @@ class GamePlayTestCase(AioHTTPTestCase):
 
 class HighscoreTestCase(AioHTTPTestCase):
     async def startup(self, app):
-        self.app["highscore"] = {variant: ValueSortedDict(neg) for variant in VARIANTS}
         self.app["highscore"]["crazyhouse960"] = ValueSortedDict(neg, ZH960)
 
         self.wplayer = User(self.app, username="user7", perfs=PERFS["user7"])
@@ -276,13 +1270,36 @@ class HighscoreTestCase(AioHTTPTestCase):
             print(row)
 
     async def play_and_resign(self, game, player):
-        clock = game.ply_clocks[0]["white"]
+        clock = game.steps.clocks(0)["white"]
         for i, move in enumerate(("e2e4", "e7e5", "f2f4"), start=1):
             await game.play_move(
                 move, clocks={"white": clock, "black": clock, "movetime": 0}, ply=i
             )
         await game.game_ended(player, "resign")
 
+    async def test_write_top_changes_only(self):
+        updates = []
+        app = {
+            "db": object(),
+            "db_writer": SimpleNamespace(update=lambda *args, **kwargs: updates.append(args)),
+        }
+        highscore = Highscores(app)
+        for i in range(HIGHSCORE_STORED):
+            highscore.update_score("chess", "player%s" % i, 2000 - i)
+        self.assertEqual(len(updates), HIGHSCORE_STORED)
+
+        # changes below the stored top are kept in memory only
+        highscore.update_score("chess", "weakplayer", 1000)
+        highscore.update_score("chess", "weakplayer", 1010)
+        self.assertEqual(len(updates), HIGHSCORE_STORED)
+
+        highscore.update_score("chess", "weakplayer", 2500)
+        self.assertEqual(len(updates), HIGHSCORE_STORED + 1)
+        collection, variant, new_data = updates[-1]
+        self.assertEqual(list(new_data["scores"])[0], "weakplayer")
+        self.assertEqual(len(new_data["scores"]), HIGHSCORE_STORED)
+        self.assertEqual(highscore.top("chess", 1), {"weakplayer": 2500})
+
     async def test_lost_but_still_there(self):
         game_id = id8()
         game = Game(
@@ -405,6 +1422,48 @@ class HighscoreTestCase(AioHTTPTestCase):
         )
 
 
+class HighscoreLoadTestCase(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        ratings = {"player%s" % i: 2000 - i for i in range(150)}
+        users = [
+            {"_id": username, "perfs": {"chess": {"gl": {"r": rating, "d": 60}, "nb": 20}}}
+            for username, rating in ratings.items()
+        ]
+        # top 10 list stored by older servers
+        top10 = dict(list(ratings.items())[:10])
+        self.db = FakeDb(user=users, highscore=[{"_id": "chess", "scores": top10}])
+        self.updates = []
+        app = {
+            "db": self.db,
+            "db_writer": SimpleNamespace(update=lambda *args, **kwargs: self.updates.append(args)),
+        }
+        self.highscore = Highscores(app)
+
+    async def test_load_regenerates_short_lists(self):
+        await self.highscore.load()
+        self.assertEqual(len(self.highscore["chess"]), HIGHSCORE_STORED)
+        self.assertEqual(self.highscore.cutoff["chess"], 2000 - HIGHSCORE_STORED + 1)
+        # variants without enough players have no cutoff
+        self.assertIsNone(self.highscore.cutoff["crazyhouse"])
+        self.assertEqual(len(self.db.highscore.docs["chess"]["scores"]), HIGHSCORE_STORED)
+
+    async def test_refill_below_cutoff(self):
+        await self.highscore.load()
+
+        # top players lose until less than HIGHSCORE_SIZE known ones are left above the cutoff
+        for i in range(HIGHSCORE_STORED - HIGHSCORE_SIZE + 1):
+            self.db.user.docs["player%s" % i]["perfs"]["chess"]["gl"]["r"] = 1000
+            self.highscore.update_score("chess", "player%s" % i, 1000)
+        self.assertIn("chess", self.highscore.refill_tasks)
+        await self.highscore.refill_tasks["chess"]
+
+        top = self.highscore.top("chess", HIGHSCORE_SIZE)
+        expected = ["player%s" % i for i in range(51, 51 + HIGHSCORE_SIZE)]
+        self.assertEqual(list(top), expected)
+        self.assertEqual(list(self.updates[-1][2]["scores"])[:HIGHSCORE_SIZE], expected)
+        self.assertNotIn("chess", self.highscore.refill_tasks)
+
+
 class RatingTestCase(AioHTTPTestCase):
     async def startup(self, app):
         self.gl2 = Glicko2(tau=0.5)
@@ -1,13 +1,28 @@
 # -*- coding: utf-8 -*-
 
+import os
+import random
 import string
+import subprocess
+import sys
 import unittest
+from datetime import datetime, timezone
 
 import pyffish as sf
 
-from compress import encode_moves, decode_moves
+from compress import (
+    encode_moves,
+    decode_moves,
+    encode_move_indexes,
+    decode_move_indexes,
+    INDEX_ENCODING,
+    V2C,
+)
+from convert import grand2zero
 from fairy import FairyBoard
-from const import VARIANTS
+from const import GRANDS, VARIANTS
+from migrate_moves import index_encode
+from utils import pgn
 
 sf.set_option("VariantPath", "variants.ini")
 
@@ -38,5 +53,83 @@ class EncodeDecodeTestCase(unittest.TestCase):
             self.assertEqual(saved_restored, moves)
 
 
+def random_game(variant, chess960, plies):
+    board = FairyBoard(variant, chess960=chess960)
+    indexes = []
+    for ply in range(plies):
+        moves = board.legal_moves()
+        if not moves:
+            break
+        move = random.choice(moves)
+        indexes.append(board.move_index(move))
+        board.push(move)
+    return board, indexes
+
+
+class IndexEncodingTestCase(unittest.TestCase):
+    def setUp(self):
+        random.seed(11)
+
+    def test_encode_decode(self):
+        for variant in VARIANTS:
+            chess960 = variant.endswith("960")
+            variant = variant[:-3] if chess960 else variant
+            board, indexes = random_game(variant, chess960, 60)
+
+            encoded = encode_move_indexes(indexes)
+            self.assertEqual(len(encoded), len(board.move_stack))
+
+            restored = FairyBoard(variant, board.initial_fen, chess960)
+            self.assertEqual(decode_move_indexes(encoded, restored), board.move_stack)
+            self.assertEqual(restored.fen, board.fen)
+
+    def test_migrate_old_document(self):
+        for variant in ("chess", "grand", "shogi", "janggi", "crazyhouse"):
+            board, indexes = random_game(variant, False, 40)
+            old_doc = {
+                "_id": "abcdefgh",
+                "v": V2C[variant],
+                "if": board.initial_fen,
+                "us": ["white", "black"],
+                "d": datetime.now(timezone.utc),
+                "r": "d",
+                "b": 5,
+                "i": 3,
+                "z": 0,
+                "uci": 1,
+                "m": encode_moves(
+                    map(grand2zero, board.move_stack) if variant in GRANDS else board.move_stack,
+                    variant,
+                ),
+            }
+
+            moves, lastmove = index_encode(old_doc)
+            self.assertEqual(moves, encode_move_indexes(indexes))
+            self.assertEqual(lastmove, board.move_stack[-1])
+
+            new_doc = dict(old_doc, m=moves, mv=INDEX_ENCODING, lm=lastmove)
+            self.assertEqual(pgn(new_doc), pgn(old_doc))
+
+    def test_migrate_variants_ini_document(self):
+        # The migrator runs standalone, without game/utils setting the VariantPath
+        script = """
+from compress import encode_moves, V2C
+from migrate_moves import index_encode
+
+doc = {"_id": "abcdefgh", "v": V2C["orda"], "z": 0, "uci": 1, "m": encode_moves(["e2e4"], "orda")}
+print(index_encode(doc))
+"""
+        env = dict(os.environ, PYTHONPATH="server")
+        proc = subprocess.run(
+            [sys.executable, "-c", script], env=env, capture_output=True, text=True
+        )
+        self.assertEqual(proc.returncode, 0, proc.stderr)
+        self.assertIn("e2e4", proc.stdout.splitlines()[-1])
+
+    def test_migrate_broken_document(self):
+        doc = {"_id": "abcdefgh", "v": V2C["chess"], "if": "not a fen", "z": 0, "m": 42}
+        self.assertIsNone(index_encode(doc))
+
+
 if __name__ == "__main__":
     unittest.main(verbosity=2)
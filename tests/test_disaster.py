@@ -93,7 +93,7 @@ class ArenaTestTournament(Tournament):
             self.game_tasks.add(asyncio.create_task(self.play_disaster_game(game)))
 
     async def play_disaster_game(self, game):
-        clock = game.ply_clocks[0]["white"]
+        clock = game.steps.clocks(0)["white"]
         clocks = {"white": clock, "black": clock}
         game.berserk("white")
 
@@ -155,6 +155,7 @@ class GamePlayTestCase(AioHTTPTestCase):
         self.app["db"].game.find_one_and_update = AsyncMock(return_value=None)
         self.app["db"].game.insert_one = AsyncMock(return_value=None)
 
+        self.app["db"].user.find_one = AsyncMock(return_value=None)
         self.app["db"].user.find_one_and_update = AsyncMock(return_value=None)
 
         # self.tournament = ArenaTestTournament(self.app, self.tid, before_start=0, minutes=0.1)
@@ -193,7 +194,7 @@ class GamePlayTestCase(AioHTTPTestCase):
 
     async def test_tournament_disaster(self):
 
-        await self.tournament.clock_task
+        await self.tournament.clock_done
 
         self.assertEqual(self.tournament.players[self.test_wplayer].nb_berserk, 1)
 
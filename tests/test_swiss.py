@@ -0,0 +1,160 @@
+# -*- coding: utf-8 -*-
+
+import random
+import unittest
+
+from dutch import (
+    SwissPlayer,
+    dutch_pairing,
+    allocate_colors,
+    color_preference,
+    WHITE,
+    BLACK,
+    MILD,
+    STRONG,
+    ABSOLUTE,
+)
+from swiss import tiebreaks
+
+
+def new_players(nb_players):
+    return [SwissPlayer(rank, rank) for rank in range(1, nb_players + 1)]
+
+
+def ids(pairs):
+    return [(wp.id, bp.id) for wp, bp in pairs]
+
+
+def play_round(players, pairs, bye, results):
+    """results: {(white id, black id): white result} where result is 2/1/0"""
+    by_id = {player.id: player for player in players}
+    for (wid, bid), wresult in results.items():
+        wp, bp = by_id[wid], by_id[bid]
+        wp.score += wresult
+        bp.score += 2 - wresult
+        wp.colors.append(WHITE)
+        bp.colors.append(BLACK)
+        wp.opponents.add(bp.id)
+        bp.opponents.add(wp.id)
+    if bye is not None:
+        bye.had_bye = True
+    for player in players:
+        player.preference = color_preference(player.colors)
+
+
+class ColorPreferenceTestCase(unittest.TestCase):
+    def test_preferences(self):
+        self.assertEqual(color_preference([]), (None, 0))
+        self.assertEqual(color_preference([WHITE, BLACK]), (WHITE, MILD))
+        self.assertEqual(color_preference([WHITE]), (BLACK, STRONG))
+        self.assertEqual(color_preference([BLACK, WHITE, BLACK]), (WHITE, STRONG))
+        self.assertEqual(color_preference([WHITE, BLACK, BLACK]), (WHITE, ABSOLUTE))
+        self.assertEqual(color_preference([BLACK, WHITE, WHITE]), (BLACK, ABSOLUTE))
+
+    def test_allocation(self):
+        # E.1 both preferences granted
+        x = SwissPlayer(1, 1, colors=[WHITE])
+        y = SwissPlayer(2, 2, colors=[BLACK])
+        self.assertEqual(allocate_colors(x, y), (y, x))
+
+        # E.2 stronger preference granted
+        x = SwissPlayer(1, 1, colors=[WHITE, BLACK])
+        y = SwissPlayer(2, 2, colors=[BLACK, BLACK, WHITE])
+        self.assertEqual(allocate_colors(x, y), (y, x))
+
+        # E.4 alternate to the last round with different colors
+        x = SwissPlayer(1, 1, colors=[WHITE, BLACK, WHITE, BLACK])
+        y = SwissPlayer(2, 2, colors=[BLACK, WHITE, WHITE, BLACK])
+        self.assertEqual(allocate_colors(x, y), (x, y))
+
+        # E.5 higher ranked player's preference granted
+        x = SwissPlayer(1, 3, colors=[WHITE])
+        y = SwissPlayer(2, 4, colors=[WHITE])
+        self.assertEqual(allocate_colors(x, y), (y, x))
+
+
+class DutchPairingTestCase(unittest.TestCase):
+    def test_first_round(self):
+        pairs, bye = dutch_pairing(new_players(8))
+        self.assertIsNone(bye)
+        self.assertEqual(ids(pairs), [(1, 5), (6, 2), (3, 7), (8, 4)])
+
+    def test_first_round_bye(self):
+        pairs, bye = dutch_pairing(new_players(7))
+        self.assertEqual(bye.id, 7)
+        self.assertEqual(ids(pairs), [(1, 4), (5, 2), (3, 6)])
+
+    def test_second_round_score_groups(self):
+        players = new_players(8)
+        pairs, bye = dutch_pairing(players)
+        # white wins everywhere: 1, 6, 3, 8 have 1 point
+        play_round(players, pairs, bye, {pair: 2 for pair in ids(pairs)})
+
+        pairs, bye = dutch_pairing(players)
+        winners = {1, 3, 6, 8}
+        for wid, bid in ids(pairs):
+            self.assertEqual(wid in winners, bid in winners)
+        # 1 and 3 played white, they get black against 6 and 8
+        self.assertEqual(ids(pairs)[:2], [(6, 1), (8, 3)])
+
+    def test_downfloater(self):
+        players = new_players(6)
+        players[0].score = 2
+        players[1].score = 2
+        players[2].score = 2
+        pairs, bye = dutch_pairing(players)
+        # lowest player of the odd top group floats down to the highest of the next
+        self.assertEqual(ids(pairs), [(1, 2), (3, 4), (5, 6)])
+
+    def test_no_second_bye(self):
+        players = new_players(5)
+        players[4].had_bye = True
+        pairs, bye = dutch_pairing(players)
+        self.assertEqual(bye.id, 4)
+
+    def test_absolute_criteria(self):
+        random.seed(1)
+        for nb_players in (9, 20, 31):
+            players = new_players(nb_players)
+            for round_no in range(7):
+                pairs, bye = dutch_pairing(players)
+                self.assertEqual(len(pairs), nb_players // 2)
+                if bye is not None:
+                    self.assertFalse(bye.had_bye)
+                for wp, bp in pairs:
+                    # C.1 no rematch
+                    self.assertNotIn(bp.id, wp.opponents)
+                results = {pair: random.choice((0, 1, 2)) for pair in ids(pairs)}
+                play_round(players, pairs, bye, results)
+                for player in players:
+                    # C.3 color difference and same color in a row limits
+                    self.assertLessEqual(abs(player.color_diff), 2)
+                    self.assertNotIn(player.colors[-3:], ([WHITE] * 3, [BLACK] * 3))
+
+    def test_collapse_last_bracket(self):
+        players = new_players(4)
+        # the two 0 point players already played, so they have to pair up with the others
+        players[0].score = players[1].score = 2
+        players[2].opponents.add(4)
+        players[3].opponents.add(3)
+        pairs, bye = dutch_pairing(players)
+        self.assertEqual(sorted(sorted(pair) for pair in ids(pairs)), [[1, 3], [2, 4]])
+
+
+class TiebreakTestCase(unittest.TestCase):
+    def test_buchholz_sonneborn_berger(self):
+        scores = {"a": 4, "b": 2, "c": 2, "d": 0}
+        results = {
+            "a": [("b", 2), ("c", 2)],
+            "b": [("a", 0), ("d", 2)],
+            "c": [("d", 1), ("a", 0)],
+            "d": [("c", 1), ("b", 0)],
+        }
+        self.assertEqual(
+            tiebreaks(results, scores),
+            {"a": (4, 4), "b": (4, 0), "c": (4, 0), "d": (4, 1)},
+        )
+
+
+if __name__ == "__main__":
+    unittest.main(verbosity=2)
@@ -4,7 +4,7 @@ import asyncio
 import collections
 import random
 import unittest
-from datetime import datetime, timezone
+from datetime import datetime, timedelta, timezone
 
 from aiohttp.test_utils import AioHTTPTestCase
 
@@ -25,10 +25,21 @@ from glicko2.glicko2 import DEFAULT_PERF
 from newid import id8
 from server import make_app
 from user import User
-from tournament import Tournament
+from tournament import (
+    Tournament,
+    PlayerData,
+    FEW_WAITING_PLAYERS,
+    MAX_WAVE,
+    MIN_WAVE,
+    PAIRING_COST_FACTOR,
+    NOTIFY1_MINUTES,
+    WAVE_GAME_TIME_DIVISOR,
+)
+from tournament_clock import TournamentClock
 from tournaments import upsert_tournament_to_db, new_tournament
 from draw import draw
-from arena import ArenaTournament
+from arena import ArenaTournament, PAIRING_GROUP_SIZE
+from matching import max_weight_matching
 from rr import RRTournament
 from swiss import SwissTournament
 from utils import play_move
@@ -101,11 +112,8 @@ class TestTournament(Tournament):
                         await opp_ws.send_json(response)
                 else:
                     move = random.choice(game.legal_moves)
-                    clocks = {
-                        "white": game.ply_clocks[-1]["white"],
-                        "black": game.ply_clocks[-1]["black"],
-                        "movetime": 0,
-                    }
+                    clocks = game.clocks
+                    clocks["movetime"] = 0
                     await play_move(self.app, cur_player, game, move, clocks=clocks)
             await asyncio.sleep(0.1)
 
@@ -223,7 +231,7 @@ class TournamentTestCase(AioHTTPTestCase):
         await asyncio.sleep((self.tournament.minutes * 60) + 0.1)
         self.assertEqual(self.tournament.status, T_FINISHED)
 
-        await self.tournament.clock_task
+        await self.tournament.clock_done
 
     @unittest.skipIf(ONE_TEST_ONLY, "1 test only")
     async def test_tournament_players(self):
@@ -243,7 +251,7 @@ class TournamentTestCase(AioHTTPTestCase):
         self.assertEqual(len(self.tournament.players), NB_PLAYERS)
         self.assertEqual(len(self.tournament.leaderboard), NB_PLAYERS - 1)
 
-        await self.tournament.clock_task
+        await self.tournament.clock_done
 
         self.assertEqual(self.tournament.status, T_FINISHED)
 
@@ -262,7 +270,7 @@ class TournamentTestCase(AioHTTPTestCase):
             del list(self.tournament.players.keys())[i].tournament_sockets[self.tournament.id]
         self.assertEqual(len(self.tournament.waiting_players()), NB_PLAYERS - 12)
 
-        await self.tournament.clock_task
+        await self.tournament.clock_done
 
         self.assertEqual(self.tournament.status, T_FINISHED)
 
@@ -279,7 +287,7 @@ class TournamentTestCase(AioHTTPTestCase):
         self.app["tournaments"][tid] = self.tournament
         await self.tournament.join_players(NB_PLAYERS)
 
-        await self.tournament.clock_task
+        await self.tournament.clock_done
 
         self.assertEqual(self.tournament.status, T_FINISHED)
         self.assertEqual(
@@ -305,7 +313,7 @@ class TournamentTestCase(AioHTTPTestCase):
 
         self.assertEqual(len(self.tournament.waiting_players()), NB_PLAYERS - 2)
 
-        await self.tournament.clock_task
+        await self.tournament.clock_done
 
         self.assertEqual(self.tournament.status, T_FINISHED)
 
@@ -320,7 +328,7 @@ class TournamentTestCase(AioHTTPTestCase):
         self.app["tournaments"][tid] = self.tournament
         await self.tournament.join_players(NB_PLAYERS)
 
-        await self.tournament.clock_task
+        await self.tournament.clock_done
 
         self.assertEqual(self.tournament.status, T_FINISHED)
         self.assertEqual(
@@ -329,5 +337,196 @@ class TournamentTestCase(AioHTTPTestCase):
         )
 
 
+class MatchingTestCase(unittest.TestCase):
+    def brute_force(self, edges):
+        weights = {}
+        for i, j, w in edges:
+            weights[(i, j)] = weights[(j, i)] = w
+
+        def best(free):
+            if not free:
+                return 0
+            v, rest = free[0], free[1:]
+            return max(
+                [best(rest)]
+                + [
+                    weights[(v, u)] + best([x for x in rest if x != u])
+                    for u in rest
+                    if (v, u) in weights
+                ]
+            )
+
+        return best(list(range(1 + max(max(i, j) for i, j, w in edges))))
+
+    def test_max_weight_matching(self):
+        random.seed(42)
+        for i in range(500):
+            n = random.randint(2, 8)
+            edges = [
+                (i, j, random.randint(1, 20))
+                for i in range(n)
+                for j in range(i + 1, n)
+                if random.random() < 0.6
+            ]
+            if not edges:
+                continue
+            weights = {(i, j): w for i, j, w in edges}
+            mate = max_weight_matching(edges)
+            total = 0
+            for v, u in enumerate(mate):
+                if u > v:
+                    self.assertEqual(mate[u], v)
+                    total += weights[(v, u)]
+            self.assertEqual(total, self.brute_force(edges))
+
+
+class ArenaPairingTestCase(unittest.TestCase):
+    def make_arena(self, nb_players):
+        app = {"db": None}
+        arena = ArenaTournament(app, id8(), with_clock=False)
+        for i in range(nb_players):
+            player = User(app, username="player%s" % i, perfs=PERFS)
+            arena.players[player] = PlayerData(1500, "")
+            arena.leaderboard[player] = nb_players - i
+        return arena
+
+    def waiting_players(self, arena):
+        return list(arena.leaderboard)
+
+    def test_pairs_everybody(self):
+        arena = self.make_arena(101)
+        pairing = arena.create_pairing(self.waiting_players(arena))
+        self.assertEqual(len(pairing), 50)
+        paired = set(p for pair in pairing for p in pair)
+        self.assertEqual(len(paired), 100)
+        self.assertEqual(sum(p.nb_not_paired for p in arena.players.values()), 1)
+
+    def test_no_rematch(self):
+        arena = self.make_arena(4)
+        a, b, c, d = self.waiting_players(arena)
+        arena.players[a].prev_opp = b.username
+        arena.players[b].prev_opp = a.username
+        arena.players[c].prev_opp = d.username
+        arena.players[d].prev_opp = c.username
+        pairing = arena.create_pairing([a, b, c, d])
+        self.assertEqual(len(pairing), 2)
+        for x, y in pairing:
+            self.assertFalse(arena.just_played_together(x, y))
+
+    def test_rematch_of_last_two(self):
+        arena = self.make_arena(2)
+        a, b = self.waiting_players(arena)
+        arena.players[a].prev_opp = b.username
+        arena.players[b].prev_opp = a.username
+
+        arena.ongoing_games = 1
+        self.assertEqual(arena.create_pairing([a, b]), [])
+
+        arena.ongoing_games = 0
+        self.assertEqual(len(arena.create_pairing([a, b])), 1)
+
+    def test_color_balance(self):
+        arena = self.make_arena(2)
+        a, b = self.waiting_players(arena)
+        arena.players[a].color_balance = 1
+        arena.players[b].color_balance = -1
+        self.assertEqual(arena.create_pairing([a, b]), [(b, a)])
+
+    def test_waiting_player_paired_first(self):
+        arena = self.make_arena(3)
+        a, b, c = self.waiting_players(arena)
+        arena.players[c].nb_not_paired = 2
+        pairing = arena.create_pairing([a, b, c])
+        self.assertIn(c, pairing[0])
+        self.assertEqual(arena.players[c].nb_not_paired, 2)
+
+    def test_groups_carry_unpaired(self):
+        arena = self.make_arena(2 * PAIRING_GROUP_SIZE)
+        players = self.waiting_players(arena)
+        # the last player of the first group can only play with the next group
+        last = players[PAIRING_GROUP_SIZE - 1]
+        for player in players[:PAIRING_GROUP_SIZE]:
+            if player is not last:
+                arena.players[player].prev_opp = last.username
+        pairing = arena.create_pairing(players)
+        self.assertEqual(len(pairing), PAIRING_GROUP_SIZE)
+
+
+class WaveTestCase(unittest.TestCase):
+    def test_adapt_wave(self):
+        app = {"db": None}
+        # 3+2 blitz: 260 s estimated game time
+        arena = ArenaTournament(app, id8(), base=3, inc=2, with_clock=False)
+        longest = timedelta(seconds=260 / WAVE_GAME_TIME_DIVISOR)
+
+        arena.adapt_wave(0)
+        self.assertEqual(arena.wave, longest)
+        arena.adapt_wave(FEW_WAITING_PLAYERS)
+        self.assertEqual(arena.wave, longest)
+
+        arena.adapt_wave(2 * FEW_WAITING_PLAYERS)
+        self.assertEqual(arena.wave, longest / 2)
+
+        arena.adapt_wave(1000)
+        self.assertEqual(arena.wave, timedelta(seconds=MIN_WAVE))
+
+        # slow pairing makes the waves longer
+        arena.pairing_cost = 1.0
+        arena.adapt_wave(1000)
+        self.assertEqual(arena.wave, timedelta(seconds=PAIRING_COST_FACTOR))
+
+    def test_wave_limits(self):
+        app = {"db": None}
+        bullet = ArenaTournament(app, id8(), base=0.25, inc=0, with_clock=False)
+        self.assertEqual(bullet.wave, timedelta(seconds=MIN_WAVE))
+
+        classical = ArenaTournament(app, id8(), base=30, inc=20, with_clock=False)
+        self.assertEqual(classical.wave, timedelta(seconds=MAX_WAVE))
+
+
+class FakeClockTournament:
+    def __init__(self, tid, ticks, next_events):
+        self.id = tid
+        self.ticks = ticks
+        self.next_events = next_events
+
+    async def clock_tick(self, now):
+        self.ticks.append(self.id)
+        return self.next_events.pop(0) if self.next_events else None
+
+
+class TournamentClockTestCase(unittest.IsolatedAsyncioTestCase):
+    async def test_order_and_wake(self):
+        clock = TournamentClock()
+        ticks = []
+        now = datetime.now(timezone.utc)
+        later = FakeClockTournament("later", ticks, [])
+        sooner = FakeClockTournament("sooner", ticks, [now + timedelta(seconds=0.2)])
+        idle = FakeClockTournament("idle", ticks, [])
+
+        clock.schedule(later, now + timedelta(seconds=0.1))
+        clock.schedule(sooner, now + timedelta(seconds=0.05))
+        clock.schedule(idle, now + timedelta(days=1))
+        await asyncio.sleep(0.3)
+        self.assertEqual(ticks, ["sooner", "later", "sooner"])
+
+        # waking runs the far away tournament now
+        clock.wake(idle)
+        await asyncio.sleep(0.05)
+        self.assertEqual(ticks[-1], "idle")
+        clock.stop()
+
+    async def test_next_event_of_scheduled_tournament(self):
+        app = {"db": None, "tournament_clock": TournamentClock()}
+        now = datetime.now(timezone.utc)
+        starts_at = now + timedelta(days=1)
+        tournament = ArenaTournament(app, id8(), starts_at=starts_at)
+
+        # nothing to do until the first notification
+        when = await tournament.clock_tick(now)
+        self.assertEqual(when, starts_at - timedelta(minutes=NOTIFY1_MINUTES + 1, seconds=-1))
+        app["tournament_clock"].stop()
+
+
 if __name__ == "__main__":
     unittest.main(verbosity=2)